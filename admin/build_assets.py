@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import sys
+
+from app import app
+from assets import DIST_DIRECTORY, MANIFEST_NAME
+
+# Builds static/dist, see assets.py.
+#
+# usage: python admin/build_assets.py [--clean]
+#   --clean  delete built files the new manifest no longer refers to. Without it the files of earlier
+#            builds are kept, so pages rendered by a server still running the old manifest keep working.
+
+SOURCE_DIRECTORIES = ["js", "css", "vendor"]
+HASH_LENGTH = 12
+
+# files worth compressing; images and fonts other than these are compressed already
+COMPRESSIBLE_EXTENSIONS = {".js", ".css", ".map", ".svg", ".json", ".txt", ".html", ".ttf", ".eot", ".otf"}
+
+# references to other files inside CSS and JS, rewritten to the built names
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+SOURCE_MAP_URL = re.compile(r"""(sourceMappingURL=)([^\s*'"]+)""")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _source_files(static_directory: str) -> list:
+    """Paths, relative to static and with forward slashes, of the files to build."""
+    files = []
+    for directory in SOURCE_DIRECTORIES:
+        for root, dirs, filenames in os.walk(os.path.join(static_directory, directory)):
+            dirs[:] = sorted(x for x in dirs if not x.startswith("."))
+            for filename in sorted(filenames):
+                if not filename.startswith("."):
+                    path = os.path.relpath(os.path.join(root, filename), static_directory)
+                    files.append(path.replace(os.sep, "/"))
+    return files
+
+
+def _built_name(path: str, data: bytes) -> str:
+    stem, extension = posixpath.splitext(path)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return f"{DIST_DIRECTORY}/{stem}.{digest}{extension}"
+
+
+def _rewrite_references(path: str, data: bytes, files: dict) -> bytes:
+    """Point the relative references of a CSS or JS file at the built files they refer to."""
+    text = data.decode("utf-8")
+    directory = posixpath.dirname(path)
+
+    def _replace(match, group):
+        reference = match.group(group)
+        if reference.startswith(("data:", "http:", "https:", "//", "/", "#")):
+            return match.group(0)
+        target, suffix = re.match(r"([^?#]*)(.*)", reference).groups()
+        built = files.get(posixpath.normpath(posixpath.join(directory, target)))
+        if built is None:
+            return match.group(0)
+        # both files move under dist, so the reference stays relative
+        new_reference = posixpath.relpath(built, posixpath.dirname(f"{DIST_DIRECTORY}/{path}")) + suffix
+        return match.group(0).replace(reference, new_reference)
+
+    if path.endswith(".css"):
+        text = CSS_URL.sub(lambda m: _replace(m, 2), text)
+    text = SOURCE_MAP_URL.sub(lambda m: _replace(m, 2), text)
+    return text.encode("utf-8")
+
+
+def _write(static_directory: str, path: str, data: bytes) -> None:
+    full_path = os.path.join(static_directory, path)
+    if os.path.exists(full_path):
+        return
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(f"{full_path}.part", "wb") as built_file:
+        built_file.write(data)
+    os.replace(f"{full_path}.part", full_path)
+
+
+def _compress(static_directory: str, path: str, data: bytes) -> list:
+    """Write the compressed copies of a built file that are smaller than it, returning their encodings."""
+    if posixpath.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return []
+
+    encodings = []
+    compressed = {"gz": ("gzip", gzip.compress(data, compresslevel=9, mtime=0))}
+    if brotli is not None:
+        compressed["br"] = ("br", brotli.compress(data, quality=11))
+    for extension, (encoding, compressed_data) in sorted(compressed.items()):
+        if len(compressed_data) < len(data):
+            _write(static_directory, f"{path}.{extension}", compressed_data)
+            encodings.append(encoding)
+    return encodings
+
+
+def build(static_directory: str) -> dict:
+    """
+    Build the fingerprinted and compressed assets and write the manifest.
+
+    :param static_directory: The static folder.
+    :return: The manifest.
+    """
+    files = {}
+    encodings = {}
+    sources = _source_files(static_directory)
+
+    # files referring to others are built last, once the names of what they refer to are known
+    def _refers(path_):
+        return path_.endswith((".css", ".js"))
+
+    for path in sorted(sources, key=lambda x: (_refers(x), x)):
+        with open(os.path.join(static_directory, path), "rb") as source_file:
+            data = source_file.read()
+        if _refers(path):
+            try:
+                data = _rewrite_references(path, data, files)
+            except UnicodeDecodeError:
+                pass
+
+        built = _built_name(path, data)
+        _write(static_directory, built, data)
+        files[path] = built
+        compressed = _compress(static_directory, built, data)
+        if len(compressed) > 0:
+            encodings[built] = compressed
+
+    manifest = {"files": files, "encodings": encodings}
+    manifest_path = os.path.join(static_directory, DIST_DIRECTORY, MANIFEST_NAME)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(f"{manifest_path}.part", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(f"{manifest_path}.part", manifest_path)
+    return manifest
+
+
+def clean(static_directory: str, manifest: dict) -> int:
+    """Delete the built files the manifest does not refer to. Returns the number of files deleted."""
+    keep = set()
+    for built in manifest["files"].values():
+        keep.add(built)
+        keep.update(f"{built}.{x}" for x in ("gz", "br"))
+
+    number_deleted = 0
+    dist_directory = os.path.join(static_directory, DIST_DIRECTORY)
+    for root, dirs, filenames in os.walk(dist_directory, topdown=False):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), static_directory).replace(os.sep, "/")
+            if path not in keep and filename != MANIFEST_NAME:
+                os.remove(os.path.join(root, filename))
+                number_deleted += 1
+        if root != dist_directory and not os.listdir(root):
+            os.rmdir(root)
+    return number_deleted
+
+
+if __name__ == '__main__':
+    if brotli is None:
+        print("brotli is not installed, only writing gzip copies")
+    manifest_ = build(app.static_folder)
+    print(f"built {len(manifest_['files'])} assets, {len(manifest_['encodings'])} compressed")
+    if "--clean" in sys.argv[1:]:
+        print(f"deleted {clean(app.static_folder, manifest_)} old files")
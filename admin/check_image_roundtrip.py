@@ -0,0 +1,77 @@
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+from sqlalchemy import select
+
+from app import app, db
+from export_archive import ArchiveWriter, extract_image
+from image_store import is_content_filename, user_images_directory
+from models import Image
+
+# Checks that the images stored by content come back under their own names when exported and
+# imported again, so a re-import reuses the user's images instead of storing them a second time.
+# Each image file is written into an export archive and extracted from it into a scratch directory,
+# the same way items_export and items_load do; nothing in the user's directory or the database is
+# changed. Exits with status 1 if any image comes back under another name.
+#
+# usage: python admin/check_image_roundtrip.py [user id]
+
+
+def _round_trip(image_filename: str, image_path: str, scratch_directory: str) -> str:
+    archive_path = os.path.join(scratch_directory, "export.zip")
+    writer = ArchiveWriter()
+    with open(archive_path, "wb") as archive_file:
+        for chunk in writer.add_image(item_id=1, image_filename=image_filename, image_path=image_path):
+            archive_file.write(chunk)
+        entry = writer.last_entry
+        for chunk in writer.finish():
+            archive_file.write(chunk)
+
+    with zipfile.ZipFile(archive_path) as archive:
+        return extract_image(archive, entry, os.path.join(scratch_directory, "images"))
+
+
+def check_round_trip(user_id: int = None) -> list:
+    """
+    Export and import every image stored by content.
+
+    :param user_id: Only check this user's images.
+    :return: (user id, image filename, filename after the import) of the images not coming back
+             under their own name.
+    """
+    stmt = select(Image.user_id, Image.image_filename).order_by(Image.user_id, Image.id)
+    if user_id is not None:
+        stmt = stmt.where(Image.user_id == user_id)
+
+    mismatches = []
+    number_checked = 0
+    for owner_id, image_filename in db.session.execute(stmt):
+        if image_filename is None or not is_content_filename(image_filename):
+            continue
+        image_path = os.path.join(user_images_directory(owner_id), image_filename)
+        if not os.path.exists(image_path):
+            continue
+
+        scratch_directory = tempfile.mkdtemp(prefix="roundtrip-")
+        try:
+            imported_filename = _round_trip(image_filename, image_path, scratch_directory)
+        finally:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+        number_checked += 1
+        if imported_filename != image_filename:
+            mismatches.append((owner_id, image_filename, imported_filename))
+
+    print(f"{number_checked - len(mismatches)} of {number_checked} images come back under their own name")
+    return mismatches
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        results = check_round_trip(user_id=int(sys.argv[1]) if len(sys.argv) > 1 else None)
+
+    for owner_id, image_filename, imported_filename in results:
+        print(f"MISMATCH  {owner_id}/{image_filename} -> {imported_filename}")
+    sys.exit(1 if len(results) > 0 else 0)
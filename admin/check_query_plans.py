@@ -0,0 +1,26 @@
+import sys
+
+from app import app
+from query_plans import check_plans
+
+# EXPLAINs the hot queries and exits with status 1 if any reads a whole table, see query_plans.py.
+#
+# usage: python admin/check_query_plans.py
+# Run it against a database with realistic numbers of rows, and after admin/migrate.py.
+
+if __name__ == '__main__':
+    with app.app_context():
+        results = check_plans()
+
+    number_failed = 0
+    for name, scans in results.items():
+        if len(scans) == 0:
+            print(f"ok    {name}")
+        else:
+            number_failed += 1
+            print(f"SCAN  {name}")
+            for scan in scans:
+                print(f"        {scan}")
+
+    print(f"{len(results) - number_failed} of {len(results)} hot queries use indexes")
+    sys.exit(1 if number_failed > 0 else 0)
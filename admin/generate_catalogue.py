@@ -0,0 +1,368 @@
+import argparse
+import csv
+import io
+import os
+import random
+import string
+import uuid
+from typing import Dict, List
+
+from PIL import Image as PILImage
+from slugify import slugify
+from sqlalchemy import select, insert, func
+
+from app import app, db, flask_bcrypt
+from image_store import store_bytes, user_images_directory
+from models import User, Preferences, Inventory, UserInventory, Location, ItemType, Tag, Field, FieldTemplate, \
+    TemplateField, Item, InventoryItem, ItemTag, ItemField, Relateditems, Image, ItemImage
+
+# Generates a synthetic catalogue: users with inventories, locations, item types, field templates
+# and items with tags, custom field values, related items and placeholder images, for load tests
+# and for reproducing performance problems at production scale on a local database.
+#
+# usage: python admin/generate_catalogue.py [--users N] [--items N] [--skew S] [--seed N] ...
+#   see --help for all options
+#
+# The same seed and options give the same catalogue on an empty database. Items are shared out
+# between inventories with Zipf weights: with --skew 0 every inventory gets about as many, the
+# higher the skew the more a few inventories get most of them.
+#
+# Rows are written with multi-row INSERTs that bypass the ORM, with ids allocated here (SQLite does
+# not generate ids for the tables with composite keys). Afterwards run admin/reindex_search.py to
+# index the items for search and admin/generate_image_derivatives.py for the image sizes.
+#
+# The users are called <prefix>00001 and up, with the password given by --password.
+
+LOCATION_NAMES = ["Kitchen", "Garage", "Attic", "Basement", "Office", "Bedroom", "Living room", "Shed",
+                  "Workshop", "Hallway", "Storage unit", "Bathroom", "Loft", "Pantry", "Closet"]
+TYPE_NAMES = ["book", "tool", "record", "game", "cable", "camera", "lens", "toy", "kitchenware", "clothing",
+              "board", "component", "instrument", "print", "plant", "document", "furniture", "lamp"]
+INVENTORY_NAMES = ["Books", "Tools", "Electronics", "Records", "Games", "Camera gear", "Kitchen", "Wardrobe",
+                   "Spares", "Collection", "Projects", "Archive", "Lending", "For sale", "Workshop"]
+ADJECTIVES = ["old", "blue", "small", "large", "spare", "broken", "vintage", "red", "green", "wooden", "metal",
+              "heavy", "folding", "portable", "signed", "rare", "cheap", "shiny", "tiny", "digital"]
+NOUNS = ["chair", "hammer", "camera", "cable", "lamp", "record", "book", "drill", "lens", "kettle", "clock",
+         "radio", "box", "jacket", "guitar", "board", "printer", "mug", "charger", "map", "saw", "tripod"]
+TAG_WORDS = ["fragile", "borrowed", "gift", "to-fix", "favourite", "duplicate", "insured", "loaned", "new",
+             "used", "boxed", "sold", "wishlist", "signed", "battery", "outdoor", "winter", "summer"]
+
+NONE_NAME = "None"
+PUBLIC_ACCESS_LEVEL = 3
+PUBLIC_INVENTORY_FRACTION = 0.2
+SHORT_CODE_LENGTH = 8
+PLACEHOLDER_SIZE = 64
+
+
+class CatalogueGenerator:
+    """
+    Generate and insert the synthetic catalogue.
+
+    :param options: The parsed command line options.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self._next_ids = {}
+        self._pending = {}
+
+    # --- writing ---
+
+    def _allocate_ids(self, model, number: int) -> range:
+        """Take number ids after the highest in the table."""
+        table_ = model.__table__
+        if table_.name not in self._next_ids:
+            highest = db.session.execute(select(func.max(table_.c.id))).scalar()
+            self._next_ids[table_.name] = (highest or 0) + 1
+        first = self._next_ids[table_.name]
+        self._next_ids[table_.name] += number
+        return range(first, first + number)
+
+    def _add(self, model, row: dict) -> None:
+        rows = self._pending.setdefault(model, [])
+        rows.append(row)
+        if len(rows) >= self.options.batch_size:
+            self._flush(model)
+
+    def _flush(self, model=None) -> None:
+        for model_ in ([model] if model is not None else list(self._pending.keys())):
+            rows = self._pending.pop(model_, [])
+            if len(rows) > 0:
+                db.session.execute(insert(model_.__table__), rows)
+
+    def _commit(self) -> None:
+        # parents before the rows referring to them
+        for model in [User, Preferences, Location, ItemType, Tag, Field, FieldTemplate, TemplateField, Inventory,
+                      UserInventory, Image, Item, InventoryItem, ItemTag, ItemField, ItemImage, Relateditems]:
+            self._flush(model)
+        db.session.commit()
+
+    # --- random values ---
+
+    def _code(self, length: int) -> str:
+        return "".join(self.rng.choice(string.ascii_letters + string.digits) for _ in range(length))
+
+    def _names(self, vocabulary: List[str], number: int) -> List[str]:
+        """number distinct names from vocabulary, numbered once it runs out."""
+        names = []
+        for i in range(number):
+            name = vocabulary[i % len(vocabulary)]
+            names.append(name if i < len(vocabulary) else f"{name} {i // len(vocabulary) + 1}")
+        return names
+
+    def _zipf_cum_weights(self, number: int) -> List[float]:
+        cum_weights = []
+        total = 0.0
+        for rank in range(1, number + 1):
+            total += 1.0 / rank ** self.options.skew
+            cum_weights.append(total)
+        return cum_weights
+
+    def _field_value(self, field_type: str) -> str:
+        if field_type == "textarea":
+            return " ".join(self.rng.choice(ADJECTIVES + NOUNS) for _ in range(self.rng.randint(5, 20)))
+        choice = self.rng.random()
+        if choice < 0.4:
+            return str(self.rng.randint(1, 10000))
+        if choice < 0.6:
+            return f"{self.rng.randint(1990, 2025)}-{self.rng.randint(1, 12):02d}-{self.rng.randint(1, 28):02d}"
+        return f"{self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)}"
+
+    def _placeholder_image(self) -> bytes:
+        colour = tuple(self.rng.randint(0, 255) for _ in range(3))
+        image_data = io.BytesIO()
+        PILImage.new("RGB", (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), colour).save(image_data, format="JPEG")
+        return image_data.getvalue()
+
+    # --- shared rows ---
+
+    def _tags(self, owner_id: int) -> List[int]:
+        """The ids of the tags items are tagged with, created if missing; tags are shared by all users."""
+        names = [x.replace(" ", "-") for x in self._names(TAG_WORDS, self.options.tags)]
+        existing = dict(db.session.execute(select(Tag.tag, Tag.id).where(Tag.tag.in_(names))).all())
+        missing = [x for x in names if x not in existing]
+        for name, id_ in zip(missing, self._allocate_ids(Tag, len(missing))):
+            self._add(Tag, {"id": id_, "tag": name, "user_id": owner_id})
+            existing[name] = id_
+        return [existing[x] for x in names]
+
+    def _fields(self) -> List[tuple]:
+        """(id, type) of the custom fields to fill in, loading data/fields.csv if there are none."""
+        rows = db.session.execute(select(Field.id, Field.type).order_by(Field.id)).all()
+        if len(rows) == 0:
+            with open(os.path.join(app.root_path, "data", "fields.csv"), newline='') as csv_file:
+                reader = csv.reader(csv_file, delimiter=',', quotechar='"')
+                next(reader)
+                definitions = {slugify(row[1]): (row[0], row[2]) for row in reader}
+            for (slug, (name, type_)), id_ in zip(sorted(definitions.items()),
+                                                 self._allocate_ids(Field, len(definitions))):
+                self._add(Field, {"id": id_, "field": name, "slug": slug, "type": type_})
+                rows.append((id_, type_))
+        rows = [tuple(x) for x in rows]
+        return self.rng.sample(rows, min(self.options.fields, len(rows)))
+
+    # --- users ---
+
+    def _check_usernames(self, usernames: List[str]) -> None:
+        taken = db.session.execute(select(User.username).where(User.username.in_(usernames)).limit(1)).scalar()
+        if taken is not None:
+            raise SystemExit(f"user {taken} exists already, choose another --prefix")
+
+    def _add_user(self, user_id: int, username: str, password_hash: str) -> None:
+        self._add(User, {"id": user_id, "username": username, "email": f"{username}@example.invalid",
+                         "password": password_hash, "is_active": True, "activated": True})
+        self._add(Preferences, {"user_id": user_id, "default_public": False})
+
+    def _add_named_rows(self, model, user_id: int, names: List[str], **values) -> List[int]:
+        ids = list(self._allocate_ids(model, len(names)))
+        for id_, name in zip(ids, names):
+            self._add(model, {"id": id_, "name": name, "user_id": user_id, **values})
+        return ids
+
+    def _add_templates(self, user_id: int, fields: List[tuple]) -> Dict[int, List[tuple]]:
+        templates = {}
+        for template_id in self._allocate_ids(FieldTemplate, self.options.templates):
+            template_fields = self.rng.sample(fields, min(len(fields), self.rng.randint(2, 6)))
+            self._add(FieldTemplate, {"id": template_id, "name": f"Template {template_id}", "user_id": user_id})
+            for order, (field_id, field_type) in enumerate(template_fields):
+                self._add(TemplateField, {"field_id": field_id, "template_id": template_id, "order": order})
+            templates[template_id] = template_fields
+        return templates
+
+    def _add_inventories(self, user_id: int, username: str, templates: Dict[int, List[tuple]]) -> List[dict]:
+        names = self._names(INVENTORY_NAMES, self.options.inventories)
+        inventories = [{"name": f"__default__{username}", "slug": f"default-{username}", "access_level": 0,
+                        "field_template": None}]
+        for name in names:
+            template_id = self.rng.choice(list(templates.keys())) if len(templates) > 0 else None
+            public = self.rng.random() < PUBLIC_INVENTORY_FRACTION
+            inventories.append({"name": name, "slug": slugify(name), "field_template": template_id,
+                                "access_level": PUBLIC_ACCESS_LEVEL if public else 0})
+
+        for inventory, id_ in zip(inventories, self._allocate_ids(Inventory, len(inventories))):
+            inventory.update({"id": id_, "owner_id": user_id})
+            self._add(Inventory, {**inventory, "description": f"{inventory['name']} of {username}", "type": 1,
+                                  "token": uuid.UUID(int=self.rng.getrandbits(128)).hex,
+                                  "short_code": self._code(SHORT_CODE_LENGTH), "default_fields": "-1"})
+            self._add(UserInventory, {"user_id": user_id, "inventory_id": id_, "access_level": 0})
+        return inventories
+
+    def _add_images(self, user_id: int) -> List[tuple]:
+        """(id, filename) of the user's placeholder images, written to the user's image directory."""
+        directory = user_images_directory(user_id)
+        filenames = sorted({store_bytes(self._placeholder_image(), directory) for _ in range(self.options.images)})
+        ids = list(self._allocate_ids(Image, len(filenames)))
+        for id_, filename in zip(ids, filenames):
+            self._add(Image, {"id": id_, "image_filename": filename, "user_id": user_id})
+        return list(zip(ids, filenames))
+
+    # --- items ---
+
+    def _add_items(self, user: dict, inventory: dict, number: int, templates: Dict[int, List[tuple]],
+                   fields: List[tuple], tag_ids: List[int], tag_weights: List[float]) -> List[int]:
+        item_fields = templates.get(inventory["field_template"]) or fields
+        item_ids = list(self._allocate_ids(Item, number))
+        for item_id in item_ids:
+            name = f"{self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)}"
+            images = []
+            if len(user["images"]) > 0 and self.rng.random() < self.options.image_fraction:
+                images = self.rng.sample(user["images"], min(len(user["images"]), self.rng.randint(1, 3)))
+
+            self._add(Item, {
+                "id": item_id, "name": name, "slug": f"{item_id}-{slugify(name)}", "user_id": user["id"],
+                "description": " ".join(self.rng.choice(ADJECTIVES + NOUNS) for _ in range(self.rng.randint(3, 30))),
+                "quantity": max(1, int(self.rng.paretovariate(2.0))),
+                "item_type": self.rng.choice(user["types"]), "location_id": self.rng.choice(user["locations"]),
+                "specific_location": f"shelf {self.rng.randint(1, 20)}" if self.rng.random() < 0.3 else None,
+                "short_code": self._code(SHORT_CODE_LENGTH),
+                "main_image": images[0][1] if len(images) > 0 else None,
+            })
+            self._add(InventoryItem, {"inventory_id": inventory["id"], "item_id": item_id, "access_level": 0,
+                                      "is_link": False})
+
+            number_of_tags = self.rng.randint(0, self.options.tags_per_item)
+            for tag_id in set(self.rng.choices(tag_ids, cum_weights=tag_weights, k=number_of_tags)):
+                self._add(ItemTag, {"item_id": item_id, "tag_id": tag_id})
+
+            number_of_fields = min(len(item_fields), self.rng.randint(0, self.options.fields_per_item))
+            for field_id, field_type in self.rng.sample(item_fields, number_of_fields):
+                self._add(ItemField, {"field_id": field_id, "item_id": item_id, "show": True, "user_id": user["id"],
+                                      "value": self._field_value(field_type)[:255]})
+
+            for image_id, filename in images:
+                self._add(ItemImage, {"image_id": image_id, "item_id": item_id})
+        return item_ids
+
+    def _add_related(self, item_ids: List[int]) -> None:
+        """Relate some of a user's items to others of theirs."""
+        if len(item_ids) < 2:
+            return
+        pairs = set()
+        for item_id in item_ids:
+            if self.rng.random() < self.options.related:
+                for related_id in self.rng.sample(item_ids, min(len(item_ids), self.rng.randint(1, 3))):
+                    if related_id != item_id:
+                        pairs.add((item_id, related_id))
+        for item_id, related_id in sorted(pairs):
+            self._add(Relateditems, {"item_id": item_id, "related_item_id": related_id})
+
+    # --- all of it ---
+
+    def generate(self) -> Dict[str, int]:
+        """
+        Generate the catalogue.
+
+        :return: The number of users, inventories and items added.
+        """
+        options = self.options
+        usernames = [f"{options.prefix}{n:05d}" for n in range(1, options.users + 1)]
+        self._check_usernames(usernames)
+        password_hash = flask_bcrypt.generate_password_hash(options.password).decode("utf-8")
+
+        user_ids = list(self._allocate_ids(User, len(usernames)))
+        for user_id, username in zip(user_ids, usernames):
+            self._add_user(user_id, username, password_hash)
+        tag_ids = self._tags(owner_id=user_ids[0])
+        tag_weights = self._zipf_cum_weights(len(tag_ids))
+        fields = self._fields()
+        self._commit()
+
+        users = []
+        for user_id, username in zip(user_ids, usernames):
+            templates = self._add_templates(user_id, fields)
+            users.append({
+                "id": user_id,
+                "locations": self._add_named_rows(Location, user_id, [NONE_NAME] + self._names(
+                    LOCATION_NAMES, options.locations), description=""),
+                "types": self._add_named_rows(ItemType, user_id, [NONE_NAME.lower()] + self._names(
+                    TYPE_NAMES, options.types)),
+                "templates": templates,
+                "inventories": self._add_inventories(user_id, username, templates),
+                "images": self._add_images(user_id),
+            })
+        self._commit()
+        print(f"added {len(users)} users")
+
+        # a few huge inventories and many small ones: share the items out by Zipf weights over the
+        # inventories in a random order
+        inventories = [(user, inventory) for user in users for inventory in user["inventories"]]
+        ranks = list(range(len(inventories)))
+        self.rng.shuffle(ranks)
+        cum_weights = self._zipf_cum_weights(len(inventories))
+        counts = [0] * len(inventories)
+        for rank in self.rng.choices(range(len(inventories)), cum_weights=cum_weights, k=options.items):
+            counts[ranks[rank]] += 1
+
+        number_done = 0
+        position = 0
+        for user in users:
+            user_item_ids = []
+            for inventory in user["inventories"]:
+                number = counts[position]
+                position += 1
+                if number > 0:
+                    user_item_ids.extend(self._add_items(user, inventory, number, user["templates"], fields,
+                                                         tag_ids, tag_weights))
+            self._add_related(user_item_ids)
+            self._commit()
+            number_done += len(user_item_ids)
+            print(f"added {number_done} of {options.items} items")
+
+        return {"users": len(users), "inventories": len(inventories), "items": number_done,
+                "largest inventory": max(counts) if len(counts) > 0 else 0}
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Generate a synthetic catalogue for load and benchmark tests.")
+    parser.add_argument("--seed", type=int, default=1, help="the random seed (default 1)")
+    parser.add_argument("--prefix", default="load", help="the start of the usernames (default load)")
+    parser.add_argument("--password", default="password", help="the password of every user (default password)")
+    parser.add_argument("--users", type=int, default=10, help="users to add (default 10)")
+    parser.add_argument("--inventories", type=int, default=5,
+                        help="inventories per user, besides the default one (default 5)")
+    parser.add_argument("--items", type=int, default=10000, help="items to add, over all users (default 10000)")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="the Zipf exponent sharing items out between inventories, 0 for even (default 1.1)")
+    parser.add_argument("--locations", type=int, default=10, help="locations per user (default 10)")
+    parser.add_argument("--types", type=int, default=10, help="item types per user (default 10)")
+    parser.add_argument("--templates", type=int, default=2, help="field templates per user (default 2)")
+    parser.add_argument("--tags", type=int, default=200, help="tags shared by the items (default 200)")
+    parser.add_argument("--tags-per-item", type=int, default=4, help="the most tags of an item (default 4)")
+    parser.add_argument("--fields", type=int, default=30, help="custom fields in use (default 30)")
+    parser.add_argument("--fields-per-item", type=int, default=3,
+                        help="the most custom field values of an item (default 3)")
+    parser.add_argument("--related", type=float, default=0.1,
+                        help="the fraction of items related to others (default 0.1)")
+    parser.add_argument("--images", type=int, default=8, help="placeholder images per user (default 8)")
+    parser.add_argument("--image-fraction", type=float, default=0.3,
+                        help="the fraction of items with images (default 0.3)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per INSERT (default 1000)")
+    return parser
+
+
+if __name__ == '__main__':
+    options_ = _parser().parse_args()
+    with app.app_context():
+        result = CatalogueGenerator(options_).generate()
+    print(", ".join(f"{key}: {value}" for key, value in result.items()))
+    print("now run admin/reindex_search.py and admin/generate_image_derivatives.py")
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+
+from sqlalchemy import select, update, bindparam
+
+import migrations
+from app import app, db
+from image_derivatives import generate_derivatives
+from image_store import is_content_filename, user_images_directory
+from models import Image
+
+BATCH_SIZE = 200
+
+
+def generate_missing(regenerate: bool = False) -> int:
+    """
+    Generate the derivatives of every image that has none yet, leaving the image file alone.
+
+    Files stored by content are the images as uploaded and get a "full" derivative; older files are
+    the full size JPEG themselves.
+
+    :param regenerate: Regenerate the derivatives of all images, e.g. after changing IMAGE_DERIVATIVES.
+    :return: The number of images processed.
+    """
+    number_done = 0
+    last_id = 0
+    while True:
+        stmt = select(Image.id, Image.user_id, Image.image_filename) \
+            .where(Image.id > last_id).order_by(Image.id).limit(BATCH_SIZE)
+        if not regenerate:
+            stmt = stmt.where(Image.variants == None)
+        rows = db.session.execute(stmt).all()
+        if len(rows) == 0:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for image_id, user_id, image_filename in rows:
+            directory = user_images_directory(user_id)
+            try:
+                with open(os.path.join(directory, image_filename), "rb") as image_file:
+                    variants = generate_derivatives(image_data=image_file.read(), image_filename=image_filename,
+                                                    directory=directory,
+                                                    keep_full=not is_content_filename(image_filename))
+            except (OSError, ValueError) as e:
+                print(f"skipped {user_id}/{image_filename}: {str(e)}")
+                continue
+            updates.append({"b_id": image_id, "b_variants": json.dumps(variants)})
+
+        if len(updates) > 0:
+            db.session.execute(update(Image.__table__).where(Image.__table__.c.id == bindparam("b_id"))
+                               .values(variants=bindparam("b_variants")), updates)
+            db.session.commit()
+        number_done += len(updates)
+        print(f"processed {number_done} images")
+
+    return number_done
+
+
+if __name__ == '__main__':
+    # usage: python admin/generate_image_derivatives.py [--all]
+    with app.app_context():
+        # images.variants comes with the baseline revision
+        migrations.upgrade()
+        generate_missing(regenerate="--all" in sys.argv[1:])
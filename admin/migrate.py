@@ -0,0 +1,27 @@
+import sys
+
+import migrations
+from app import app
+
+# Brings the database schema up to date, see migrations.py.
+#
+# usage: python admin/migrate.py [--status | --stamp]
+#   --status  list the revisions and whether each is applied, changing nothing
+#   --stamp   record every revision as applied without running them, for a database whose schema
+#             was created from the current models
+
+if __name__ == '__main__':
+    with app.app_context():
+        if "--status" in sys.argv[1:]:
+            applied = set(migrations.applied_revisions())
+            for revision, description, upgrade_function in migrations.REVISIONS:
+                print(f"{revision} {'applied' if revision in applied else 'pending'}  {description}")
+        elif "--stamp" in sys.argv[1:]:
+            migrations.stamp_head()
+            print("recorded every revision as applied")
+        else:
+            done = migrations.upgrade()
+            if len(done) == 0:
+                print("the schema is up to date")
+            for revision in done:
+                print(f"applied {revision}")
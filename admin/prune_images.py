@@ -1,20 +1,345 @@
+import argparse
+import heapq
+import os
+import time
+from typing import Iterator, Optional, Tuple
 
+from sqlalchemy import select, cast, or_, LargeBinary
 
-from database_functions import get_all_images
+from app import app, db
+from database_functions import set_image_variants
+from image_derivatives import derivative_sizes, parse_variants
+from image_store import is_content_filename, user_images_base_directory
+from models import Image
+from utils import derivative_filename
 
+# Orphan image garbage collector
+#
+# Compares the files under USER_IMAGES_BASE_PATH/<user id>/ with the images table and reports
+#   orphans:  files no image row refers to, as the image itself or one of its derivatives
+#   dangling: image rows whose image file is missing
+# then deletes the orphan files (and, with --delete-rows, the dangling rows) in rate-limited batches.
+#
+# Both sides are streamed in the same order, (user id, file path) with paths compared bytewise, and
+# merged like two sorted lists, so memory does not grow with the number of images. The files of a
+# directory are sorted in memory, one directory at a time; content-addressed images (see
+# image_store.py) are sharded so their directories stay small.
+#
+# Staging files (dotfiles and *.part) belong to uploads and imports in progress and are never
+# touched, nor are files modified in the last --min-age seconds.
 
-def prune():
+BATCH_SIZE = 500
+STREAM_BATCH_SIZE = 1000
 
-    d = get_all_images(user_id=None)
+IMAGE = "image"
+DERIVATIVE = "derivative"
 
-    import os
-    for root, dirs, files in os.walk("/mydir"):
-        for file in files:
-            if file.endswith(".txt"):
-                print(os.path.join(root, file))
 
-    f = 6
+def _is_staging_file(name: str) -> bool:
+    return name.startswith(".") or name.endswith(".part")
+
+
+def _walk_sorted(directory: str, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    """
+    Yield (path relative to directory, mtime) of every file below directory, in bytewise path order.
+
+    Directories sort as "<name>/", so their files come out where their full paths belong.
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = [(x.name + "/" if x.is_dir(follow_symlinks=False) else x.name, x) for x in it]
+    except OSError as e:
+        app.logger.error(f"Prune: could not read {directory}: {str(e)}")
+        return
+    entries.sort(key=lambda x: x[0].encode("utf-8"))
+
+    for key, entry in entries:
+        if key.endswith("/"):
+            yield from _walk_sorted(entry.path, prefix=prefix + key)
+        elif entry.is_file(follow_symlinks=False) and not _is_staging_file(entry.name):
+            try:
+                yield prefix + entry.name, entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+
+
+def _user_directories(base_directory: str) -> Iterator[Tuple[int, str]]:
+    """(user id, directory) of every user image directory, by user id."""
+    users = []
+    with os.scandir(base_directory) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False) and entry.name.isdigit():
+                users.append((int(entry.name), entry.path))
+    return iter(sorted(users))
+
+
+def disk_files(base_directory: str) -> Iterator[Tuple[Tuple[int, bytes], str, float]]:
+    """Yield ((user id, path bytes), path, mtime) of every image file on disk, in merge order."""
+    for user_id, directory in _user_directories(base_directory):
+        for path, mtime in _walk_sorted(directory):
+            yield (user_id, path.encode("utf-8")), path, mtime
+
+
+def _stem(image_filename: str) -> str:
+    return os.path.splitext(image_filename)[0]
+
+
+def _stem_bound(image_filename: str) -> str:
+    """
+    A lower bound for the stems of all filenames sorting after this one: its prefix up to the first
+    character that sorts at or before ".". Every file expected for a later row is at least this.
+    """
+    for i, c in enumerate(image_filename):
+        if c <= ".":
+            return image_filename[:i]
+    return image_filename
+
+
+def _expected_files(image_filename: str, variants_json: Optional[str], sizes: list) -> set:
+    """The derivative files an image may have: those recorded in variants and the configured names."""
+    files = set()
+    for variant in parse_variants(variants_json).values():
+        files.add(variant.get("file"))
+        files.add(variant.get("webp"))
+    for name, _ in sizes:
+        files.add(derivative_filename(image_filename, name))
+        files.add(derivative_filename(image_filename, name, extension="webp"))
+    files.discard(None)
+    files.discard(image_filename)
+    # only files sharing the image's stem keep the stream in order
+    stem = _stem(image_filename)
+    return {x for x in files if x.startswith(stem)}
+
+
+def database_files(connection) -> Iterator[Tuple[Tuple[int, bytes], str, str, Optional[int]]]:
+    """
+    Yield ((user id, path bytes), path, kind, image id) of every file the images table refers to, in
+    merge order. kind is IMAGE for the image file itself, DERIVATIVE for its derivatives.
+
+    Rows come ordered by filename; an image's derivatives are named after its stem and so sort after
+    it, possibly after later rows. They wait in a heap until no later row can sort before them.
+    """
+    sizes = derivative_sizes()
+    stmt = select(Image.id, Image.user_id, Image.image_filename, Image.variants) \
+        .where(Image.image_filename != None) \
+        .order_by(Image.user_id, cast(Image.image_filename, LargeBinary))
+    result = connection.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE).execute(stmt)
+
+    pending = []
+    current_user_id = None
+    for image_id, user_id, image_filename, variants_json in result:
+        if ".." in image_filename.split("/"):
+            continue
+
+        if user_id != current_user_id:
+            while pending:
+                yield heapq.heappop(pending)
+            current_user_id = user_id
+
+        bound = (user_id, _stem_bound(image_filename).encode("utf-8"))
+        while pending and pending[0][0] < bound:
+            yield heapq.heappop(pending)
+
+        heapq.heappush(pending, ((user_id, image_filename.encode("utf-8")), image_filename, IMAGE, image_id))
+        for path in _expected_files(image_filename, variants_json, sizes):
+            heapq.heappush(pending, ((user_id, path.encode("utf-8")), path, DERIVATIVE, None))
+
+    while pending:
+        yield heapq.heappop(pending)
+
+
+def diff(disk: Iterator, database: Iterator) -> Iterator[Tuple[str, tuple]]:
+    """
+    Merge the two sorted streams, yielding ("orphan", disk entry) and ("dangling", database entry).
+    """
+    disk_entry = next(disk, None)
+    database_entry = next(database, None)
+    while disk_entry is not None or database_entry is not None:
+        if database_entry is None or (disk_entry is not None and disk_entry[0] < database_entry[0]):
+            yield "orphan", disk_entry
+            disk_entry = next(disk, None)
+        elif disk_entry is None or disk_entry[0] > database_entry[0]:
+            if database_entry[2] == IMAGE:
+                yield "dangling", database_entry
+            database_entry = next(database, None)
+        else:
+            # the same file may be expected more than once, e.g. by duplicate rows
+            key = disk_entry[0]
+            while database_entry is not None and database_entry[0] == key:
+                database_entry = next(database, None)
+            disk_entry = next(disk, None)
+
+
+class Pruner:
+    """Deletes what the diff finds, in batches of batch_size and at most rate deletions a second."""
+
+    def __init__(self, base_directory: str, dry_run: bool = True, delete_rows: bool = False,
+                 min_age: float = 3600, batch_size: int = BATCH_SIZE, rate: float = 200):
+        self.base_directory = base_directory
+        self.dry_run = dry_run
+        self.delete_rows = delete_rows
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.rate = rate
+        self.started = time.time()
+        self.counts = {"orphan": 0, "orphan_bytes": 0, "dangling": 0, "young": 0,
+                       "deleted_files": 0, "deleted_rows": 0, "kept": 0}
+        self._orphans = []
+        self._dangling = []
+
+    def _directory(self, user_id: int) -> str:
+        return os.path.join(self.base_directory, str(user_id))
+
+    def run(self) -> dict:
+        with db.engine.connect() as connection:
+            database = database_files(connection)
+            for kind, entry in diff(disk_files(self.base_directory), database):
+                if kind == "orphan":
+                    self._orphan(entry)
+                else:
+                    self._dangling_row(entry)
+        self._flush_orphans()
+        self._flush_dangling()
+        return self.counts
+
+    def _orphan(self, entry):
+        (user_id, _), path, mtime = entry
+        if mtime > self.started - self.min_age:
+            self.counts["young"] += 1
+            return
+        try:
+            size = os.path.getsize(os.path.join(self._directory(user_id), path))
+        except OSError:
+            return
+        self.counts["orphan"] += 1
+        self.counts["orphan_bytes"] += size
+        print(f"orphan {user_id}/{path} {size}")
+        if not self.dry_run:
+            self._orphans.append((user_id, path, mtime))
+            if len(self._orphans) >= self.batch_size:
+                self._flush_orphans()
+
+    def _dangling_row(self, entry):
+        (user_id, _), path, _, image_id = entry
+        self.counts["dangling"] += 1
+        print(f"dangling {user_id}/{path} image {image_id}")
+        if not self.dry_run and self.delete_rows:
+            self._dangling.append((user_id, path))
+            if len(self._dangling) >= self.batch_size:
+                self._flush_dangling()
+
+    def _throttle(self, batch_started: float, number_deleted: int):
+        if self.rate > 0:
+            remaining = number_deleted / self.rate - (time.time() - batch_started)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def _referenced_stems(self, orphans: list) -> set:
+        """
+        The stems, among those the orphans could belong to, that an image row refers to now. A file
+        scanned as an orphan may have been linked again since, e.g. by an upload of the same content.
+        """
+        derivative_names = [name for name, _ in derivative_sizes()]
+        candidates = {}
+        for user_id, path, _ in orphans:
+            stem = _stem(path)
+            stems = candidates.setdefault(user_id, set())
+            stems.add(stem)
+            for name in derivative_names:
+                if stem.endswith(f"_{name}"):
+                    stems.add(stem[:-len(name) - 1])
+
+        referenced = set()
+        for user_id, stems in candidates.items():
+            stmt = select(Image.image_filename).where(Image.user_id == user_id) \
+                .where(or_(*[Image.image_filename.like(f"{x}.%") for x in stems]))
+            for image_filename, in db.session.execute(stmt):
+                referenced.add((user_id, _stem(image_filename)))
+        return referenced
+
+    def _flush_orphans(self):
+        if len(self._orphans) == 0:
+            return
+        batch_started = time.time()
+        referenced = self._referenced_stems(self._orphans)
+        number_deleted = 0
+        for user_id, path, mtime in self._orphans:
+            stem = _stem(path)
+            if (user_id, stem) in referenced or \
+                    any((user_id, stem[:-len(name) - 1]) in referenced
+                        for name, _ in derivative_sizes() if stem.endswith(f"_{name}")):
+                self.counts["kept"] += 1
+                continue
+
+            full_path = os.path.join(self._directory(user_id), path)
+            try:
+                if os.stat(full_path).st_mtime != mtime:
+                    self.counts["kept"] += 1
+                    continue
+                os.remove(full_path)
+            except OSError as e:
+                app.logger.error(f"Prune: could not delete {full_path}: {str(e)}")
+                continue
+            number_deleted += 1
+
+            if is_content_filename(path):
+                # drop the shard directories once empty
+                shard_directory = os.path.dirname(full_path)
+                try:
+                    os.rmdir(shard_directory)
+                    os.rmdir(os.path.dirname(shard_directory))
+                except OSError:
+                    pass
+
+        self.counts["deleted_files"] += number_deleted
+        self._orphans = []
+        self._throttle(batch_started, number_deleted)
+
+    def _has_recent_staging_files(self, user_id: int) -> bool:
+        """Uploads in progress have rows without files yet, their staged files say so."""
+        try:
+            with os.scandir(self._directory(user_id)) as it:
+                for entry in it:
+                    if entry.name.startswith(".") and entry.stat().st_mtime > self.started - self.min_age:
+                        return True
+        except OSError:
+            return False
+        return False
+
+    def _flush_dangling(self):
+        if len(self._dangling) == 0:
+            return
+        batch_started = time.time()
+        number_deleted = 0
+        busy_users = {}
+        for user_id, path in self._dangling:
+            if user_id not in busy_users:
+                busy_users[user_id] = self._has_recent_staging_files(user_id)
+            if busy_users[user_id] or os.path.exists(os.path.join(self._directory(user_id), path)):
+                self.counts["kept"] += 1
+                continue
+            # unlinks the image from its items, fixing their main image, and deletes the row
+            set_image_variants(image_filename=path, user_id=user_id, variants=None)
+            number_deleted += 1
+
+        self.counts["deleted_rows"] += number_deleted
+        self._dangling = []
+        self._throttle(batch_started, number_deleted)
 
 
 if __name__ == '__main__':
-    prune()
+    parser = argparse.ArgumentParser(description="Find and delete image files no image refers to.")
+    parser.add_argument("--dry-run", action="store_true", help="only report, delete nothing")
+    parser.add_argument("--delete-rows", action="store_true", help="also delete image rows whose file is missing")
+    parser.add_argument("--min-age", type=float, default=3600,
+                        help="leave files modified in the last this many seconds (default 3600)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="deletions per batch")
+    parser.add_argument("--rate", type=float, default=200, help="maximum deletions per second, 0 for no limit")
+    args = parser.parse_args()
+
+    with app.app_context():
+        base_directory = user_images_base_directory()
+        pruner = Pruner(base_directory=base_directory, dry_run=args.dry_run, delete_rows=args.delete_rows,
+                        min_age=args.min_age, batch_size=args.batch_size, rate=args.rate)
+        counts = pruner.run()
+        print(", ".join(f"{k}: {v}" for k, v in counts.items()))
@@ -0,0 +1,58 @@
+import sys
+
+from sqlalchemy import select
+
+import search
+from app import app, db
+from models import Item, Inventory, Tag, Invtag
+
+SEARCHABLE_MODELS = [Item, Inventory, Tag, Invtag]
+BATCH_SIZE = 1000
+
+
+def reindex(model, backend) -> int:
+    """
+    Rebuild the search index of one model from the database, streaming rows in batches.
+
+    :param model: The searchable model class.
+    :param backend: The search backend to write to.
+    :return: The number of documents indexed.
+    """
+    owner_column = model.user_id if hasattr(model, 'user_id') else model.owner_id
+    fields = list(model.__searchable__)
+    stmt = select(model.id, owner_column, *[getattr(model, field) for field in fields]) \
+        .order_by(model.id).execution_options(yield_per=BATCH_SIZE)
+
+    backend.clear(model.__tablename__)
+
+    number_indexed = 0
+    for rows in db.session.execute(stmt).partitions():
+        documents = []
+        for row in rows:
+            document = {'id': row[0], 'user_id': row[1]}
+            for i, field in enumerate(fields):
+                document[field] = row[i + 2]
+            documents.append(document)
+        backend.add_many(model.__tablename__, documents)
+        number_indexed += len(documents)
+
+    return number_indexed
+
+
+def reindex_all(index_names: list = None):
+    backend = search.get_backend()
+    if backend is None:
+        print("Search is disabled (SEARCH_BACKEND), nothing to do")
+        return
+
+    for model in SEARCHABLE_MODELS:
+        if index_names and model.__tablename__ not in index_names:
+            continue
+        number_indexed = reindex(model, backend)
+        print(f"{model.__tablename__}: indexed {number_indexed}")
+
+
+if __name__ == '__main__':
+    # usage: python admin/reindex_search.py [index ...]   e.g. items inventories tags invtags
+    with app.app_context():
+        reindex_all(sys.argv[1:])
@@ -73,6 +73,24 @@ app.config['ITEM_DESCRIPTION_CHAR_LIMIT'] = os.environ.get('ITEM_DESCRIPTION_CHA
 app.config['USER_IMAGES_BASE_URL'] = os.environ.get('USER_IMAGES_BASE_URL', '')
 app.config['USER_IMAGES_BASE_PATH'] = os.environ.get('USER_IMAGES_BASE_PATH', '')
 app.config['ITEM_MASONARY_IMAGE_SIZE'] = os.environ.get('ITEM_MASONARY_IMAGE_SIZE', 200)
+# the sizes every upload is stored in, see image_derivatives.py
+app.config['IMAGE_DERIVATIVES'] = os.environ.get('IMAGE_DERIVATIVES') or 'thumb:150,grid:300,masonry:400,full:600'
+app.config['IMAGE_WEBP'] = bool(int(os.environ.get('IMAGE_WEBP') or 0))
+# uploads are resized by this many worker processes; at most IMAGE_QUEUE_LIMIT uploads wait for them and
+# an upload finding the queue full waits IMAGE_QUEUE_TIMEOUT seconds before it is turned away
+app.config['IMAGE_WORKERS'] = os.environ.get('IMAGE_WORKERS') or 2
+app.config['IMAGE_QUEUE_LIMIT'] = os.environ.get('IMAGE_QUEUE_LIMIT') or 16
+app.config['IMAGE_QUEUE_TIMEOUT'] = os.environ.get('IMAGE_QUEUE_TIMEOUT') or 5
+# browser cache lifetimes, in seconds, of static files and of user images, see http_caching.py
+app.config['STATIC_CACHE_MAX_AGE'] = os.environ.get('STATIC_CACHE_MAX_AGE') or 3600
+app.config['IMAGE_CACHE_MAX_AGE'] = os.environ.get('IMAGE_CACHE_MAX_AGE') or 30 * 24 * 3600
+# link static files to their fingerprinted builds, see assets.py; turn off while editing them
+app.config['ASSET_FINGERPRINTS'] = bool(int(os.environ.get('ASSET_FINGERPRINTS') or 1))
+# compress text responses of at least COMPRESSION_MIN_SIZE bytes, see compression.py
+app.config['COMPRESSION'] = bool(int(os.environ.get('COMPRESSION') or 1))
+app.config['COMPRESSION_MIN_SIZE'] = os.environ.get('COMPRESSION_MIN_SIZE') or 1024
+app.config['COMPRESSION_GZIP_LEVEL'] = os.environ.get('COMPRESSION_GZIP_LEVEL') or 6
+app.config['COMPRESSION_BROTLI_QUALITY'] = os.environ.get('COMPRESSION_BROTLI_QUALITY') or 5
 
 
 
@@ -105,6 +123,37 @@ SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'mysql://{0}:{1}@{2}/{3}?cha
                                                                                      app.config['MYSQL_DB']))
 
 app.config['ELASTICSEARCH_URL'] = ELASTICSEARCH_URL
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND') or 'sqlite'
+app.config['SEARCH_INDEX_PATH'] = os.environ.get('SEARCH_INDEX_PATH') or 'search_index.db'
+
+app.config['JOB_WORKERS'] = os.environ.get('JOB_WORKERS') or 2
+app.config['JOB_RESULTS_DIRECTORY'] = os.environ.get('JOB_RESULTS_DIRECTORY') or 'job_results'
+# running jobs not heard from for this long are failed, their server went down, see jobs.py
+app.config['JOB_HEARTBEAT_TIMEOUT_SECONDS'] = os.environ.get('JOB_HEARTBEAT_TIMEOUT_SECONDS') or 120
+# result files of jobs (exports) are deleted this many hours after they were written
+app.config['JOB_RESULT_TTL_HOURS'] = os.environ.get('JOB_RESULT_TTL_HOURS') or 24
+
+# item types, fields, locations and templates are cached across requests, see reference_cache.py
+app.config['REFERENCE_CACHE_SIZE'] = os.environ.get('REFERENCE_CACHE_SIZE') or 1024
+app.config['REFERENCE_CACHE_TTL'] = os.environ.get('REFERENCE_CACHE_TTL') or 300
+app.config['REFERENCE_CACHE_SHARED'] = bool(int(os.environ.get('REFERENCE_CACHE_SHARED') or 0))
+app.config['REFERENCE_CACHE_VERSION_CHECK'] = os.environ.get('REFERENCE_CACHE_VERSION_CHECK') or 5
+
+# the Flask-Login user loader reuses a user's identity columns for this many seconds, 0 to disable
+app.config['USER_CACHE_TTL'] = os.environ.get('USER_CACHE_TTL') or 30
+
+# log the hits and misses of the request-scoped lookup cache after every request
+app.config['REQUEST_CACHE_REPORT'] = bool(int(os.environ.get('REQUEST_CACHE_REPORT') or 0))
+
+# statements taking this many milliseconds go to the slow query log, and views running more statements
+# than QUERY_BUDGET (0 for no limit) are logged, see query_stats.py
+app.config['SLOW_QUERY_MS'] = os.environ.get('SLOW_QUERY_MS') or 200
+app.config['QUERY_BUDGET'] = os.environ.get('QUERY_BUDGET') or 0
+
+# serve /metrics to requests with "Authorization: Bearer <METRICS_TOKEN>", see metrics.py; it
+# answers 404 until METRICS_TOKEN is set
+app.config['METRICS'] = bool(int(os.environ.get('METRICS') or 1))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') or ''
 
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
 
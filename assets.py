@@ -0,0 +1,90 @@
+import json
+import mimetypes
+import os
+import threading
+from typing import Optional
+
+from flask import request, send_from_directory
+
+from app import app
+
+# Fingerprinted static assets
+#
+# admin/build_assets.py copies static/js, static/css and static/vendor to static/dist, naming every
+# file after a hash of its content (js/thinglist.js -> dist/js/thinglist.<hash>.js) and writing
+# gzip and brotli compressed copies next to it (<file>.gz, <file>.br). static/dist/manifest.json maps
+# the source names to the built ones:
+#   {"files": {"js/thinglist.js": "dist/js/thinglist.<hash>.js", ...},
+#    "encodings": {"dist/js/thinglist.<hash>.js": ["br", "gzip"], ...}}
+#
+# With ASSET_FINGERPRINTS set, url_for('static', filename=...) returns the built file of any asset in
+# the manifest, and the static view sends the compressed copy the browser accepts. Built files never
+# change, so they are cached for good (see http_caching.py). The manifest is read once per process;
+# run the build before (re)starting the server.
+
+DIST_DIRECTORY = "dist"
+MANIFEST_NAME = "manifest.json"
+
+# file extension -> Content-Encoding, in order of preference
+ENCODINGS = {"br": "br", "gz": "gzip"}
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def _load_manifest() -> dict:
+    global _manifest
+
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                manifest = {"files": {}, "encodings": {}}
+                path = os.path.join(app.static_folder, DIST_DIRECTORY, MANIFEST_NAME)
+                try:
+                    with open(path) as manifest_file:
+                        manifest.update(json.load(manifest_file))
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError) as e:
+                    app.logger.error(f"Could not read the asset manifest {path}: {str(e)}")
+                manifest["built"] = set(manifest["files"].values())
+                _manifest = manifest
+    return _manifest
+
+
+def asset_filename(filename: str) -> str:
+    """The filename, under static, to link to for an asset: its fingerprinted build if there is one."""
+    if not app.config['ASSET_FINGERPRINTS']:
+        return filename
+    return _load_manifest()["files"].get(filename, filename)
+
+
+def is_fingerprinted(filename: Optional[str]) -> bool:
+    return filename is not None and filename in _load_manifest()["built"]
+
+
+@app.url_defaults
+def _fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = asset_filename(values['filename'])
+
+
+def send_static_asset(filename: str):
+    """The static view: sends a precompressed copy of built assets when the browser accepts one."""
+    if not is_fingerprinted(filename):
+        return app.send_static_file(filename)
+
+    response = None
+    for extension, encoding in ENCODINGS.items():
+        if encoding in _load_manifest()["encodings"].get(filename, []) and request.accept_encodings[encoding] > 0:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            response = send_from_directory(app.static_folder, f"{filename}.{extension}", mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = send_static_asset
@@ -0,0 +1,375 @@
+from typing import Callable, Dict, Iterable, List, Optional
+
+from slugify import slugify
+from sqlalchemy import select, insert, update, delete, bindparam, func
+
+import search
+from app import db, app
+from inventory_versions import bump_inventory_versions
+from reference_cache import invalidate_reference_data, ITEM_TYPES, FIELDS, LOCATIONS
+from models import Item, ItemType, Location, Tag, ItemTag, Field, ItemField, InventoryItem, Image, ItemImage, \
+    generate_short_id
+
+# Bulk import
+#
+# Items are imported in batches: every type, location, tag and field a batch refers to is resolved
+# into an in-memory map (created with one multi-row INSERT if missing), then the batch's items and
+# their association rows are written with multi-row INSERTs and committed together.
+#
+# The inserts bypass the ORM, so model events do not run: short codes are generated here and the
+# search index is updated here.
+
+IMPORT_BATCH_SIZE = 500
+
+
+class BulkImporter:
+    """
+    Import items in the JSON export shape into a user's inventories.
+
+    :param user_id: The id of the importing user.
+    :param overwrite: Update the user's existing items with the same slug instead of adding new ones.
+    :param save_images: Optional callable(item: dict, item_id: int, item_name: str) -> list of image filenames,
+                        writing the item's image files; the importer records the images in the database.
+    :param progress: Optional callable(number_done: int) called after every committed batch.
+    :param batch_size: The number of items written and committed together.
+    """
+
+    def __init__(self, user_id: int, overwrite: bool = False,
+                 save_images: Optional[Callable[[dict, int, str], List[str]]] = None,
+                 progress: Optional[Callable[[int], None]] = None,
+                 batch_size: int = IMPORT_BATCH_SIZE):
+        self.user_id = user_id
+        self.overwrite = overwrite
+        self.save_images = save_images
+        self.progress = progress
+        self.batch_size = batch_size
+
+        self.number_done = 0
+        self.new_locations = []
+
+        self._types = None
+        self._locations = None
+        self._tags = {}
+        self._fields = {}
+        # reference cache namespaces written to by the current batch
+        self._reference_changes = set()
+
+    def import_items(self, inventory_id: int, items: Iterable[dict]) -> Dict[str, int]:
+        """
+        Import items into an inventory.
+
+        :param inventory_id: The id of the inventory to add new items to.
+        :param items: The items, as dictionaries in the JSON export shape (tags with spaces, not "@#$").
+        :return: A dictionary with the number of items "added" and "updated".
+        """
+        result = {"added": 0, "updated": 0}
+
+        with app.app_context():
+            if self._types is None:
+                self._load_user_maps()
+
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._import_batch(inventory_id, batch, result)
+                    batch = []
+
+            if len(batch) > 0:
+                self._import_batch(inventory_id, batch, result)
+
+        return result
+
+    def _load_user_maps(self):
+        rows = db.session.execute(select(ItemType.name, ItemType.id).where(ItemType.user_id == self.user_id))
+        self._types = {name.lower().strip(): id_ for name, id_ in rows if name is not None}
+
+        rows = db.session.execute(select(Location.name, Location.id).where(Location.user_id == self.user_id))
+        self._locations = {name: id_ for name, id_ in rows if name is not None}
+
+    def _import_batch(self, inventory_id: int, batch: List[dict], result: dict):
+        try:
+            self._resolve_types(batch)
+            self._resolve_locations(batch)
+            self._resolve_tags(batch)
+            self._resolve_fields(batch)
+
+            existing = self._find_existing_items(batch) if self.overwrite else {}
+            new_items = [x for x in batch if x.get("slug") not in existing]
+            updated_items = [x for x in batch if x.get("slug") in existing]
+
+            item_ids = self._insert_items(inventory_id, new_items)
+            item_ids.extend(self._update_items(updated_items, existing))
+
+            all_items = new_items + updated_items
+            self._insert_tags(all_items, item_ids, replace_ids=[existing[x["slug"]] for x in updated_items])
+            self._insert_fields(all_items, item_ids)
+            self._insert_images(all_items, item_ids)
+
+            # the rows above are written with Core statements, no flush event sees them
+            bump_inventory_versions(db.session, inventory_ids=[inventory_id], item_ids=item_ids)
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self._reference_changes = set()
+            app.logger.error(f"Bulk import of {len(batch)} items for user {self.user_id} failed: {str(e)}")
+            # rows created by this batch are gone, so are the map entries pointing at them
+            self._types = None
+            self._tags = {}
+            self._fields = {}
+            raise
+
+        for namespace in self._reference_changes:
+            invalidate_reference_data(namespace, self.user_id)
+        self._reference_changes = set()
+
+        self._index(all_items, item_ids)
+
+        result["added"] += len(new_items)
+        result["updated"] += len(updated_items)
+        self.number_done += len(batch)
+        if self.progress is not None:
+            self.progress(self.number_done)
+
+    def _resolve_types(self, batch: List[dict]):
+        missing = set()
+        for item in batch:
+            type_ = (item.get("type") or "none").lower().strip()
+            if type_ not in self._types:
+                missing.add(type_)
+
+        if len(missing) > 0:
+            db.session.execute(insert(ItemType).values([{"name": x, "user_id": self.user_id} for x in missing]))
+            rows = db.session.execute(select(ItemType.name, ItemType.id)
+                                      .where(ItemType.user_id == self.user_id).where(ItemType.name.in_(missing)))
+            self._types.update({name: id_ for name, id_ in rows})
+            self._reference_changes.add(ITEM_TYPES)
+
+    def _resolve_locations(self, batch: List[dict]):
+        missing = set()
+        for item in batch:
+            location_ = (item.get("location") or "").strip()
+            if location_ != "" and location_ not in self._locations:
+                missing.add(location_)
+
+        if len(missing) > 0:
+            db.session.execute(insert(Location).values(
+                [{"name": x, "description": x, "user_id": self.user_id} for x in missing]))
+            rows = db.session.execute(select(Location.name, Location.id)
+                                      .where(Location.user_id == self.user_id).where(Location.name.in_(missing)))
+            self._locations.update({name: id_ for name, id_ in rows})
+            self.new_locations.extend(sorted(missing))
+            self._reference_changes.add(LOCATIONS)
+
+    def _resolve_tags(self, batch: List[dict]):
+        wanted = set()
+        for item in batch:
+            for tag in _item_tags(item):
+                if tag not in self._tags:
+                    wanted.add(tag)
+        if len(wanted) == 0:
+            return
+
+        # tags are shared by all users
+        rows = db.session.execute(select(Tag.tag, Tag.id).where(Tag.tag.in_(wanted)))
+        self._tags.update({tag: id_ for tag, id_ in rows})
+
+        missing = wanted - self._tags.keys()
+        if len(missing) > 0:
+            db.session.execute(insert(Tag).values([{"tag": x, "user_id": self.user_id} for x in missing]))
+            rows = db.session.execute(select(Tag.tag, Tag.id).where(Tag.tag.in_(missing)))
+            self._tags.update({tag: id_ for tag, id_ in rows})
+
+    def _resolve_fields(self, batch: List[dict]):
+        wanted = set()
+        for item in batch:
+            for field_name in (item.get("custom_fields") or {}).keys():
+                if field_name not in self._fields:
+                    wanted.add(field_name)
+        if len(wanted) == 0:
+            return
+
+        # custom field values are keyed by field slug in exports, fields are shared by all users
+        rows = db.session.execute(select(Field.slug, Field.id).where(Field.slug.in_(wanted)))
+        self._fields.update({slug: id_ for slug, id_ in rows})
+
+        missing = {}
+        for field_name in wanted - self._fields.keys():
+            field_slug = slugify(field_name)
+            if field_slug in self._fields:
+                self._fields[field_name] = self._fields[field_slug]
+            else:
+                missing.setdefault(field_slug, field_name)
+
+        if len(missing) > 0:
+            existing_slugs = {slug for slug, in db.session.execute(
+                select(Field.slug).where(Field.slug.in_(missing.keys())))}
+            to_create = [{"field": name, "slug": slug} for slug, name in missing.items() if slug not in existing_slugs]
+            if len(to_create) > 0:
+                db.session.execute(insert(Field).values(to_create))
+                self._reference_changes.add(FIELDS)
+
+            rows = db.session.execute(select(Field.slug, Field.id).where(Field.slug.in_(missing.keys())))
+            ids_by_slug = {slug: id_ for slug, id_ in rows}
+            for slug, name in missing.items():
+                self._fields[name] = ids_by_slug[slug]
+                self._fields[slug] = ids_by_slug[slug]
+
+    def _find_existing_items(self, batch: List[dict]) -> Dict[str, int]:
+        slugs = [x.get("slug") for x in batch if x.get("slug")]
+        if len(slugs) == 0:
+            return {}
+        rows = db.session.execute(select(Item.slug, Item.id)
+                                  .where(Item.user_id == self.user_id).where(Item.slug.in_(slugs)))
+        return {slug: id_ for slug, id_ in rows}
+
+    def _item_values(self, item: dict) -> dict:
+        location_ = (item.get("location") or "").strip()
+        return {
+            "name": item.get("name"),
+            "description": item.get("description"),
+            "quantity": item.get("quantity", 1),
+            "item_type": self._types[(item.get("type") or "none").lower().strip()],
+            # the model's default location
+            "location_id": self._locations.get(location_, 1) if location_ != "" else 1,
+            "specific_location": item.get("specific_location"),
+        }
+
+    def _insert_items(self, inventory_id: int, items: List[dict]) -> List[int]:
+        """Insert new items and link them to the inventory, returning their ids in order."""
+        if len(items) == 0:
+            return []
+
+        short_codes = [generate_short_id(num_of_chars=6) for _ in items]
+        rows = []
+        for item, short_code in zip(items, short_codes):
+            values = self._item_values(item)
+            values.update({"user_id": self.user_id, "short_code": short_code})
+            rows.append(values)
+        db.session.execute(insert(Item).values(rows))
+
+        # the short codes are unique, use them to find the new ids without RETURNING
+        ids_by_code = dict(db.session.execute(select(Item.short_code, Item.id)
+                                              .where(Item.short_code.in_(short_codes))).all())
+        item_ids = [ids_by_code[x] for x in short_codes]
+
+        db.session.execute(update(Item.__table__).where(Item.__table__.c.id == bindparam("b_id"))
+                           .values(slug=bindparam("b_slug")),
+                           [{"b_id": id_, "b_slug": f"{id_}-{slugify(item.get('name'))}"}
+                            for item, id_ in zip(items, item_ids)])
+
+        db.session.execute(insert(InventoryItem).values(
+            [{"inventory_id": inventory_id, "item_id": id_} for id_ in item_ids]))
+
+        return item_ids
+
+    def _update_items(self, items: List[dict], existing: Dict[str, int]) -> List[int]:
+        """Update existing items from the imported data, returning their ids in order."""
+        if len(items) == 0:
+            return []
+
+        item_ids = [existing[x["slug"]] for x in items]
+        params = []
+        for item, id_ in zip(items, item_ids):
+            values = {f"b_{k}": v for k, v in self._item_values(item).items()}
+            values["b_id"] = id_
+            values["b_slug"] = f"{id_}-{slugify(item.get('name'))}"
+            params.append(values)
+
+        table_ = Item.__table__
+        db.session.execute(update(table_).where(table_.c.id == bindparam("b_id")).values(
+            name=bindparam("b_name"), description=bindparam("b_description"), quantity=bindparam("b_quantity"),
+            item_type=bindparam("b_item_type"), location_id=bindparam("b_location_id"),
+            specific_location=bindparam("b_specific_location"), slug=bindparam("b_slug")), params)
+
+        return item_ids
+
+    def _insert_tags(self, items: List[dict], item_ids: List[int], replace_ids: List[int]):
+        if len(replace_ids) > 0:
+            db.session.execute(delete(ItemTag).where(ItemTag.item_id.in_(replace_ids)))
+
+        rows = []
+        for item, id_ in zip(items, item_ids):
+            for tag_id in {self._tags[x] for x in _item_tags(item)}:
+                rows.append({"item_id": id_, "tag_id": tag_id})
+        if len(rows) > 0:
+            db.session.execute(insert(ItemTag).values(rows))
+
+    def _insert_fields(self, items: List[dict], item_ids: List[int]):
+        rows = {}
+        for item, id_ in zip(items, item_ids):
+            for field_name, field_value in (item.get("custom_fields") or {}).items():
+                rows[(self._fields[field_name], id_)] = field_value
+        if len(rows) == 0:
+            return
+
+        # replace the values of updated items
+        db.session.execute(delete(ItemField).where(ItemField.item_id.in_(item_ids))
+                           .where(ItemField.field_id.in_({x[0] for x in rows.keys()})))
+        db.session.execute(insert(ItemField).values(
+            [{"field_id": field_id, "item_id": item_id, "value": value, "show": True, "user_id": self.user_id}
+             for (field_id, item_id), value in rows.items()]))
+
+    def _insert_images(self, items: List[dict], item_ids: List[int]):
+        if self.save_images is None:
+            return
+
+        filenames_by_item = {}
+        for item, id_ in zip(items, item_ids):
+            filenames = self.save_images(item, id_, item.get("name"))
+            if filenames:
+                filenames_by_item[id_] = filenames
+        if len(filenames_by_item) == 0:
+            return
+
+        # images are stored by content, so a re-import reuses the user's existing rows and links
+        all_filenames = sorted({f for filenames in filenames_by_item.values() for f in filenames})
+        rows = db.session.execute(select(Image.image_filename, Image.id)
+                                  .where(Image.user_id == self.user_id).where(Image.image_filename.in_(all_filenames)))
+        image_ids = {filename: id_ for filename, id_ in rows}
+
+        missing = [f for f in all_filenames if f not in image_ids]
+        if len(missing) > 0:
+            # images have no unique column, find the new rows by id above the current maximum
+            max_id = db.session.execute(select(func.max(Image.id))).scalar() or 0
+            db.session.execute(insert(Image).values([{"image_filename": f, "user_id": self.user_id}
+                                                     for f in missing]))
+            rows = db.session.execute(select(Image.image_filename, Image.id)
+                                      .where(Image.id > max_id).where(Image.user_id == self.user_id)
+                                      .where(Image.image_filename.in_(missing)))
+            image_ids.update({filename: id_ for filename, id_ in rows})
+
+        existing_links = set(db.session.execute(select(ItemImage.item_id, ItemImage.image_id)
+                                                .where(ItemImage.item_id.in_(list(filenames_by_item.keys())))
+                                                .where(ItemImage.image_id.in_(list(image_ids.values())))).all())
+        links = [{"image_id": image_ids[f], "item_id": id_}
+                 for id_, filenames in filenames_by_item.items() for f in filenames
+                 if (id_, image_ids[f]) not in existing_links]
+        if len(links) > 0:
+            db.session.execute(insert(ItemImage).values(links))
+
+        # the first image becomes the main image of items without one
+        table_ = Item.__table__
+        db.session.execute(update(table_).where(table_.c.id == bindparam("b_id"))
+                           .where(table_.c.main_image.is_(None))
+                           .values(main_image=bindparam("b_main_image")),
+                           [{"b_id": id_, "b_main_image": filenames[0]} for id_, filenames in filenames_by_item.items()])
+
+    def _index(self, items: List[dict], item_ids: List[int]):
+        changes = {}
+        for item, id_ in zip(items, item_ids):
+            document = {"id": id_, "user_id": self.user_id}
+            for field in Item.__searchable__:
+                document[field] = item.get(field)
+            changes[(Item.__tablename__, id_)] = document
+        search.enqueue_index_changes(changes)
+
+
+def _item_tags(item: dict) -> List[str]:
+    tags = []
+    for tag in item.get("tags") or []:
+        tag = str(tag).strip()
+        if tag != "":
+            tags.append(tag.replace(" ", "@#$"))
+    return tags
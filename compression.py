@@ -0,0 +1,131 @@
+import zlib
+from typing import Iterable, Iterator
+
+from flask import request
+
+from app import app
+
+# Response compression
+#
+# Text responses (pages, JSON, CSV, exports) are compressed with brotli or gzip, whichever the browser
+# prefers among those available; brotli needs the brotli package. Responses whose whole body is in
+# memory are compressed at once when they are at least COMPRESSION_MIN_SIZE bytes. Streamed responses,
+# the exports and files sent from disk, are compressed as they are sent, flushing every
+# STREAM_FLUSH_SIZE bytes so the browser keeps receiving data.
+#
+# Responses already encoded (precompressed static assets, see assets.py), images, partial content
+# and responses marked no-transform are sent as they are.
+
+COMPRESSIBLE_TYPES = {"application/json", "application/javascript", "application/xml", "application/ld+json",
+                      "image/svg+xml", "text/csv"}
+
+STREAM_FLUSH_SIZE = 64 * 1024
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _is_compressible(response) -> bool:
+    mimetype = response.mimetype or ""
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def _choose_encoding() -> str:
+    """The encoding to send, "br", "gzip" or None, by the quality the request gives each."""
+    choices = []
+    if brotli is not None:
+        choices.append("br")
+    choices.append("gzip")
+
+    best, best_quality = None, 0
+    for encoding in choices:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _Compressor:
+    """zlib and brotli behind one interface: compress, flush (without ending the stream) and finish."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=int(app.config['COMPRESSION_BROTLI_QUALITY']))
+        else:
+            # wbits 31: a gzip header and trailer around the deflate stream
+            self._compressor = zlib.compressobj(int(app.config['COMPRESSION_GZIP_LEVEL']), zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def _compress_stream(chunks: Iterable, compressor: _Compressor) -> Iterator[bytes]:
+    number_unflushed = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compressor.compress(chunk)
+            number_unflushed += len(chunk)
+            if number_unflushed >= STREAM_FLUSH_SIZE:
+                data += compressor.flush()
+                number_unflushed = 0
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        # the wrapped body may hold a file or a database cursor
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    """Compress a response for the current request if it is worth it, see above."""
+    if not app.config['COMPRESSION'] or not _is_compressible(response):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if request.method == "HEAD" or response.status_code < 200 or response.status_code in (204, 206, 304) \
+            or 'Content-Encoding' in response.headers or 'Content-Range' in response.headers \
+            or 'no-transform' in response.headers.get('Cache-Control', ""):
+        return response
+
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.content_length is not None and response.content_length < int(app.config['COMPRESSION_MIN_SIZE']):
+        return response
+
+    compressor = _Compressor(encoding)
+    if response.is_streamed or response.direct_passthrough:
+        body = response.response
+        response.direct_passthrough = False
+        response.response = _compress_stream(body, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    # ranges would refer to the compressed bytes
+    response.headers.pop('Accept-Ranges', None)
+    # the same resource with another encoding: validators still match, but only weakly
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -1,4 +1,5 @@
 import datetime
+import json
 import os
 
 import uuid
@@ -7,14 +8,22 @@ from typing import Union, List, Tuple, Optional, Dict
 import flask_bcrypt
 
 from slugify import slugify
-from sqlalchemy import select, and_, ClauseElement, or_
+from sqlalchemy import select, and_, ClauseElement, or_, insert, update
 from sqlalchemy.exc import SQLAlchemyError, NoResultFound, InvalidRequestError
 from sqlalchemy.sql.functions import func
 
+import inventory_versions  # registers the flush events bumping inventory versions
+import migrations
+import search
 from app import db, app
 from email_utils import send_email
+from image_derivatives import remove_derivative_files
+from image_store import user_images_directory
+from loading import ITEM_LIST_LOAD, ITEM_SEARCH_LOAD, INVENTORY_SUMMARY_LOAD
+from reference_cache import reference_cached, ITEM_TYPES, FIELDS, LOCATIONS, TEMPLATES
+from request_cache import request_memoized
 from models import Inventory, User, Item, UserInventory, InventoryItem, ItemType, Tag, \
-    Location, Image, Field, ItemField, FieldTemplate, Notification, TemplateField, Relateditems, ItemImage
+    Location, Image, Field, ItemField, FieldTemplate, Notification, TemplateField, Relateditems, ItemImage, ItemTag
 
 _NONE_ = "None"
 
@@ -34,6 +43,7 @@ def drop_then_create():
         db.drop_all()
         db.create_all()
         db.session.commit()
+        migrations.stamp_head()
     except Exception as e:
         print(e)
 
@@ -63,7 +73,7 @@ def post_user_add_hook(new_user: User):
         add_new_user_itemtype(name=_NONE_, user_id=new_user.id)
 
         # create folder for user uploads
-        user_upload_folder = os.path.join(app.config['USER_IMAGES_BASE_PATH'], str(new_user.id))
+        user_upload_folder = user_images_directory(new_user.id)
         if not os.path.exists(user_upload_folder):
             os.makedirs(user_upload_folder)
 
@@ -137,6 +147,7 @@ def find_user_by_id2(id: int) -> Optional[User]:
     return user
 
 
+@request_memoized
 def find_user_by_username(username: str) -> Optional[User]:
     """
     Args:
@@ -326,6 +337,7 @@ def find_inventory_by_access_token(access_token: str) -> Optional[Inventory]:
         return None
 
 
+@request_memoized
 def find_inventory_by_slug(inventory_slug: str, inventory_owner_id: int = None,
                            viewing_user_id: int = None) -> Tuple[Optional[Inventory], Optional[UserInventory]]:
     """
@@ -361,7 +373,9 @@ def find_inventory_by_slug(inventory_slug: str, inventory_owner_id: int = None,
 
     # do some new code here to fix
     # try to find a user inventory for the user and the inventory id
-    inventory_ = Inventory.query.filter(Inventory.slug == inventory_slug).one_or_none()
+    # slugs are unique per owner only
+    inventory_ = Inventory.query.filter(Inventory.owner_id == inventory_owner_id) \
+        .filter(Inventory.slug == inventory_slug).one_or_none()
     if not inventory_:
         return None, None
 
@@ -390,6 +404,7 @@ def find_inventory_by_slug(inventory_slug: str, inventory_owner_id: int = None,
                 return None, None
 
 
+@request_memoized
 def find_template_by_id(template_id: int) -> Optional[FieldTemplate]:
     """
     Args:
@@ -405,6 +420,7 @@ def find_template_by_id(template_id: int) -> Optional[FieldTemplate]:
         return None
 
 
+@request_memoized
 def find_all_user_inventories(user_id: int) -> list:
     if user_id is None:
         raise ValueError("User cannot be None")
@@ -614,19 +630,29 @@ def delete_notification_by_id(notification_id: int, user: User):
         }
 
 
-def get_item_custom_field_data(user_id: int, item_list=None):
-    with app.app_context():
-        item_field_data_ = db.session.query(Item.id, Field.field, ItemField.value, Field.slug) \
-            .join(ItemField, ItemField.field_id == Field.id) \
-            .join(Item, ItemField.item_id == Item.id) \
-            .filter(Item.user_id == user_id) \
-            .filter(ItemField.show == True)
+def _item_custom_field_query(user_id: int, item_list=None):
+    """
+    Build the query for the shown custom field values of a user's items.
+
+    :param user_id: The ID of the user owning the items.
+    :param item_list: Only the items with these IDs.
+    :return: The query of (item id, field name, value, field slug).
+    """
+    item_field_data_ = db.session.query(Item.id, Field.field, ItemField.value, Field.slug) \
+        .join(ItemField, ItemField.field_id == Field.id) \
+        .join(Item, ItemField.item_id == Item.id) \
+        .filter(Item.user_id == user_id) \
+        .filter(ItemField.show == True)
 
-        if item_list is not None:
-            if isinstance(item_list, list):
-                item_field_data_ = item_field_data_.filter(Item.id.in_(item_list))
+    if item_list is not None:
+        if isinstance(item_list, list):
+            item_field_data_ = item_field_data_.filter(Item.id.in_(item_list))
+    return item_field_data_
 
-        item_field_data_ = item_field_data_.all()
+
+def get_item_custom_field_data(user_id: int, item_list=None):
+    with app.app_context():
+        item_field_data_ = _item_custom_field_query(user_id=user_id, item_list=item_list).all()
 
         slugs = []
         sdsd = {}
@@ -684,115 +710,124 @@ def _find_field_by_name(field_name: str):
 
 
 def _search_by_field_value(field_id: int, user_id: int, query: str):
+    """
+    Build a query for the user's items whose custom field value contains the query text.
+
+    :param field_id: The ID of the custom field to search.
+    :param user_id: The ID of the user whose items are searched.
+    :param query: The text to look for.
+    :return: The items query.
+    """
     looking_for = '%{0}%'.format(query)
-    with app.app_context():
-        items_ = db.session.query(Item) \
-            .join(ItemField, ItemField.item_id == Item.id) \
-            .filter(ItemField.field_id == field_id) \
-            .filter(ItemField.user_id == user_id) \
-            .filter(ItemField.value.ilike(looking_for)).all()
+    return db.session.query(Item) \
+        .join(ItemField, ItemField.item_id == Item.id) \
+        .filter(ItemField.field_id == field_id) \
+        .filter(ItemField.user_id == user_id) \
+        .filter(ItemField.value.ilike(looking_for))
+
+
+def _search_modifier_query(search_modifier: str, query: str, user_id: int):
+    """
+    Build the items query for a 'modifier:query' search (location, tags, type or a custom field name).
+
+    :param search_modifier: The lower-case search modifier.
+    :param query: The text after the modifier.
+    :param user_id: The ID of the user whose items are searched.
+    :return: The items query, or None if nothing can match.
+    """
+    if search_modifier == 'location':
+        location_ids_ = select(Location.id) \
+            .where(Location.user_id == user_id) \
+            .where(Location.name.like(query))
+        looking_for = '%{0}%'.format(query)
+        return Item.query.filter(Item.user_id == user_id).filter(or_(
+            Item.location_id.in_(location_ids_),
+            Item.specific_location.ilike(looking_for)
+        ))
 
-        return items_
+    if search_modifier == 'tags':
+        items_query_ = Item.query.filter(Item.user_id == user_id)
 
+        any_tags_found = False
+        for tag_ in query.split(","):
+            tag_ = tag_.strip()
+            tag_ = tag_.replace(" ", "@#$")
+            t_ = find_tag(tag=tag_)
+
+            if t_ is not None:
+                any_tags_found = True
+                items_query_ = items_query_.filter(Item.tags.contains(t_))
+
+        return items_query_ if any_tags_found else None
+
+    if search_modifier == 'type':
+        type_names = [x.strip().lower() for x in query.split(",")]
+        type_ids_ = select(ItemType.id) \
+            .where(ItemType.user_id == user_id) \
+            .where(func.lower(ItemType.name).in_(type_names))
+        return Item.query.filter(Item.user_id == user_id).filter(Item.item_type.in_(type_ids_))
+
+    # we have a custom field
+    field_ = _find_field_by_name(field_name=search_modifier)
+    if field_ is None:
+        return None
+    return _search_by_field_value(field_id=field_.id, user_id=user_id, query=query)
+
+
+def search_items(query: str, user_id: int, page: int = 1, per_page: int = 25) -> Tuple[List[Item], int]:
+    """
+    Search the user's items.
+
+    Plain text is looked up in the full-text search index and ranked by relevance. A 'modifier:query'
+    search (location, tags, type or a custom field name) is answered from the database.
+
+    :param query: The search text.
+    :param user_id: The ID of the user whose items are searched.
+    :param page: The 1-based page of results to return.
+    :param per_page: The number of results per page.
+    :return: A tuple of the items on the requested page and the total number of matching items.
+    """
+    if page < 1:
+        page = 1
 
-def search_items(query: str, user_id: int):
-    items_arr = []
     with app.app_context():
 
         # see if there is a search modifier
         if ':' in query:
-            search_modifier = query.split(':')[0]
-            query = query.split(':')[1]
-
-            if search_modifier.lower() == 'location':
-                locations_ = Location.query \
-                    .filter(Location.user_id == user_id) \
-                    .filter(Location.name.like(query)).all()
-
-                for location in locations_:
-                    loc_id_ = location.id
-                    items_ = Item.query.filter(or_(
-                        Item.location_id == loc_id_,
-                        Item.specific_location == query
-                    )
-                    ).all()
-
-                    if len(items_) > 0:
-                        for item in items_:
-                            items_arr.append(item.__dict__)
-
-                looking_for = '%{0}%'.format(query)
-                items_ = Item.query.filter(
-                    Item.specific_location.ilike(looking_for)
-                ).all()
-
-                if len(items_) > 0:
-                    for item in items_:
-                        items_arr.append(item.__dict__)
-
-            elif search_modifier.lower() == 'tags':
-                query = query.split(",")
-                q_ = Item.query
-
-                any_tags_found = False
-                for tag_ in query:
-                    tag_ = tag_.strip()
-                    tag_ = tag_.replace(" ", "@#$")
-                    t_ = find_tag(tag=tag_)
-
-                    if t_ is not None:
-                        any_tags_found = True
-                        q_ = q_.filter(Item.tags.contains(t_))
-
-                if any_tags_found:
-                    items_ = q_.all()
-
-                    if len(items_) > 0:
-                        for item in items_:
-                            items_arr.append(item.__dict__)
-
-            elif search_modifier.lower() == 'type':
-                query = query.split(",")
-
-                types_ = ItemType.query \
-                    .filter(ItemType.user_id == user_id) \
-                    .filter(ItemType.name.like(query)).all()
-
-                type_ids = []
-                for type_ in types_:
-                    type_ids.append(type_.id)
-
-                items_ = Item.query.filter(Item.user_id == user_id).filter(Item.item_type.in_([type_ids])).all()
-
-                if len(items_) > 0:
-                    for item in items_:
-                        items_arr.append(item.__dict__)
-
-            else:  # we have a custom field
-                field_ = _find_field_by_name(field_name=search_modifier)
-                if field_ is not None:
-                    field_id = field_.id
-                    items_ = _search_by_field_value(field_id=field_id, user_id=user_id, query=query)
+            search_modifier, query = query.split(':', 1)
+            items_query_ = _search_modifier_query(search_modifier=search_modifier.strip().lower(),
+                                                  query=query.strip(), user_id=user_id)
+        else:
+            hits = search.query_index(Item.__tablename__, query, page, per_page, user_id=user_id)
 
-                    if len(items_) > 0:
-                        for item in items_:
-                            items_arr.append(item.__dict__)
+            if hits is not None:
+                item_ids, total = hits
+                if len(item_ids) == 0:
+                    return [], total
 
-        else:
-            # search simple string
-            looking_for = '%{0}%'.format(query)
+                items_ = Item.query.options(*ITEM_SEARCH_LOAD).filter(Item.id.in_(item_ids)).all()
+
+                # keep the relevance order of the search index
+                rank = {item_id: position for position, item_id in enumerate(item_ids)}
+                items_.sort(key=lambda x: rank[x.id])
+                return items_, total
 
-            items_ = Item.query.filter(or_(
+            # no search index available, search simple string
+            looking_for = '%{0}%'.format(query)
+            items_query_ = Item.query.filter(Item.user_id == user_id).filter(or_(
                 Item.name.ilike(looking_for),
                 Item.description.ilike(looking_for)
-            )
-            ).all()
+            ))
 
-            if len(items_) > 0:
-                for item in items_:
-                    items_arr.append(item.__dict__)
+        if items_query_ is None:
+            return [], 0
+
+        total = items_query_.order_by(None).count()
+        items_ = items_query_.options(*ITEM_SEARCH_LOAD) \
+            .order_by(Item.name.asc(), Item.id.asc()) \
+            .limit(per_page).offset((page - 1) * per_page).all()
 
-        return items_arr
+        return items_, total
 
 
 def find_item(logged_in_user_id, request_user_id, item_id, item_slug):
@@ -904,75 +939,151 @@ def _find_my_items_using_select(logged_in_user: User, inventory_id, query_params
             d = 3
 
 
-def _find_my_items(logged_in_user: User, inventory_id, query_params):
-    with app.app_context():
-        if inventory_id is not None and inventory_id != '':
-            query = db.session.query(Item, ItemType.name, Location.name, InventoryItem.access_level,
-                                     InventoryItem.is_link, UserInventory) \
-                .join(ItemType, ItemType.id == Item.item_type) \
-                .join(Location, Location.id == Item.location_id)
+_ITEM_ORDER_COLUMNS = {
+    'name': Item.name,
+    'type': ItemType.name,
+    'location': Location.name,
+    'description': Item.description,
+    'quantity': Item.quantity,
+    'id': Item.id,
+}
 
-            query = query.join(InventoryItem, InventoryItem.item_id == Item.id)
-            query = query.join(Inventory, Inventory.id == InventoryItem.inventory_id)
-            query = query.filter(InventoryItem.inventory_id == inventory_id)
+# DataTables column indexes used by the original list view (name, type, location)
+_LEGACY_ORDER_COLUMNS = {'0': 'name', '1': 'type', '2': 'location'}
 
-            query = query.filter(UserInventory.inventory_id == inventory_id)
-            query = query.filter(UserInventory.user_id == logged_in_user.id)
-        else:
-            query = db.session.query(Item, ItemType.name, Location.name, InventoryItem.access_level,
-                                     InventoryItem.is_link) \
-                .join(ItemType, ItemType.id == Item.item_type) \
-                .join(Location, Location.id == Item.location_id)
 
-            query = query.join(InventoryItem, InventoryItem.item_id == Item.id)
+def _item_order_column(order_column: str):
+    """
+    Map a requested order column name onto a SQL expression.
 
-        query = query.filter(Item.user_id == logged_in_user.id)
+    :param order_column: The column name (or legacy DataTables column index) to order by.
+    :return: A column expression, or None if the column is not orderable.
+    """
+    order_column = _LEGACY_ORDER_COLUMNS.get(order_column, order_column)
 
-        query = _find_query_parameters(query_=query, query_params=query_params)
+    if order_column == 'tags':
+        # order by the alphabetically first tag of each item
+        return select(func.min(Tag.tag)) \
+            .join(ItemTag, ItemTag.tag_id == Tag.id) \
+            .where(ItemTag.item_id == Item.id) \
+            .scalar_subquery()
+
+    return _ITEM_ORDER_COLUMNS.get(order_column, None)
+
+
+def _my_items_query(entities: tuple, logged_in_user: User, inventory_id, query_params: dict):
+    """
+    Build the filtered (but not ordered or windowed) items query for the logged-in user.
 
-        search = query_params.get("search", None)
+    :param entities: The entities/columns to select.
+    :param logged_in_user: The user whose items are queried.
+    :param inventory_id: The inventory to restrict the items to, or None for all inventories.
+    :param query_params: The type/location/tag/search filters.
+    :return: The filtered query.
+    """
+    query = db.session.query(*entities).select_from(Item) \
+        .join(ItemType, ItemType.id == Item.item_type) \
+        .join(Location, Location.id == Item.location_id) \
+        .join(InventoryItem, InventoryItem.item_id == Item.id)
 
-        if search is not None:
-            if search != "":
-                query = query.filter(Item.name.contains(search))
+    if inventory_id is not None and inventory_id != '':
+        query = query.filter(InventoryItem.inventory_id == inventory_id)
 
-        start = query_params.get("start", 0)
-        length = query_params.get("length", 50)
+    query = query.filter(Item.user_id == logged_in_user.id)
 
-        order_0 = query_params.get("order_0", None)
-        dir_0 = query_params.get("dir_0", None)
+    query = _find_query_parameters(query_=query, query_params=query_params)
+
+    search = query_params.get("search", None)
+
+    if search is not None and search != "":
+        query = query.filter(Item.name.contains(search))
+
+    return query
 
-        if order_0 is not None and dir_0 is not None:
-            if order_0 == '0':
-                if dir_0 == 'asc':
-                    query = query.order_by(Item.name.asc())
-                else:
-                    query = query.order_by(Item.name.desc())
-            elif order_0 == '1':
-                if dir_0 == 'asc':
-                    query = query.order_by(ItemType.name.asc())
-                else:
-                    query = query.order_by(ItemType.name.desc())
-            elif order_0 == '2':
-                if dir_0 == 'asc':
-                    query = query.order_by(Location.name.asc())
-                else:
-                    query = query.order_by(Location.name.desc())
 
-        page = int((int(start) / int(length)))
-        # page = query_params.get("page", 1)
-        per_page = int(query_params.get("length", 50))
+def _apply_items_window(query_, query_params: dict):
+    """
+    Apply ordering and the page window to an items query.
+
+    The page window is either a keyset window ('after_id', ordered by item id) or
+    an offset window ('start'/'length'). Without 'length' the whole result is returned.
+
+    :param query_: The filtered items query.
+    :param query_params: The ordering and paging parameters.
+    :return: The ordered and windowed query.
+    """
+    order_column = query_params.get("order_column", query_params.get("order_0", None))
+    order_dir = query_params.get("dir_0", None)
+    after_id = query_params.get("after_id", None)
+    length = query_params.get("length", None)
+
+    column_ = None
+    if order_column is not None and after_id is None:
+        column_ = _item_order_column(str(order_column))
+
+    if column_ is not None:
+        if order_dir == 'desc':
+            query_ = query_.order_by(column_.desc(), Item.id.desc())
+        else:
+            query_ = query_.order_by(column_.asc(), Item.id.asc())
+    else:
+        query_ = query_.order_by(Item.id.asc())
+
+    if after_id is not None:
+        query_ = query_.filter(Item.id > int(after_id))
+    else:
+        start = int(query_params.get("start", 0) or 0)
+        if start > 0:
+            query_ = query_.offset(start)
+
+    if length is not None and int(length) > 0:
+        query_ = query_.limit(int(length))
 
-        if length is not None:
-            query = query.limit(per_page)
-        if page is not None:
-            query = query.offset(page * per_page)
+    return query_
+
+
+def _find_my_items(logged_in_user: User, inventory_id, query_params, load_options=ITEM_LIST_LOAD):
+    with app.app_context():
+        if inventory_id is not None and inventory_id != '':
+            query = _my_items_query(entities=(Item, ItemType.name, Location.name, InventoryItem.access_level,
+                                              InventoryItem.is_link, UserInventory),
+                                    logged_in_user=logged_in_user, inventory_id=inventory_id,
+                                    query_params=query_params)
+
+            query = query.filter(UserInventory.inventory_id == inventory_id)
+            query = query.filter(UserInventory.user_id == logged_in_user.id)
+        else:
+            query = _my_items_query(entities=(Item, ItemType.name, Location.name, InventoryItem.access_level,
+                                              InventoryItem.is_link),
+                                    logged_in_user=logged_in_user, inventory_id=inventory_id,
+                                    query_params=query_params)
+
+        query = _apply_items_window(query_=query, query_params=query_params)
+        query = query.options(*load_options)
 
         results_ = query.all()
 
         return results_
 
 
+def count_my_items(logged_in_user: User, inventory_id, query_params=None) -> int:
+    """
+    Count the items matching the filters of _find_my_items with a single SQL COUNT.
+
+    :param logged_in_user: The user whose items are counted.
+    :param inventory_id: The inventory to restrict the count to, or None for all inventories.
+    :param query_params: The type/location/tag/search filters. Ordering and paging are ignored.
+    :return: The number of matching item rows.
+    """
+    if query_params is None:
+        query_params = {}
+
+    with app.app_context():
+        query = _my_items_query(entities=(func.count(Item.id),), logged_in_user=logged_in_user,
+                                inventory_id=inventory_id, query_params=query_params)
+        return query.scalar() or 0
+
+
 """
 inventory access
 0 - owner
@@ -980,7 +1091,8 @@ inventory access
 """
 
 
-def _find_someone_elses_items_loggedin(logged_in_user: User, request_user_id, inventory_id, query_params):
+def _find_someone_elses_items_loggedin(logged_in_user: User, request_user_id, inventory_id, query_params,
+                                       load_options=ITEM_LIST_LOAD):
     with app.app_context():
         query = db.session.query(Item, ItemType.name, Location.name, InventoryItem.access_level, InventoryItem.is_link) \
             .join(ItemType, ItemType.id == Item.item_type) \
@@ -998,13 +1110,14 @@ def _find_someone_elses_items_loggedin(logged_in_user: User, request_user_id, in
         # query = query.filter(InventoryItem.access_level == 2)
 
         query = _find_query_parameters(query_=query, query_params=query_params)
+        query = query.options(*load_options)
 
         results_ = query.all()
 
         return results_
 
 
-def _find_someone_elses_items_notloggedin(request_user_id, inventory_id, query_params):
+def _find_someone_elses_items_notloggedin(request_user_id, inventory_id, query_params, load_options=ITEM_LIST_LOAD):
     with app.app_context():
         query = db.session.query(Item, ItemType.name, Location.name, InventoryItem.access_level, InventoryItem.is_link) \
             .join(ItemType, ItemType.id == Item.item_type) \
@@ -1022,13 +1135,15 @@ def _find_someone_elses_items_notloggedin(request_user_id, inventory_id, query_p
         # query = query.filter(InventoryItem.access_level == 2)
 
         query = _find_query_parameters(query_=query, query_params=query_params)
+        query = query.options(*load_options)
 
         results_ = query.all()
 
         return results_
 
 
-def find_items_new(logged_in_user=None, requested_username=None, inventory_id=None, query_params=None):
+def find_items_new(logged_in_user=None, requested_username=None, inventory_id=None, query_params=None,
+                   load_options=ITEM_LIST_LOAD):
     if query_params is None:
         query_params = {}
 
@@ -1057,18 +1172,21 @@ def find_items_new(logged_in_user=None, requested_username=None, inventory_id=No
         return {}
 
     if logged_in_user is not None and requested_user is None:
-        return _find_my_items(logged_in_user=logged_in_user, inventory_id=inventory_id, query_params=query_params)
+        return _find_my_items(logged_in_user=logged_in_user, inventory_id=inventory_id, query_params=query_params,
+                              load_options=load_options)
 
     if logged_in_user is not None and logged_in_user_id == request_user_id:
-        return _find_my_items(logged_in_user=logged_in_user, inventory_id=inventory_id, query_params=query_params)
+        return _find_my_items(logged_in_user=logged_in_user, inventory_id=inventory_id, query_params=query_params,
+                              load_options=load_options)
 
     if logged_in_user is not None:
         # if logged_in_user is not None:
         return _find_someone_elses_items_loggedin(request_user_id=request_user_id, inventory_id=inventory_id,
-                                                  query_params=query_params, logged_in_user=logged_in_user)
+                                                  query_params=query_params, logged_in_user=logged_in_user,
+                                                  load_options=load_options)
     else:
         return _find_someone_elses_items_notloggedin(request_user_id=request_user_id, inventory_id=inventory_id,
-                                                     query_params=query_params)
+                                                     query_params=query_params, load_options=load_options)
 
 
 def get_all_item_ids_in_inventory(user_id: int, inventory_id: int):
@@ -1081,14 +1199,15 @@ def get_all_item_ids_in_inventory(user_id: int, inventory_id: int):
         return [x[0] for x in results_]
 
 
-def count_all_item_ids_in_inventory(user_id: int, inventory_id: int) -> int:
+def count_all_item_ids_in_inventory(user_id: int, inventory_id: int = None) -> int:
     with app.app_context():
-        stmt = select(Item.id).join(InventoryItem, InventoryItem.item_id == Item.id
-                                    ).where(user_id == Item.user_id
-                                            ).where(InventoryItem.inventory_id == inventory_id)
+        stmt = select(func.count(Item.id)).join(InventoryItem, InventoryItem.item_id == Item.id
+                                                ).where(user_id == Item.user_id)
 
-        results_ = db.session.execute(stmt).all()
-        return len(results_)
+        if inventory_id is not None:
+            stmt = stmt.where(InventoryItem.inventory_id == inventory_id)
+
+        return db.session.execute(stmt).scalar() or 0
 
 
 def delete_all_items_in_inventory(user_id: int, inventory_id: int):
@@ -1122,6 +1241,8 @@ def change_item_access_level(item_ids: int, access_level: int, user_id: int):
         db.session.commit()
 
 
+@request_memoized
+@reference_cached(LOCATIONS, user_arg="user_id")
 def get_all_user_locations(user_id: int) -> Optional[list[Location]]:
     user_locations_ = Location.query.filter_by(user_id=user_id).all()
     return user_locations_
@@ -1133,6 +1254,8 @@ def get_all_user_tags(user_id: int) -> list[Tag]:
     return res_
 
 
+@request_memoized
+@reference_cached(ITEM_TYPES)
 def get_all_item_types() -> list:
     item_types_ = ItemType.query.all()
     return item_types_
@@ -1177,6 +1300,7 @@ def add_new_user_itemtype(name: str, user_id: int) -> (bool, str):
         return True, f"Item type {name} exists for {user_id}"
 
 
+@request_memoized
 def find_type_by_text(type_text: str, user_id: int = None) -> Union[dict, None]:
     with app.app_context():
 
@@ -1263,6 +1387,7 @@ def find_template(template_id: int) -> Location:
     return template_
 
 
+@request_memoized
 def find_location_by_name(location_name: str) -> Location:
     location_ = Location.query.filter_by(name=location_name).first()
     return location_
@@ -1346,7 +1471,16 @@ def relate_items_by_id(item1_id: int, item2_id: int) -> (bool, str):
             return False, f"Items with ids {item1_id} and {item2_id} are already related"
 
 
-# def add_item_inventory(item, inventory): XXXX
+# def add_item_inventory(item, inventory): XX    removed_images = list(item_.images)
+    item_.images = []
+    item_.main_image = None
+    release_images(images=removed_images, user_id=user_id)
+    try:
+        db.session.commit()
+        return True, "Item images deleted successfully"
+    except SQLAlchemyError:
+        db.session.rollback()
+        return False, "Error deleting item images"
 #     with app.app_context():
 #         stmt = select(Item).where(Item.id == item)
 #         item_ = db.session.execute(stmt).first()
@@ -1401,13 +1535,14 @@ def get_all_images(user_id: int = None) -> list[Image]:
         return images_, itemimages_
 
 
-def add_images_to_item(item_id: int, filenames: list[str], user: User) -> (bool, str):
+def add_images_to_item(item_id: int, filenames: list[str], user: User, variants: dict = None) -> (bool, str):
     """
     Add images to an item.
 
     :param item_id: The ID of the item to add images to. (int)
     :param filenames: A list of filenames for the images to add. (list[str])
     :param user: The user who is adding the images. (User)
+    :param variants: The derivatives generated for each filename, if any. (dict)
 
     :return: A tuple indicating the success of adding the images and a message. (bool, str)
     """
@@ -1424,8 +1559,14 @@ def add_images_to_item(item_id: int, filenames: list[str], user: User) -> (bool,
             return False, f"No item with id {item_id} found for user {user.username}"
 
         for file in filenames:
-            new_image = Image(image_filename=file, user_id=user.id)
-            item_.images.append(new_image)
+            # a user stores each file once, items share its Image row
+            image_ = Image.query.filter_by(image_filename=file).filter_by(user_id=user.id).first()
+            if image_ is None:
+                image_ = Image(image_filename=file, user_id=user.id)
+            if variants is not None and file in variants:
+                image_.variants = json.dumps(variants[file])
+            if image_ not in item_.images:
+                item_.images.append(image_)
 
         item_.main_image = item_.images[0].image_filename
 
@@ -1437,6 +1578,79 @@ def add_images_to_item(item_id: int, filenames: list[str], user: User) -> (bool,
             return False
 
 
+def set_image_variants(image_filename: str, user_id: int, variants: Optional[dict]) -> None:
+    """
+    Record the derivatives written for an uploaded image, or drop the image and its file if it could
+    not be processed.
+
+    :param image_filename: The filename of the image.
+    :param user_id: The ID of the user owning the image.
+    :param variants: The variants written, see image_derivatives.py, or None if processing failed.
+    """
+    with app.app_context():
+        image_ = Image.query.filter_by(image_filename=image_filename).filter_by(user_id=user_id).one_or_none()
+        if image_ is None:
+            # every item let go of the image while it was processed, nothing refers to its files
+            if variants is not None:
+                images_directory = user_images_directory(user_id)
+                remove_derivative_files(images_directory, image_filename, json.dumps(variants))
+                try:
+                    os.remove(os.path.join(images_directory, image_filename))
+                except OSError:
+                    pass
+            return
+
+        if variants is not None:
+            image_.variants = json.dumps(variants)
+        else:
+            for item_ in list(image_.items):
+                item_.images.remove(image_)
+                if item_.main_image == image_filename:
+                    item_.main_image = item_.images[0].image_filename if len(item_.images) > 0 else None
+            db.session.delete(image_)
+
+        try:
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            app.logger.error(f"Could not record the variants of image {image_filename}: {str(e)}")
+            return
+
+        if variants is None:
+            images_directory = user_images_directory(user_id)
+            try:
+                os.remove(os.path.join(images_directory, image_filename))
+            except OSError as er:
+                app.logger.error(f"Could not delete image file {image_filename}: {er}")
+
+
+def release_images(images: List[Image], user_id: int) -> None:
+    """
+    Delete the images no item refers to any more, with their files.
+
+    Items share a user's Image rows (see image_store.py), so unlinking an image from an item only
+    deletes it when that was the last item using it.
+
+    :param images: The images just unlinked from an item.
+    :param user_id: The ID of the user owning the images.
+    """
+    if len(images) == 0:
+        return
+    db.session.flush()
+
+    images_directory = user_images_directory(user_id)
+    for image_ in {x.id: x for x in images}.values():
+        number_links = db.session.scalar(select(func.count(ItemImage.id)).where(ItemImage.image_id == image_.id))
+        if number_links > 0:
+            continue
+        try:
+            os.remove(os.path.join(images_directory, image_.image_filename))
+        except OSError as er:
+            app.logger.error(f"Could not delete image file {image_.image_filename}: {er}")
+        remove_derivative_files(images_directory, image_.image_filename, image_.variants)
+        db.session.delete(image_)
+
+
 def find_image_by_filename(image_filename: str, user: User) -> Optional[Image]:
     """
     Args:
@@ -1487,6 +1701,7 @@ def delete_images_from_item(item_id: int, image_ids: List[str], user: User) -> (
         if item_ is None:
             return False, f"No item with id {item_id} found for user {user.username}"
 
+        removed_images = []
         for image_id in image_ids:
             image_ = find_image_by_filename(image_filename=image_id, user=user)
             if image_ is None:
@@ -1496,16 +1711,9 @@ def delete_images_from_item(item_id: int, image_ids: List[str], user: User) -> (
                 if image_.image_filename == item_.main_image:
                     item_.main_image = None
                 item_.images.remove(image_)
+                removed_images.append(image_)
 
-                try:
-                    os.remove(os.path.join(app.root_path,
-                                           app.config['USER_IMAGES_BASE_PATH'],
-                                           str(user.id),
-                                           image_.image_filename))
-                except OSError as er:
-                    err_msg = f"Could not delete image with id {image_id} for user {user.username}: {er}"
-                    app.logger.error(err_msg)
-                    return False, err_msg
+        release_images(images=removed_images, user_id=user.id)
 
         if item_.main_image is None:
             if len(item_.images) == 0:
@@ -1803,15 +2011,10 @@ def delete_item_images_by_item_id(item_id: int, user_id: str):
     with app.app_context():
         item_ = find_item_by_id(item_id=item_id, user_id=user_id)
         if item_ is not None:
-            for image_ in item_.images:
-                try:
-                    os.remove(os.path.join(app.root_path, app.config['USER_IMAGES_BASE_PATH'], user_id,
-                                           image_.image_filename))
-                except OSError as er:
-                    pass
-
+            removed_images = list(item_.images)
             item_.images = []
             item_.main_image = None
+            release_images(images=removed_images, user_id=user_id)
             db.session.commit()
 
 
@@ -1819,24 +2022,16 @@ def delete_item_images(item_: Item, user_id: int) -> (bool, str):
     if item_ is None:
         return False, "Item ID cannot be None"
 
-    with app.app_context():
-        for image_ in item_.images:
-            try:
-                os.remove(os.path.join(app.root_path, app.config['USER_IMAGES_BASE_PATH'], str(user_id),
-                                       image_.image_filename))
-            except OSError as er:
-                app.logger.error(f"Error deleting image file: {image_.image_filename}")
-                app.logger.error(f"Error message: {er}")
-                return False, f"Error deleting image file: {image_.image_filename}"
-
-        item_.images = []
-        item_.main_image = None
-        try:
-            db.session.commit()
-            return True, "Item images deleted successfully"
-        except SQLAlchemyError:
-            db.session.rollback()
-            return False, "Error deleting item images"
+    removed_images = list(item_.images)
+    item_.images = []
+    item_.main_image = None
+    release_images(images=removed_images, user_id=user_id)
+    try:
+        db.session.commit()
+        return True, "Item images deleted successfully"
+    except SQLAlchemyError:
+        db.session.rollback()
+        return False, "Error deleting item images"
 
 
 def get_related_items(item_id: int):
@@ -2048,6 +2243,13 @@ def copy_items(item_ids: list, user: User, inventory_id: int):
                     # log this error
                     return {"status": "error", "count": 0}
 
+                # the copy shares the stored image files of the original
+                if len(item_.images) > 0:
+                    db.session.execute(insert(ItemImage).values(
+                        [{"image_id": x.id, "item_id": new_["item"]["id"]} for x in item_.images]))
+                    db.session.execute(update(Item).where(Item.id == new_["item"]["id"])
+                                       .values(main_image=item_.main_image or item_.images[0].image_filename))
+
             db.session.commit()
             return {"status": "success", "count": len(results_)}
         except Exception as e:
@@ -2428,6 +2630,7 @@ def add_new_template(name: str, fields: str, to_user: User) -> FieldTemplate:
             print(e)
 
 
+@request_memoized
 def get_users_for_inventory(inventory_id: int, current_user_id: int):
     with app.app_context():
         stmt = db.session.query(User, UserInventory.access_level) \
@@ -2533,6 +2736,7 @@ def add_user_to_inventory(inventory_id: int, current_user_id: int, user_to_add_u
             return False
 
 
+@request_memoized
 def get_user_inventory_by_id(user_id: int, inventory_id: int) -> Inventory:
     session = db.session
     stmt = select(UserInventory).where(UserInventory.user_id == user_id) \
@@ -2544,7 +2748,7 @@ def get_user_inventory_by_id(user_id: int, inventory_id: int) -> Inventory:
 
 def save_user_inventory_view(user_id: int, inventory_id: int, view: int):
     with app.app_context():
-        user_inventory_ = get_user_inventory_by_id(user_id=user_id, inventory_id=inventory_id)
+        user_inventory_ = get_user_inventory_by_id.uncached(user_id=user_id, inventory_id=inventory_id)
         if user_inventory_ is not None:
             user_inventory_[0].view = view
             db.session.commit()
@@ -2774,12 +2978,36 @@ def delete_location(user_id: int, location_ids) -> dict:
     return {"success": True}
 
 
+def count_inventory_items(inventory_ids: List[int]) -> Dict[int, int]:
+    """
+    Count the items in each of the given inventories with a single grouped COUNT.
+
+    :param inventory_ids: The IDs of the inventories to count.
+    :return: A dictionary of inventory ID to item count. Inventories without items map to 0.
+    """
+    counts_ = {inventory_id: 0 for inventory_id in inventory_ids}
+    if len(counts_) == 0:
+        return counts_
+
+    stmt = select(InventoryItem.inventory_id, func.count(InventoryItem.id)) \
+        .where(InventoryItem.inventory_id.in_(list(counts_.keys()))) \
+        .group_by(InventoryItem.inventory_id)
+
+    for inventory_id, item_count in db.session.execute(stmt).all():
+        counts_[inventory_id] = item_count
+
+    return counts_
+
+
 def get_user_public_lists(for_user_id: int):
     with app.app_context():
         stmt = db.session.query(Inventory).filter(
-            Inventory.owner_id == for_user_id).filter(Inventory.access_level == __PUBLIC__)
+            Inventory.owner_id == for_user_id).filter(Inventory.access_level == __PUBLIC__) \
+            .options(*INVENTORY_SUMMARY_LOAD)
         r = db.session.execute(stmt).all()
 
+        item_counts_ = count_inventory_items(inventory_ids=[inv[0].id for inv in r])
+
         ret_results = []
 
         for inv in r:
@@ -2791,7 +3019,7 @@ def get_user_public_lists(for_user_id: int):
                 "inventory_slug": inv.slug,
                 "inventory_access_level": inv.access_level,
                 "inventory_owner": inv.owner.username,
-                "inventory_item_count": len(inv.items),
+                "inventory_item_count": item_counts_[inv.id],
                 "inventory_type": inv.type,
                 "userinventory_access_level": __PRIVATE__
             }
@@ -2858,8 +3086,11 @@ def get_user_inventories(current_user_id: int, requesting_user_id: int, access_l
                                            ).filter(Inventory.owner_id == requesting_user_id
                                                     ).filter(Inventory.access_level == 1)
 
+        stmt = stmt.options(*INVENTORY_SUMMARY_LOAD)
         r = db.session.execute(stmt).all()
 
+        item_counts_ = count_inventory_items(inventory_ids=[inv.id for inv, user_inv in r])
+
         ret_results = []
 
         for inv, user_inv in r:
@@ -2870,7 +3101,7 @@ def get_user_inventories(current_user_id: int, requesting_user_id: int, access_l
                 "inventory_slug": inv.slug,
                 "inventory_access_level": inv.access_level,
                 "inventory_owner": inv.owner.username,
-                "inventory_item_count": len(inv.items),
+                "inventory_item_count": item_counts_[inv.id],
                 "inventory_type": inv.type,
                 "inventory_show_default_fields": 1 if inv.show_default_fields else 0,
 
@@ -2885,6 +3116,8 @@ def get_user_inventories(current_user_id: int, requesting_user_id: int, access_l
         return ret_results
 
 
+@request_memoized
+@reference_cached(TEMPLATES, user_arg="user_id")
 def get_user_templates(user_id: int):
     """
     Retrieve the templates associated with a given user.
@@ -3054,6 +3287,43 @@ def get_all_item_fields(item_id: int):
         return ddd
 
 
+def get_export_item_data(item_ids: List[int]) -> Dict[int, dict]:
+    """
+    Load the custom field values and related items of a batch of items for the export.
+
+    Two set-based queries for the whole batch instead of get_item_fields and get_related_items
+    for every item. Tags and images come with the items themselves (ITEM_EXPORT_LOAD).
+
+    :param item_ids: The ids of the items being exported.
+    :return: A dictionary of item id to {"custom_fields": {field slug: value},
+             "related_items": {item id: related item id}}.
+    """
+    export_data = {item_id: {"custom_fields": {}, "related_items": {}} for item_id in item_ids}
+    if len(item_ids) == 0:
+        return export_data
+
+    with app.app_context():
+        # only fields that are part of a field template are exported, as with get_item_fields
+        fields_stmt = select(ItemField.item_id, Field.slug, ItemField.value) \
+            .join(Field, ItemField.field_id == Field.id) \
+            .join(TemplateField, TemplateField.field_id == Field.id) \
+            .filter(ItemField.item_id.in_(item_ids)) \
+            .filter(ItemField.show == True)
+        for item_id, field_slug, field_value in db.session.execute(fields_stmt):
+            export_data[item_id]["custom_fields"][field_slug] = field_value
+
+        related_stmt = select(Relateditems.item_id, Relateditems.related_item_id) \
+            .filter(or_(Relateditems.item_id.in_(item_ids), Relateditems.related_item_id.in_(item_ids)))
+        for item_id, related_item_id in db.session.execute(related_stmt):
+            for id_ in (item_id, related_item_id):
+                if id_ in export_data:
+                    export_data[id_]["related_items"][item_id] = related_item_id
+
+    return export_data
+
+
+@request_memoized
+@reference_cached(FIELDS)
 def get_all_fields():
     """
     Returns a list of all fields from the database.
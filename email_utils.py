@@ -3,6 +3,7 @@ from threading import Thread
 from flask import render_template
 from flask_mail import Message
 from app import app, mail
+from metrics import EMAILS_QUEUED, EMAILS_SENT
 
 
 def threading(f):
@@ -13,15 +14,25 @@ def threading(f):
 
 
 @threading
+def _send_email(subject, sender, recipients, text_body, html_body):
+    try:
+        with app.app_context():
+            msg = Message(subject, sender=sender, recipients=recipients)
+            msg.body = text_body
+            msg.html = html_body
+            mail.send(msg)
+    except Exception:
+        EMAILS_SENT.inc("failed")
+        raise
+    EMAILS_SENT.inc("sent")
+
+
 def send_email(subject, sender=None, recipients=None, text_body=None, html_body=None):
     if sender is None:
         sender = app.config['ADMINS'][0]
 
-    with app.app_context():
-        msg = Message(subject, sender=sender, recipients=recipients)
-        msg.body = text_body
-        msg.html = html_body
-        mail.send(msg)
+    EMAILS_QUEUED.inc()
+    _send_email(subject, sender, recipients, text_body, html_body)
 
 
 def inventory_invite_email(user, token: str):
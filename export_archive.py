@@ -0,0 +1,224 @@
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import tempfile
+import zipfile
+from typing import Iterator, Optional
+
+from app import app
+from image_store import store_file
+
+# Archive export format
+#
+# A zip file holding:
+#   images/<item id>/<image filename>   the raw image files
+#   manifest.jsonl                      one JSON record per line, see below
+#   manifest.jsonl.hmac                 the HMAC of manifest.jsonl
+#
+# The first manifest record is {"record": "archive", "version": ARCHIVE_VERSION}. The others are
+# {"record": "inventory", "key": ..., <inventory details>} and
+# {"record": "item", "inventory": <inventory key>, <item details>, "images": [...]}. The items of an
+# inventory are consecutive. Each image entry names its archive file and carries the file's HMAC.
+# HMACs are SHA-256 with IMAGE_SECRET_KEY, hex encoded.
+
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = "manifest.jsonl"
+MANIFEST_HMAC_NAME = "manifest.jsonl.hmac"
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+
+def _new_hmac():
+    return hmac.new(app.config['IMAGE_SECRET_KEY'].encode('utf-8'), digestmod=hashlib.sha256)
+
+
+class _ChunkBuffer:
+    """Write-only file object collecting what zipfile writes so it can be yielded as it is produced."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ArchiveWriter:
+    """
+    Write an export archive as a stream of bytes chunks.
+
+    Images are copied into the archive as they are added; manifest records are spooled to a
+    temporary file and written into the archive by finish(). Every method returns an iterator
+    of the bytes produced so far, to be yielded by the response generator.
+    """
+
+    def __init__(self):
+        self._buffer = _ChunkBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, mode="w", compression=zipfile.ZIP_STORED)
+        self._manifest = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+b")
+        self._entries = {}
+        self.last_entry = None
+
+        self.add_record({"record": "archive", "version": ARCHIVE_VERSION})
+
+    def _drain(self) -> Iterator[bytes]:
+        data = self._buffer.take()
+        if data:
+            yield data
+
+    def add_record(self, record: dict) -> None:
+        """Append a record to the manifest."""
+        self._manifest.write(json.dumps(record).encode("utf-8") + b"\n")
+
+    def add_image(self, item_id: int, image_filename: str, image_path: str) -> Iterator[bytes]:
+        """
+        Copy an image file into the archive, in chunks.
+
+        Sets self.last_entry to {"file": <archive name>, "hmac": <hex digest>} for the manifest.
+        """
+        name = f"images/{item_id}/{image_filename}"
+        if name in self._entries:
+            self.last_entry = self._entries[name]
+            return
+
+        digest = _new_hmac()
+        with open(image_path, "rb") as image_file, self._zip.open(name, mode="w", force_zip64=True) as entry:
+            while True:
+                chunk = image_file.read(ARCHIVE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                entry.write(chunk)
+                yield from self._drain()
+
+        self.last_entry = {"file": name, "hmac": digest.hexdigest()}
+        self._entries[name] = self.last_entry
+        yield from self._drain()
+
+    def finish(self) -> Iterator[bytes]:
+        """Write the manifest and its HMAC, and close the archive."""
+        digest = _new_hmac()
+        self._manifest.seek(0)
+        manifest_info = zipfile.ZipInfo(MANIFEST_NAME)
+        manifest_info.compress_type = zipfile.ZIP_DEFLATED
+        with self._zip.open(manifest_info, mode="w", force_zip64=True) as entry:
+            while True:
+                chunk = self._manifest.read(ARCHIVE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                entry.write(chunk)
+                yield from self._drain()
+        self._manifest.close()
+
+        self._zip.writestr(MANIFEST_HMAC_NAME, digest.hexdigest())
+        self._zip.close()
+        yield from self._drain()
+
+
+def is_archive(filepath: str) -> bool:
+    return zipfile.is_zipfile(filepath)
+
+
+def _manifest_records(archive: zipfile.ZipFile) -> Iterator[dict]:
+    with archive.open(MANIFEST_NAME) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def verify_manifest(archive: zipfile.ZipFile) -> bool:
+    """Check the manifest against its HMAC, reading it in chunks."""
+    try:
+        expected = archive.read(MANIFEST_HMAC_NAME).decode("utf-8").strip()
+        digest = _new_hmac()
+        with archive.open(MANIFEST_NAME) as manifest:
+            while True:
+                chunk = manifest.read(ARCHIVE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except KeyError:
+        return False
+    return hmac.compare_digest(digest.hexdigest(), expected)
+
+
+def read_archive_inventories(archive: zipfile.ZipFile) -> Iterator[dict]:
+    """
+    Read the inventories of an archive in the shape of the JSON export: {"inventory": {..., "items": ...}}.
+
+    The items of each inventory are a generator reading the manifest lazily, so an inventory's
+    items must be consumed (or skipped) before moving on to the next inventory.
+    """
+    inventories = {}
+    inventories_seen = set()
+    for record in _manifest_records(archive):
+        if record.get("record") == "inventory":
+            inventories[record["key"]] = record
+
+    def _inventory(key_, items_):
+        inventory_data = {k: v for k, v in inventories.get(key_, {}).items() if k not in ("record", "key")}
+        inventory_data["items"] = items_
+        return {"inventory": inventory_data}
+
+    item_records = (x for x in _manifest_records(archive) if x.get("record") == "item")
+    for key, items in itertools.groupby(item_records, key=lambda x: x.get("inventory")):
+        inventories_seen.add(key)
+        yield _inventory(key, items)
+
+    # inventories without any items
+    for key in inventories.keys():
+        if key not in inventories_seen:
+            yield _inventory(key, [])
+
+
+def extract_image(archive: zipfile.ZipFile, image_entry: dict, directory: str) -> Optional[str]:
+    """
+    Copy an image out of the archive into the user's image store if its HMAC matches, in chunks.
+
+    The content hash is computed in the same pass as the HMAC, so an image the user already has
+    (e.g. when re-importing an export) is not written again.
+
+    :param directory: The directory of the user's images.
+    :return: The store filename of the image if it was verified, otherwise None.
+    """
+    name = image_entry.get("file", None)
+    expected = image_entry.get("hmac", None)
+    if name is None or expected is None:
+        return None
+
+    extension = os.path.splitext(name)[1].lstrip(".").lower() or "jpg"
+    try:
+        digest = _new_hmac()
+        content_digest = hashlib.sha256()
+        with archive.open(name) as entry:
+            while True:
+                chunk = entry.read(ARCHIVE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                content_digest.update(chunk)
+        if not hmac.compare_digest(digest.hexdigest(), expected):
+            app.logger.error(f"Import: image {name} failed its HMAC check")
+            return None
+
+        with archive.open(name) as entry:
+            return store_file(entry, content_digest.hexdigest(), directory, extension=extension)
+    except (KeyError, OSError) as e:
+        app.logger.error(f"Import: could not extract image {name}: {str(e)}")
+        return None
@@ -0,0 +1,136 @@
+import hashlib
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+from flask import g, request, session, Response
+
+from app import app
+from assets import is_fingerprinted
+from image_store import is_content_filename
+
+# HTTP caching policies
+#
+# Every response gets the Cache-Control of one policy, chosen in add_headers (run_server.py):
+#   NO_STORE    the default: pages and API responses that are private to the user, never stored
+#   REVALIDATE  pages anyone may see (public inventories) and API responses with an ETag of their
+#               own; stored by the browser only, revalidated on every use, so an unchanged response
+#               costs a 304
+#   STATIC      files under /static, cached for STATIC_CACHE_MAX_AGE seconds and then revalidated
+#   IMMUTABLE   fingerprinted static files (see assets.py, or with a "v" query argument), cached for a year
+#   USER_IMAGE  user images served from USER_IMAGES_BASE_URL, cached for IMAGE_CACHE_MAX_AGE seconds;
+#               content-addressed images (see image_store.py) never change and are immutable
+# Views pick a policy other than the default with set_cache_policy. Static files get theirs from
+# the path.
+
+NO_STORE = "no-store"
+REVALIDATE = "revalidate"
+STATIC = "static"
+IMMUTABLE = "immutable"
+USER_IMAGE = "user_image"
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def set_cache_policy(policy: str) -> None:
+    """Set the caching policy of the response to the current request."""
+    g.cache_policy = policy
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """
+    A 304 response if the request already has the version of the response with this ETag, else None.
+    Views able to compute their ETag up front call this before doing the work of the response, and
+    set the ETag on the response they return.
+    """
+    set_cache_policy(REVALIDATE)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def _user_images_path() -> Optional[str]:
+    """The URL path user images are served under, if they are served by this application."""
+    base_url = app.config['USER_IMAGES_BASE_URL']
+    if not base_url:
+        return None
+    parsed = urlparse(base_url)
+    if parsed.netloc and parsed.netloc != request.host:
+        return None
+    return parsed.path.rstrip("/") + "/"
+
+
+def _request_policy() -> str:
+    policy = g.get("cache_policy", None)
+    if policy is not None:
+        return policy
+
+    if request.endpoint != 'static':
+        return NO_STORE
+
+    images_path = _user_images_path()
+    if images_path is not None and request.path.startswith(images_path):
+        return USER_IMAGE
+    if is_fingerprinted((request.view_args or {}).get("filename")) or request.args.get("v"):
+        return IMMUTABLE
+    return STATIC
+
+
+def _page_etag(response) -> str:
+    """
+    The ETag of a rendered page. Pages embed a CSRF token signed with the current time, so the token
+    is left out of the hash; the session's own token and the token's validity period go in instead,
+    so a page is never reused with a token that no longer validates.
+    """
+    data = response.get_data()
+    signed_token = g.get("csrf_token", None)
+    if signed_token:
+        data = data.replace(signed_token.encode("utf-8"), b"")
+
+    digest = hashlib.sha1(data)
+    raw_token = session.get("csrf_token", None)
+    if raw_token:
+        time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or IMMUTABLE_MAX_AGE
+        digest.update(f"{raw_token}:{int(time.time() // max(time_limit // 2, 1))}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def apply_cache_policy(response):
+    """
+    Set the caching headers of a response according to its policy, answering conditional requests
+    for pages with a 304.
+    """
+    policy = _request_policy()
+
+    # errors and redirects are never stored
+    if policy != NO_STORE and response.status_code not in (200, 304):
+        policy = NO_STORE
+
+    if policy == REVALIDATE and (request.method != "GET" or response.is_streamed or response.direct_passthrough):
+        policy = NO_STORE
+
+    if policy == NO_STORE:
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+    elif policy == REVALIDATE:
+        # pages carry the viewer's session, shared caches must not keep them
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        if response.get_etag()[0] is None:
+            response.set_etag(_page_etag(response))
+        response.make_conditional(request)
+    elif policy == IMMUTABLE:
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    elif policy == USER_IMAGE:
+        filename = request.path[len(_user_images_path()):].split("/", 1)[-1]
+        if is_content_filename(filename):
+            response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = f"public, max-age={int(app.config['IMAGE_CACHE_MAX_AGE'])}"
+    else:
+        response.headers['Cache-Control'] = f"public, max-age={int(app.config['STATIC_CACHE_MAX_AGE'])}"
+
+    return response
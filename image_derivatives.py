@@ -0,0 +1,203 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app import app
+from metrics import IMAGES_QUEUED, IMAGES_REJECTED, IMAGE_PROCESSING
+from utils import write_image_derivatives, write_image_derivatives_from_file
+
+# Image derivatives
+#
+# Every uploaded image is stored in several sizes, configured by IMAGE_DERIVATIVES as
+# "name:max_px,..." (the defaults are thumb, grid, masonry and full). The image file itself is the
+# upload as it was uploaded (see image_store.py); each variant, "full" included, is written next to
+# it as <stem>_<name>.jpg. With IMAGE_WEBP set each variant is also written as <stem>_<name>.webp.
+# Images stored before "full" was a variant of its own have their full size JPEG as the image file.
+#
+# The variants written for an image are recorded as JSON in Image.variants:
+#   {"<name>": {"file": ..., "width": ..., "height": ..., "webp": <file or null>}, ...}
+# An upload waiting for a worker has no variants yet, {} (PENDING_VARIANTS). Images never processed,
+# stored before derivatives existed or imported, have NULL. Pages build their URLs from this column
+# alone, they do not look at the files.
+#
+# Uploads are decoded and resized by a pool of IMAGE_WORKERS processes, so the work does not hold
+# the web process's GIL. Until the worker has written an image's files the pages show a placeholder.
+
+FULL = "full"
+PENDING_VARIANTS = "{}"
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+
+
+def derivative_sizes() -> List[Tuple[str, int]]:
+    """The configured derivatives as (name, max size in pixels), largest first."""
+    sizes = []
+    for entry in str(app.config['IMAGE_DERIVATIVES']).split(","):
+        if ":" not in entry:
+            continue
+        name, size = entry.split(":", 1)
+        sizes.append((name.strip(), int(size)))
+    return sorted(sizes, key=lambda x: x[1], reverse=True)
+
+
+def generate_derivatives(image_data: bytes, image_filename: str, directory: str,
+                         keep_full: bool = False) -> Dict[str, dict]:
+    """
+    Decode an image once and write all of its configured derivatives, in this process.
+
+    :param image_data: The uploaded image file.
+    :param image_filename: The filename of the image, in directory.
+    :param directory: The directory of the user's images.
+    :param keep_full: The image file is the full size JPEG, see utils.write_image_derivatives.
+    :return: The variants written, in the Image.variants shape.
+    """
+    return write_image_derivatives(image_data=image_data, image_filename=image_filename, directory=directory,
+                                   sizes=derivative_sizes(), write_webp=bool(app.config['IMAGE_WEBP']),
+                                   keep_full=keep_full)
+
+
+def _get_executor() -> Tuple[ProcessPoolExecutor, threading.BoundedSemaphore]:
+    """The worker pool and the semaphore of its queue slots."""
+    global _executor, _slots
+
+    with _executor_lock:
+        if _executor is None:
+            # spawned, not forked: the web process has threads of its own
+            _executor = ProcessPoolExecutor(max_workers=int(app.config['IMAGE_WORKERS']),
+                                            mp_context=multiprocessing.get_context("spawn"))
+            _slots = threading.BoundedSemaphore(int(app.config['IMAGE_QUEUE_LIMIT']))
+        return _executor, _slots
+
+
+def _drop_executor(broken: ProcessPoolExecutor) -> None:
+    """Forget a pool that broke (a worker was killed), so the next upload starts a new one."""
+    global _executor, _slots
+
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+            _slots = None
+    broken.shutdown(wait=False)
+
+
+def submit_derivatives(image_filename: str, directory: str, on_done: Callable[[Optional[dict]], None]) -> bool:
+    """
+    Queue a stored upload for the image worker processes.
+
+    At most IMAGE_QUEUE_LIMIT uploads are queued or being processed at once. When the queue is full
+    this waits up to IMAGE_QUEUE_TIMEOUT seconds for a slot and then gives up.
+
+    :param image_filename: The filename of the uploaded image, in directory.
+    :param directory: The directory of the user's images.
+    :param on_done: Called from a background thread with the variants written, or None if the
+                    image could not be processed.
+    :return: True if the upload was queued, False if the queue is full. Raises if the upload could
+             not be handed to the workers.
+    """
+    # a pool whose worker was killed (e.g. out of memory on a large image) refuses all work, the
+    # upload is retried once on a new pool
+    for attempt in range(2):
+        executor, slots = _get_executor()
+        if not slots.acquire(timeout=float(app.config['IMAGE_QUEUE_TIMEOUT'])):
+            IMAGES_REJECTED.inc()
+            return False
+
+        try:
+            future = executor.submit(write_image_derivatives_from_file, image_filename=image_filename,
+                                     directory=directory, sizes=derivative_sizes(),
+                                     write_webp=bool(app.config['IMAGE_WEBP']))
+        except BrokenProcessPool:
+            slots.release()
+            _drop_executor(executor)
+            if attempt > 0:
+                raise
+            app.logger.error("The image worker pool broke, starting a new one")
+            continue
+        except Exception:
+            slots.release()
+            raise
+        break
+    IMAGES_QUEUED.inc()
+    queued_at = time.perf_counter()
+
+    def _done(future_):
+        slots.release()
+        try:
+            variants = future_.result()
+            IMAGE_PROCESSING.observe(time.perf_counter() - queued_at, "done")
+        except Exception as e:
+            IMAGE_PROCESSING.observe(time.perf_counter() - queued_at, "failed")
+            app.logger.error(f"Could not process image {image_filename}: {str(e)}")
+            variants = None
+        try:
+            on_done(variants)
+        except Exception as e:
+            app.logger.error(f"Could not record the derivatives of image {image_filename}: {str(e)}")
+
+    future.add_done_callback(_done)
+    return True
+
+
+def parse_variants(variants_json: Optional[str]) -> Dict[str, dict]:
+    if not variants_json:
+        return {}
+    try:
+        return json.loads(variants_json)
+    except ValueError:
+        return {}
+
+
+def derivative_files(image_filename: str, variants_json: Optional[str]) -> List[str]:
+    """All files of an image's derivatives, apart from the image file itself."""
+    files = set()
+    for variant in parse_variants(variants_json).values():
+        files.add(variant.get("file"))
+        files.add(variant.get("webp"))
+    files.discard(None)
+    files.discard(image_filename)
+    return sorted(files)
+
+
+def remove_derivative_files(directory: str, image_filename: str, variants_json: Optional[str]) -> None:
+    """Delete the derivative files of an image, ignoring files that are already gone."""
+    for filename in derivative_files(image_filename, variants_json):
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            pass
+
+
+def image_variant_url(base_url: str, image_filename: str, variants_json: Optional[str], size: str = None,
+                      extension: str = None, placeholder_url: str = None) -> Optional[str]:
+    """
+    The URL of a derivative of an image, from the variants recorded for it.
+
+    Images without variants only have their own file; for those the URL of the image itself is
+    returned, or None when asking for WebP. Uploads still waiting for a worker get placeholder_url.
+
+    :param variants_json: The image's Image.variants.
+    :param size: The name of the derivative, defaults to "full". Sizes the image was not generated
+                 in fall back to "full".
+    :param extension: "webp" for the WebP file of the derivative.
+    """
+    if variants_json is None:
+        return None if extension is not None else f"{base_url}/{image_filename}"
+
+    variants = parse_variants(variants_json)
+    if len(variants) == 0:
+        if extension is not None:
+            return None
+        return placeholder_url if placeholder_url is not None else f"{base_url}/{image_filename}"
+
+    variant = variants.get(size or FULL) or variants.get(FULL)
+    if variant is None:
+        return None if extension is not None else f"{base_url}/{image_filename}"
+    filename = variant.get("file") if extension is None else variant.get(extension)
+    return f"{base_url}/{filename}" if filename is not None else None
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Tuple
+
+from app import app
+
+# Content-addressed image store
+#
+# Image files are named after the SHA-256 of their content and sharded into two levels of
+# directories under the user's image directory (user_images_directory):
+#   USER_IMAGES_BASE_PATH/<user id>/<h[0:2]>/<h[2:4]>/<h>.jpg
+# A relative USER_IMAGES_BASE_PATH is below the application's root, not the working directory.
+# Image.image_filename holds the path below the user's directory ("ab/cd/abcd....jpg"), so URLs
+# and derivative names (see image_derivatives.py) work unchanged. Files written before the store
+# existed keep their old flat names.
+#
+# A user stores each distinct file once, in one Image row; items share it through item_images, and
+# the file is only deleted when the last item lets go of it (see release_image in
+# database_functions). A stored file holds exactly the bytes it is named after: an upload is kept as
+# uploaded and its resized copies, "full" included, are written next to it as derivatives. An export
+# carries those bytes, so importing it again finds the images the user already has.
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def user_images_base_directory() -> str:
+    """The directory holding every user's image directory."""
+    return os.path.join(app.root_path, app.config['USER_IMAGES_BASE_PATH'])
+
+
+def user_images_directory(user_id) -> str:
+    """The directory of a user's images."""
+    return os.path.join(user_images_base_directory(), str(user_id))
+
+
+def content_filename(digest: str, extension: str = "jpg") -> str:
+    """The store filename of content with a hex digest."""
+    return f"{digest[0:2]}/{digest[2:4]}/{digest}.{extension}"
+
+
+def is_content_filename(image_filename: str) -> bool:
+    return image_filename.count("/") == 2
+
+
+def ensure_directory(directory: str, image_filename: str) -> str:
+    """
+    Create the shard directories of a store filename.
+
+    :return: The full path of the file.
+    """
+    path = os.path.join(directory, image_filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def stage_upload(upload_file: BinaryIO, directory: str) -> Tuple[str, str]:
+    """
+    Copy an upload to a temporary file in the user's directory, hashing it on the way.
+
+    :return: The path of the staged file and the hex digest of its content.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".", suffix=".upload", delete=False) as staged_file:
+        while True:
+            chunk = upload_file.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            staged_file.write(chunk)
+    return staged_file.name, digest.hexdigest()
+
+
+def store_staged(staged_path: str, digest: str, directory: str, extension: str = "jpg") -> Tuple[str, bool]:
+    """
+    Move a staged upload to its store filename, or delete it if the user already has the content.
+
+    :return: The store filename of the content and whether the file is new.
+    """
+    image_filename = content_filename(digest, extension=extension)
+    path = ensure_directory(directory, image_filename)
+    if os.path.exists(path):
+        os.remove(staged_path)
+        return image_filename, False
+    os.replace(staged_path, path)
+    return image_filename, True
+
+
+def store_bytes(data: bytes, directory: str, extension: str = "jpg") -> str:
+    """
+    Store content unless the user already has it.
+
+    :return: The store filename of the content.
+    """
+    image_filename = content_filename(hash_bytes(data), extension=extension)
+    path = ensure_directory(directory, image_filename)
+    if not os.path.exists(path):
+        partial_path = f"{path}.part"
+        with open(partial_path, "wb") as image_file:
+            image_file.write(data)
+        os.replace(partial_path, path)
+    return image_filename
+
+
+def store_file(source: BinaryIO, digest: str, directory: str, extension: str = "jpg") -> str:
+    """
+    Store the content of a file object whose digest is already known, unless the user already has it.
+
+    :return: The store filename of the content.
+    """
+    image_filename = content_filename(digest, extension=extension)
+    path = ensure_directory(directory, image_filename)
+    if not os.path.exists(path):
+        partial_path = f"{path}.part"
+        with open(partial_path, "wb") as image_file:
+            shutil.copyfileobj(source, image_file, HASH_CHUNK_SIZE)
+        os.replace(partial_path, path)
+    return image_filename
@@ -0,0 +1,131 @@
+import hashlib
+from typing import Iterable, Optional
+
+from sqlalchemy import event, select, update, func
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session
+
+from app import db
+from models import Inventory, InventoryItem, Item, ItemTag, ItemField, ItemImage, Location, ItemType, UserInventory
+
+# Inventory versions
+#
+# Inventory.version goes up by one in every transaction that changes what the inventory's item list
+# shows: items added, edited, moved, copied, linked or deleted, their tags and fields, and the names
+# of their owner's locations and item types. The items API derives its ETags from it (see
+# items_api_etag), so a client asking for a page that has not changed gets a 304 without the item
+# tables being read.
+#
+# Changes made through the ORM bump the versions automatically, in the same transaction, from the
+# flush events below. Code writing items with Core statements calls bump_inventory_versions itself.
+
+_PENDING_KEY = 'inventory_versions_pending'
+
+# link rows naming the item they belong to
+_ITEM_LINK_MODELS = (ItemTag, ItemField, ItemImage)
+# rows shown by name in the item lists of their user's inventories
+_OWNER_MODELS = (Location, ItemType)
+
+
+def bump_inventory_versions(connection, inventory_ids: Iterable[int] = (), item_ids: Iterable[int] = (),
+                            owner_ids: Iterable[int] = ()) -> None:
+    """
+    Bump the versions of inventories, in the transaction of connection.
+
+    :param connection: A session or connection.
+    :param inventory_ids: Inventories that changed.
+    :param item_ids: Items that changed; the inventories they are in are bumped.
+    :param owner_ids: Users whose inventories all changed.
+    """
+    inventory_ids = set(x for x in inventory_ids if x is not None)
+    item_ids = set(x for x in item_ids if x is not None)
+    owner_ids = set(x for x in owner_ids if x is not None)
+
+    if len(item_ids) > 0:
+        rows = connection.execute(select(InventoryItem.inventory_id).distinct()
+                                  .where(InventoryItem.item_id.in_(sorted(item_ids))))
+        inventory_ids.update(x for x, in rows)
+
+    table_ = Inventory.__table__
+    if len(inventory_ids) > 0:
+        connection.execute(update(table_).where(table_.c.id.in_(sorted(inventory_ids)))
+                           .values(version=table_.c.version + 1))
+    if len(owner_ids) > 0:
+        connection.execute(update(table_).where(table_.c.owner_id.in_(sorted(owner_ids)))
+                           .values(version=table_.c.version + 1))
+
+
+def inventory_version(inventory_id: Optional[int], user_id: int) -> str:
+    """
+    The version of an inventory, or with inventory_id None of all the user's inventories together: the
+    sum of their versions and their number, which changes whenever any of them changes.
+    """
+    if inventory_id is not None:
+        version = db.session.execute(select(Inventory.version).where(Inventory.id == inventory_id)).scalar()
+        return str(version)
+
+    total, number = db.session.execute(
+        select(func.coalesce(func.sum(Inventory.version), 0), func.count(Inventory.id))
+        .join(UserInventory, UserInventory.inventory_id == Inventory.id)
+        .where(UserInventory.user_id == user_id)).one()
+    return f"{total}.{number}"
+
+
+def items_api_etag(inventory_id: Optional[int], user_id: int, args) -> str:
+    """
+    The ETag of an items API response: the inventory version, the user asking and the query. The draw
+    counter DataTables may send only numbers requests and is left out.
+    """
+    digest = hashlib.sha1(f"{inventory_version(inventory_id, user_id)}:{inventory_id}:{user_id}".encode("utf-8"))
+    for key, value in sorted(args.items(multi=True)):
+        if key not in ("draw", "_"):
+            digest.update(f"\n{key}={value}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _is_changed(session, obj) -> bool:
+    return obj in session.new or obj in session.deleted or session.is_modified(obj)
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_deleted_items(session, flush_context, instances):
+    # the links of deleted items go in this flush, find their inventories while they are there
+    item_ids = [x.id for x in session.deleted if isinstance(x, Item) and x.id is not None]
+    if len(item_ids) > 0:
+        rows = session.connection().execute(select(InventoryItem.inventory_id).distinct()
+                                            .where(InventoryItem.item_id.in_(item_ids)))
+        session.info.setdefault(_PENDING_KEY, set()).update(x for x, in rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_changed_inventories(session, flush_context):
+    inventory_ids = session.info.pop(_PENDING_KEY, set())
+    item_ids = set()
+    owner_ids = set()
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Item):
+            if obj not in session.deleted and _is_changed(session, obj):
+                item_ids.add(obj.id)
+        elif isinstance(obj, InventoryItem):
+            if _is_changed(session, obj):
+                # a move changes inventory_id, both inventories changed
+                history = sa_inspect(obj).attrs.inventory_id.history
+                inventory_ids.update(list(history.deleted or []) + [obj.inventory_id])
+        elif isinstance(obj, Inventory):
+            if _is_changed(session, obj):
+                inventory_ids.add(obj.id)
+        elif isinstance(obj, _ITEM_LINK_MODELS):
+            item_ids.add(obj.item_id)
+        elif isinstance(obj, _OWNER_MODELS):
+            if _is_changed(session, obj):
+                owner_ids.add(obj.user_id)
+
+    if len(inventory_ids) > 0 or len(item_ids) > 0 or len(owner_ids) > 0:
+        bump_inventory_versions(session.connection(), inventory_ids=inventory_ids, item_ids=item_ids,
+                                owner_ids=owner_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_versions(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,305 @@
+import datetime
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import update
+
+from app import db, app
+from models import Job
+
+# Background jobs
+#
+# Long running work (imports, exports, bulk deletes) is recorded in the jobs table and run by a
+# thread pool in the web process; the browser polls the job until it is done. The table is the
+# only shared state, so this works the same against SQLite and MySQL without a broker.
+#
+# A running job's updated_at is its heartbeat: progress writes it, and so does a thread of the
+# process running it every _HEARTBEAT_SECONDS for handlers that go a while without progress. A job
+# whose heartbeat is older than JOB_HEARTBEAT_TIMEOUT_SECONDS was running in a process that died;
+# it is failed when it is polled, when a job is submitted and when the server starts.
+#
+# Result files (exports) are kept for JOB_RESULT_TTL_HOURS, then deleted when the next job is
+# submitted or the server starts.
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# progress is written to the database at most this often
+_PROGRESS_INTERVAL_SECONDS = 1.0
+# the updated_at of jobs running in this process is written at least this often
+_HEARTBEAT_SECONDS = 15.0
+
+_handlers: Dict[str, Callable] = {}
+_executor = None
+_executor_lock = threading.Lock()
+_table_checked = False
+# the ids of the jobs running in this process
+_running_ids = set()
+_running_lock = threading.Lock()
+
+
+def job_handler(kind: str):
+    """
+    Register a function running jobs of a kind.
+
+    The function is called as handler(job, **params) inside an application context, where job is a
+    JobContext. Whatever string it returns becomes the job's final message.
+    """
+    def decorator(f):
+        _handlers[kind] = f
+        return f
+    return decorator
+
+
+class JobContext:
+    """Handed to a job handler to report progress and to name its result file."""
+
+    def __init__(self, job_id: int, user_id: int):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.result_filename = None
+        self._last_progress = 0.0
+
+    def progress(self, done: int, total: int = None, message: str = None, force: bool = False) -> None:
+        """Record the progress of the job, throttled to _PROGRESS_INTERVAL_SECONDS. Also a heartbeat."""
+        now = time.monotonic()
+        if not force and now - self._last_progress < _PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_progress = now
+
+        values = {"progress": done, "updated_at": datetime.datetime.now()}
+        if total is not None:
+            values["total"] = total
+        if message is not None:
+            values["message"] = message
+        _update_job(self.job_id, **values)
+
+    def result_path(self, filename: str) -> str:
+        """
+        The path to write the job's downloadable result to.
+
+        :param filename: The filename the user downloads the result as.
+        """
+        self.result_filename = filename
+        return _result_path(self.job_id, filename)
+
+
+def _results_directory() -> str:
+    directory = app.config['JOB_RESULTS_DIRECTORY']
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def _result_path(job_id: int, filename: str) -> str:
+    return os.path.join(_results_directory(), f"{job_id}-{os.path.basename(filename)}")
+
+
+def _result_expired(path: str) -> bool:
+    ttl_seconds = float(app.config['JOB_RESULT_TTL_HOURS']) * 3600
+    return os.path.getmtime(path) < time.time() - ttl_seconds
+
+
+def remove_expired_results() -> int:
+    """
+    Delete the result files written more than JOB_RESULT_TTL_HOURS ago.
+
+    :return: The number of files deleted.
+    """
+    directory = _results_directory()
+    removed = 0
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            if os.path.isfile(path) and _result_expired(path):
+                os.remove(path)
+                removed += 1
+        except OSError as e:
+            app.logger.error(f"Could not remove job result {path}: {str(e)}")
+    return removed
+
+
+def _ensure_job_table():
+    global _table_checked
+
+    if not _table_checked:
+        Job.__table__.create(db.engine, checkfirst=True)
+        _table_checked = True
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=int(app.config['JOB_WORKERS']),
+                                               thread_name_prefix="job-worker")
+                threading.Thread(target=_heartbeat, name="job-heartbeat", daemon=True).start()
+    return _executor
+
+
+def _heartbeat() -> None:
+    while True:
+        time.sleep(_HEARTBEAT_SECONDS)
+        with _running_lock:
+            job_ids = list(_running_ids)
+        if len(job_ids) == 0:
+            continue
+        try:
+            with app.app_context():
+                db.session.execute(update(Job).where(Job.id.in_(job_ids)).where(Job.status == JOB_RUNNING)
+                                   .values(updated_at=datetime.datetime.now()))
+                db.session.commit()
+        except Exception as e:
+            app.logger.error(f"Could not record the heartbeat of jobs {job_ids}: {str(e)}")
+
+
+def _stale_before() -> datetime.datetime:
+    return datetime.datetime.now() - datetime.timedelta(seconds=float(app.config['JOB_HEARTBEAT_TIMEOUT_SECONDS']))
+
+
+def fail_stale_jobs(job_id: int = None) -> int:
+    """
+    Fail the running jobs whose heartbeat stopped, see above.
+
+    :param job_id: Only check this job.
+    :return: The number of jobs failed.
+    """
+    with app.app_context():
+        _ensure_job_table()
+        query_ = update(Job).where(Job.status == JOB_RUNNING).where(Job.updated_at < _stale_before())
+        if job_id is not None:
+            query_ = query_.where(Job.id == job_id)
+        result = db.session.execute(query_.values(status=JOB_FAILED,
+                                                  message="The job was interrupted, please try again.",
+                                                  updated_at=datetime.datetime.now()))
+        db.session.commit()
+        return result.rowcount
+
+
+def _update_job(job_id: int, **values) -> None:
+    with app.app_context():
+        db.session.execute(update(Job).where(Job.id == job_id).values(**values))
+        db.session.commit()
+
+
+def submit_job(kind: str, user_id: int, params: dict = None) -> int:
+    """
+    Record a new job and queue it on the worker pool.
+
+    :param kind: The kind of job, registered with job_handler.
+    :param user_id: The id of the user the job runs for.
+    :param params: The JSON serialisable keyword arguments of the handler.
+    :return: The id of the job.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"No handler for job kind {kind}")
+
+    fail_stale_jobs()
+    with app.app_context():
+        job_ = Job(kind=kind, user_id=user_id, status=JOB_QUEUED, params=json.dumps(params or {}))
+        db.session.add(job_)
+        db.session.commit()
+        job_id = job_.id
+
+    _get_executor().submit(_run_job, job_id)
+    remove_expired_results()
+    return job_id
+
+
+def _run_job(job_id: int) -> None:
+    with app.app_context():
+        # claim the job, so a job is only ever run once even if it was queued twice
+        claimed = db.session.execute(update(Job).where(Job.id == job_id).where(Job.status == JOB_QUEUED)
+                                     .values(status=JOB_RUNNING, updated_at=datetime.datetime.now()))
+        db.session.commit()
+        if claimed.rowcount != 1:
+            return
+
+        job_ = db.session.get(Job, job_id)
+        kind, user_id, params = job_.kind, job_.user_id, json.loads(job_.params or "{}")
+
+    context = JobContext(job_id=job_id, user_id=user_id)
+    with _running_lock:
+        _running_ids.add(job_id)
+    try:
+        with app.app_context():
+            message = _handlers[kind](context, **params)
+        _update_job(job_id, status=JOB_DONE, message=message, result_filename=context.result_filename,
+                    updated_at=datetime.datetime.now())
+    except Exception as e:
+        app.logger.error(f"Job {job_id} ({kind}) for user {user_id} failed: {str(e)}\n{traceback.format_exc()}")
+        _update_job(job_id, status=JOB_FAILED, message="Sorry, there was an error running this job.",
+                    updated_at=datetime.datetime.now())
+    finally:
+        with _running_lock:
+            _running_ids.discard(job_id)
+
+
+def get_job(job_id: int, user_id: int) -> Optional[dict]:
+    """
+    Get the status of one of a user's jobs.
+
+    :return: A dictionary describing the job, or None if the user has no such job.
+    """
+    with app.app_context():
+        _ensure_job_table()
+        job_ = Job.query.filter_by(id=job_id, user_id=user_id).one_or_none()
+        if job_ is None:
+            return None
+        if job_.status == JOB_RUNNING and job_.updated_at < _stale_before() and fail_stale_jobs(job_id=job_id) > 0:
+            db.session.refresh(job_)
+
+        return {
+            "id": job_.id,
+            "kind": job_.kind,
+            "status": job_.status,
+            "progress": job_.progress,
+            "total": job_.total,
+            "message": job_.message,
+            "result_filename": job_.result_filename,
+            "created_at": job_.created_at.isoformat() if job_.created_at else None,
+            "updated_at": job_.updated_at.isoformat() if job_.updated_at else None,
+        }
+
+
+def get_job_result_path(job_id: int, user_id: int) -> Optional[str]:
+    """
+    Get the path of the result file of one of a user's finished jobs.
+
+    :return: The path, or None if the job has no result (yet), or its result has expired.
+    """
+    job_ = get_job(job_id=job_id, user_id=user_id)
+    if job_ is None or job_["status"] != JOB_DONE or job_["result_filename"] is None:
+        return None
+
+    path = _result_path(job_id, job_["result_filename"])
+    if not os.path.exists(path) or _result_expired(path):
+        return None
+    return path
+
+
+def recover_jobs() -> None:
+    """
+    Resume jobs after a restart: re-queue jobs that never started and fail the ones whose heartbeat
+    stopped, they were running when a server went down (and did not record where they got to).
+    Jobs still beating run in another server process and are left alone. Deletes expired result
+    files.
+    """
+    fail_stale_jobs()
+
+    with app.app_context():
+        queued_ids = [x.id for x in Job.query.filter_by(status=JOB_QUEUED).all()]
+
+    for job_id in queued_ids:
+        _get_executor().submit(_run_job, job_id)
+
+    remove_expired_results()
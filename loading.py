@@ -0,0 +1,57 @@
+from sqlalchemy.orm import Load, selectinload, raiseload, joinedload, load_only
+
+from models import Item, Inventory, User, Tag, Image
+
+# Relationship loading strategies, one per rendering path.
+#
+# The model relationships only eager load the small per-item collections (tags, images, fields).
+# Everything that fans out (inventory items, user inventories, inventory users) is lazy, so each
+# query that returns objects which outlive their session says here exactly what it renders.
+
+
+# Items rendered by the DataTables JSON API: name link, description, location and tags
+ITEM_API_LOAD = (
+    load_only(Item.id, Item.name, Item.slug, Item.description, Item.specific_location),
+    selectinload(Item.tags).load_only(Tag.tag),
+    Load(Item).raiseload('*'),
+)
+
+# Items rendered by the server-side list and grid views; the main image's URL comes from its variants
+ITEM_LIST_LOAD = (
+    selectinload(Item.tags).load_only(Tag.tag),
+    selectinload(Item.images).load_only(Image.image_filename, Image.variants),
+    selectinload(Item.inventories).options(load_only(Inventory.slug), raiseload('*')),
+    raiseload(Item.fields),
+    raiseload(Item.related_items),
+)
+
+# Items written by the JSON export: every item column plus tags and image filenames
+ITEM_EXPORT_LOAD = (
+    selectinload(Item.tags).load_only(Tag.tag),
+    selectinload(Item.images).load_only(Image.image_filename),
+    raiseload(Item.inventories),
+    raiseload(Item.fields),
+    raiseload(Item.related_items),
+)
+
+# Items rendered by the search results page: name and a link into their first inventory
+ITEM_SEARCH_LOAD = (
+    load_only(Item.id, Item.name, Item.slug),
+    selectinload(Item.inventories).options(load_only(Inventory.slug), raiseload('*')),
+    Load(Item).raiseload('*'),
+)
+
+# Inventories summarised on the profile and /lists pages: inventory columns and the owner's username.
+# Item counts come from count_inventory_items, never from the items collection.
+INVENTORY_SUMMARY_LOAD = (
+    joinedload(Inventory.owner).options(load_only(User.username), raiseload('*')),
+    raiseload(Inventory.items),
+    raiseload(Inventory.users),
+    raiseload(Inventory.invtags),
+)
+
+# Users loaded by the Flask-Login user loader on every authenticated request: identity columns only.
+# The password, tokens and every relationship load on first access.
+USER_SESSION_LOAD = (
+    load_only(User.id, User.username, User.email, User.is_active, User.is_admin, User.activated),
+)
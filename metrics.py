@@ -0,0 +1,300 @@
+import bisect
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Tuple
+
+from flask import g, request
+from sqlalchemy import event, func, select
+from sqlalchemy.pool import Pool
+
+from app import app, db
+from models import Job
+
+# Metrics
+#
+# Counters and histograms of this process, served at /metrics (routes/metrics_routes.py) in the
+# Prometheus text format. Each process counts its own requests; with several server processes,
+# scrape each of them.
+#
+# Recording takes no lock: every thread adds to a shard of its own, and only that thread writes to
+# it. /metrics adds the shards up, copying each (dict and list copies are atomic under the GIL).
+# When a thread ends its shard is folded into the shard of retired threads, so a server starting
+# a thread per request does not pile them up; the folding waits for the next thread starting or
+# the next /metrics, the thread ending takes no lock either.
+#
+# Gauges (pool connections, queued jobs, emails and images waiting) are read when /metrics is asked
+# for.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+IMAGE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_START_KEY = '_metrics_request_start'
+
+
+class _Shard:
+    def __init__(self):
+        # (metric name, label values) -> value
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        # (metric name, label values) -> [count of each bucket..., count above the last, sum]
+        self.histograms: Dict[Tuple[str, tuple], List[float]] = {}
+
+
+_local = threading.local()
+_shards: List[_Shard] = []
+_retired = _Shard()
+_shards_lock = threading.Lock()
+# shards of ended threads, not folded into _retired yet
+_ended: List[_Shard] = []
+
+_metrics = []
+
+
+def _add(total: _Shard, counters: dict, histograms: dict) -> None:
+    for key, value in counters.items():
+        total.counters[key] = total.counters.get(key, 0.0) + value
+    for key, values in histograms.items():
+        total_values = total.histograms.setdefault(key, [0.0] * len(values))
+        for i, value in enumerate(values):
+            total_values[i] += value
+
+
+def _retire_ended() -> None:
+    # under _shards_lock
+    while len(_ended) > 0:
+        shard = _ended.pop()
+        _shards.remove(shard)
+        _add(_retired, shard.counters, shard.histograms)
+
+
+def _shard() -> _Shard:
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _Shard()
+        _local.shard = shard
+        with _shards_lock:
+            _retire_ended()
+            _shards.append(shard)
+        # runs once the thread has ended and its Thread object is gone
+        weakref.finalize(threading.current_thread(), _ended.append, shard)
+    return shard
+
+
+def _snapshot() -> _Shard:
+    """The shards of all threads added up."""
+    with _shards_lock:
+        _retire_ended()
+        copies = [(dict(x.counters), {k: list(v) for k, v in list(x.histograms.items())})
+                  for x in _shards + [_retired]]
+
+    total = _Shard()
+    for counters, histograms in copies:
+        _add(total, counters, histograms)
+    return total
+
+
+class Counter:
+    """A count that only goes up, e.g. of requests."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        counters = _shard().counters
+        key = (self.name, label_values)
+        counters[key] = counters.get(key, 0.0) + amount
+
+    def total(self, snapshot: _Shard = None) -> float:
+        """The count over all label values."""
+        snapshot = snapshot or _snapshot()
+        return sum(value for (name, label_values), value in snapshot.counters.items() if name == self.name)
+
+    def _lines(self, snapshot: _Shard) -> List[str]:
+        lines = []
+        for (name, label_values), value in sorted(snapshot.counters.items()):
+            if name == self.name:
+                lines.append(f"{name}{_labels(self.labels, label_values)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Observed values, e.g. durations, counted in buckets."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        _metrics.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        histograms = _shard().histograms
+        key = (self.name, label_values)
+        values = histograms.get(key)
+        if values is None:
+            values = [0.0] * (len(self.buckets) + 2)
+            histograms[key] = values
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def count(self, snapshot: _Shard = None) -> float:
+        """The number of values observed, over all label values."""
+        snapshot = snapshot or _snapshot()
+        return sum(sum(values[:-1]) for (name, label_values), values in snapshot.histograms.items()
+                   if name == self.name)
+
+    def _lines(self, snapshot: _Shard) -> List[str]:
+        lines = []
+        for (name, label_values), values in sorted(snapshot.histograms.items()):
+            if name != self.name:
+                continue
+            cumulative = 0.0
+            for bound, number in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += number
+                le = bound if isinstance(bound, str) else _number(bound)
+                lines.append(f"{name}_bucket{_labels(self.labels + ('le',), label_values + (le,))} "
+                             f"{_number(cumulative)}")
+            lines.append(f"{name}_sum{_labels(self.labels, label_values)} {_number(values[-1])}")
+            lines.append(f"{name}_count{_labels(self.labels, label_values)} {_number(cumulative)}")
+        return lines
+
+
+class Gauge:
+    """A value read when the metrics are asked for: collect returns {label values: value}."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple, collect: Callable[[], Dict[tuple, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+        _metrics.append(self)
+
+    def _lines(self, snapshot: _Shard) -> List[str]:
+        try:
+            values = self.collect()
+        except Exception as e:
+            app.logger.error(f"Could not collect metric {self.name}: {str(e)}")
+            return []
+        return [f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+                for label_values, value in sorted(values.items())]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _metric_type(metric) -> str:
+    return {Counter: "counter", Histogram: "histogram", Gauge: "gauge"}[type(metric)]
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text format."""
+    snapshot = _snapshot()
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {_metric_type(metric)}")
+        lines.extend(metric._lines(snapshot))
+    return "\n".join(lines) + "\n"
+
+
+# requests
+
+REQUESTS = Counter("thinglist_requests_total", "Requests answered, by endpoint and status.",
+                   ("endpoint", "status"))
+REQUEST_DURATION = Histogram("thinglist_request_duration_seconds",
+                             "Time from the start of a request to its response, by blueprint and endpoint.",
+                             ("blueprint", "endpoint"))
+
+
+def _endpoint_labels() -> Tuple[str, str]:
+    # requests matching no route would each add an endpoint label, they are counted together
+    if request.endpoint is None:
+        return "", "unmatched"
+    return request.blueprint or "", request.endpoint
+
+
+@app.before_request
+def _start_request_timer():
+    setattr(g, _START_KEY, time.perf_counter())
+
+
+@app.after_request
+def _record_request(response):
+    start = g.get(_START_KEY, None)
+    if start is not None:
+        blueprint, endpoint = _endpoint_labels()
+        REQUESTS.inc(endpoint, str(response.status_code))
+        REQUEST_DURATION.observe(time.perf_counter() - start, blueprint, endpoint)
+    return response
+
+
+# database connection pool
+
+POOL_CHECKOUTS = Counter("thinglist_db_pool_checkouts_total", "Connections taken from the pool.")
+
+
+@event.listens_for(Pool, 'checkout')
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKOUTS.inc()
+
+
+def _pool_value(attribute: str) -> Dict[tuple, float]:
+    method = getattr(db.engine.pool, attribute, None)
+    return {(): method()} if method is not None else {}
+
+
+Gauge("thinglist_db_pool_size", "Connections the pool keeps open.", (), lambda: _pool_value("size"))
+Gauge("thinglist_db_pool_checked_out", "Connections in use.", (), lambda: _pool_value("checkedout"))
+Gauge("thinglist_db_pool_overflow", "Connections open beyond the pool size; negative while the pool is not full.",
+      (), lambda: _pool_value("overflow"))
+
+
+# background jobs, see jobs.py
+
+def _jobs_by_status() -> Dict[tuple, float]:
+    rows = db.session.execute(select(Job.status, func.count(Job.id)).group_by(Job.status)).all()
+    return {(status,): number for status, number in rows}
+
+
+Gauge("thinglist_jobs", "Background jobs in the jobs table, by status; queued ones are the queue depth.",
+      ("status",), _jobs_by_status)
+
+
+# emails, see email_utils.py
+
+EMAILS_QUEUED = Counter("thinglist_emails_queued_total", "Emails handed to a sending thread.")
+EMAILS_SENT = Counter("thinglist_emails_total", "Emails the mail server accepted or refused, by result.",
+                      ("result",))
+Gauge("thinglist_email_outbox", "Emails waiting to be sent.", (),
+      lambda: {(): EMAILS_QUEUED.total() - EMAILS_SENT.total()})
+
+
+# image processing, see image_derivatives.py
+
+IMAGES_QUEUED = Counter("thinglist_images_queued_total", "Uploads queued for the image workers.")
+IMAGE_PROCESSING = Histogram("thinglist_image_processing_seconds",
+                             "Time from queueing an upload to its derivatives being written, by result.",
+                             ("result",), buckets=IMAGE_BUCKETS)
+IMAGES_REJECTED = Counter("thinglist_images_rejected_total", "Uploads turned away because the image queue was full.")
+
+
+def _images_waiting() -> Dict[tuple, float]:
+    snapshot = _snapshot()
+    return {(): IMAGES_QUEUED.total(snapshot) - IMAGE_PROCESSING.count(snapshot)}
+
+
+Gauge("thinglist_image_queue", "Uploads queued or being processed by the image workers.", (), _images_waiting)
@@ -0,0 +1,151 @@
+import datetime
+
+from sqlalchemy import Table, Column, String, DateTime, MetaData, Index, select, text, inspect
+
+from app import app, db
+from models import Image, Inventory, Item, ItemField, ItemImage, ItemTag, ItemType, InventoryItem, Location, Job, \
+    CacheVersion
+
+# Schema migrations
+#
+# A new database gets its schema from the models (db.create_all, see drop_then_create) and is then
+# stamped with every revision below. A database created earlier is brought up to date with
+# admin/migrate.py, which runs the revisions not yet recorded in schema_migrations, in order, and
+# records each once it has run.
+#
+# A change to the tables of the models gets a revision here as well. Revisions check what exists
+# before changing it, so they also run on a database that already has part of the change (MySQL
+# commits every ALTER TABLE at once, an interrupted revision cannot be rolled back).
+
+_metadata = MetaData()
+
+schema_migrations = Table(
+    "schema_migrations", _metadata,
+    Column("revision", String(50), primary_key=True),
+    Column("applied_at", DateTime(), nullable=False),
+)
+
+
+def add_column_if_missing(connection, table, column_name: str, definition: str) -> bool:
+    """
+    Add a column of a model's table if the table does not have it yet.
+
+    :param connection: The connection to the database.
+    :param table: The model's table.
+    :param column_name: The name of the column.
+    :param definition: The SQL type and constraints of the column.
+    :return: True if the column was added.
+    """
+    columns = [x["name"] for x in inspect(connection).get_columns(table.name)]
+    if column_name in columns:
+        return False
+    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_name} {definition}"))
+    return True
+
+
+def create_index_if_missing(connection, index: Index) -> bool:
+    """
+    Create one of the indexes declared by the models if the database does not have it yet.
+
+    :param connection: The connection to the database.
+    :param index: The index, from the __table_args__ of its model.
+    :return: True if the index was created.
+    """
+    existing = [x["name"] for x in inspect(connection).get_indexes(index.table.name)]
+    if index.name in existing:
+        return False
+    index.create(connection)
+    return True
+
+
+def _model_index(model, name: str) -> Index:
+    for index in model.__table__.indexes:
+        if index.name == name:
+            return index
+    raise KeyError(f"{model.__tablename__} declares no index {name}")
+
+
+def _baseline(connection) -> None:
+    # the columns and tables added before there were migrations
+    add_column_if_missing(connection, Image.__table__, "variants", "TEXT NULL")
+    add_column_if_missing(connection, Inventory.__table__, "version", "INTEGER NOT NULL DEFAULT 0")
+    Job.__table__.create(connection, checkfirst=True)
+    CacheVersion.__table__.create(connection, checkfirst=True)
+
+
+# the indexes of the lookups listed in query_plans.py
+_HOT_LOOKUP_INDEXES = [
+    (Item, "ix_items_user_id_slug"),
+    (Item, "ix_items_slug"),
+    (Inventory, "ix_inventories_owner_id_slug"),
+    (InventoryItem, "ix_inventory_items_inventory_id_item_id"),
+    (ItemField, "ix_item_fields_item_id"),
+    (ItemTag, "ix_item_tags_item_id"),
+    (ItemImage, "ix_item_images_item_id"),
+    (ItemImage, "ix_item_images_image_id"),
+    (Image, "ix_images_user_id_image_filename"),
+    (Location, "ix_locations_user_id"),
+    (ItemType, "ix_item_type_user_id"),
+]
+
+
+def _hot_lookup_indexes(connection) -> None:
+    for model, name in _HOT_LOOKUP_INDEXES:
+        create_index_if_missing(connection, _model_index(model, name))
+
+
+def _field_value_search_index(connection) -> None:
+    # fields are shared between users, _item_field_uc (field_id, item_id) alone reads every user's
+    # values of a field
+    create_index_if_missing(connection, _model_index(ItemField, "ix_item_fields_field_id_user_id"))
+
+
+# (revision, description, upgrade), in the order they run; never renumber or remove one
+REVISIONS = [
+    ("0001", "image variants, inventory versions, jobs and cache versions", _baseline),
+    ("0002", "indexes for the hot lookups", _hot_lookup_indexes),
+    ("0003", "index for searches by custom field value", _field_value_search_index),
+]
+
+
+def applied_revisions() -> list:
+    """The revisions recorded in the database, in the order they were applied."""
+    schema_migrations.create(db.engine, checkfirst=True)
+    with db.engine.connect() as connection:
+        rows = connection.execute(select(schema_migrations.c.revision)
+                                  .order_by(schema_migrations.c.applied_at, schema_migrations.c.revision))
+        return [x for x, in rows]
+
+
+def pending_revisions() -> list:
+    """The revisions not applied yet, in the order they run."""
+    applied = set(applied_revisions())
+    return [x for x in REVISIONS if x[0] not in applied]
+
+
+def _record(connection, revision: str) -> None:
+    connection.execute(schema_migrations.insert().values(revision=revision, applied_at=datetime.datetime.now()))
+
+
+def upgrade() -> list:
+    """
+    Run the revisions the database does not have yet.
+
+    :return: The revisions run.
+    """
+    done = []
+    for revision, description, upgrade_function in pending_revisions():
+        app.logger.info(f"Applying schema revision {revision}: {description}")
+        with db.engine.begin() as connection:
+            upgrade_function(connection)
+            _record(connection, revision)
+        done.append(revision)
+    return done
+
+
+def stamp_head() -> None:
+    """Record every revision as applied, for a database just created from the models."""
+    pending = pending_revisions()
+    with db.engine.begin() as connection:
+        for revision, description, upgrade_function in pending:
+            _record(connection, revision)
@@ -3,7 +3,7 @@ import string
 from random import choice
 
 from flask_login import UserMixin
-from sqlalchemy import UniqueConstraint, event
+from sqlalchemy import UniqueConstraint, Index, event
 
 from app import db
 from sqlalchemy.ext.declarative import declarative_base
@@ -40,7 +40,7 @@ class User(UserMixin, db.Model):
     user_created = db.Column(db.DateTime(), default=datetime.datetime.now)
     email_confirmed_at = db.Column(db.DateTime(), default=None)
     inventories = db.relationship('Inventory', secondary='inventory_users',
-                                  back_populates='users', cascade="all,delete", lazy='subquery')
+                                  back_populates='users', cascade="all,delete", lazy='select')
 
     notifications = db.relationship('Notification', backref='users', passive_deletes="all")
     activated = db.Column(db.Boolean(), nullable=True, unique=False, default=False)
@@ -60,7 +60,7 @@ class Notification(db.Model):
     date = db.Column(db.DateTime(), default=datetime.datetime.now)
     text = db.Column(db.String(255), nullable=True, unique=False)
     from_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, nullable=False)
-    from_user = db.relationship(User, overlaps="notifications, users", load_on_pending=True, lazy='subquery',
+    from_user = db.relationship(User, overlaps="notifications, users", load_on_pending=True, lazy='selectin',
                                 passive_deletes="all")
 #viewonly=True,
 
@@ -70,7 +70,7 @@ class FieldTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(50))
     fields = db.relationship('Field', secondary='fieldtemplate_fields',
-                             back_populates='field_templates', lazy='subquery')
+                             back_populates='field_templates', lazy='selectin')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
 
@@ -101,6 +101,7 @@ class Location(db.Model):
     name = db.Column(db.String(50), nullable=True, unique=False)
     description = db.Column(db.String(50), nullable=True, unique=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    __table_args__ = (Index('ix_locations_user_id', 'user_id'),)
 
 
 class Inventory(db.Model):
@@ -111,9 +112,9 @@ class Inventory(db.Model):
     slug = db.Column(db.String(50), nullable=True, unique=False)
     description = db.Column(db.String(255))
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, nullable=False)
-    owner = db.relationship(User, load_on_pending=True, lazy='subquery')
-    users = db.relationship('User', secondary='inventory_users', back_populates='inventories', lazy='subquery')
-    items = db.relationship('Item', secondary='inventory_items', back_populates='inventories', lazy='subquery')
+    owner = db.relationship(User, load_on_pending=True, lazy='select')
+    users = db.relationship('User', secondary='inventory_users', back_populates='inventories', lazy='select')
+    items = db.relationship('Item', secondary='inventory_items', back_populates='inventories', lazy='select')
     default_fields = db.Column(db.String(1000), default="-1")
     field_template = db.Column(db.Integer, db.ForeignKey('field_templates.id'), nullable=True)
     access_level = db.Column(db.Integer, nullable=False, unique=False, default=False)
@@ -125,7 +126,10 @@ class Inventory(db.Model):
     show_item_location = db.Column(db.Boolean(), nullable=False, unique=False, default=True)
     show_item_type = db.Column(db.Boolean(), nullable=False, unique=False, default=True)
     show_item_tags = db.Column(db.Boolean(), nullable=False, unique=False, default=True)
-    invtags = db.relationship('Invtag', secondary='inventory_tags', back_populates='inventories', lazy='subquery')
+    invtags = db.relationship('Invtag', secondary='inventory_tags', back_populates='inventories', lazy='select')
+    # bumped by every change to the inventory's items, see inventory_versions.py
+    version = db.Column(db.Integer, nullable=False, unique=False, default=0, server_default='0')
+    __table_args__ = (Index('ix_inventories_owner_id_slug', 'owner_id', 'slug'),)
 
 
 class Relateditems(db.Model):
@@ -144,15 +148,18 @@ class Item(db.Model):
     slug = db.Column(db.String(255), nullable=True, unique=False)
     description = db.Column(db.String(10000), nullable=True, unique=False)
     quantity = db.Column(db.Integer, nullable=False, unique=False, default=1)
-    inventories = db.relationship('Inventory', secondary='inventory_items', back_populates='items', lazy='subquery')
-    tags = db.relationship('Tag', secondary='item_tags', back_populates='items', lazy='subquery')
+    inventories = db.relationship('Inventory', secondary='inventory_items', back_populates='items', lazy='select')
+    tags = db.relationship('Tag', secondary='item_tags', back_populates='items', lazy='selectin')
     location_id = db.Column(db.Integer, db.ForeignKey('locations.id'), primary_key=True, default=1)
     specific_location = db.Column(db.String(50), nullable=True, unique=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-    images = db.relationship('Image', secondary='item_images', back_populates='items', lazy='subquery')
+    images = db.relationship('Image', secondary='item_images', back_populates='items', lazy='selectin')
     main_image = db.Column(db.String(255), nullable=True, unique=False)
-    fields = db.relationship('Field', secondary='item_fields', back_populates='items', lazy='subquery')
+    fields = db.relationship('Field', secondary='item_fields', back_populates='items', lazy='selectin')
     short_code = db.Column(db.String(255), nullable=True, unique=True)
+    __table_args__ = (Index('ix_items_user_id_slug', 'user_id', 'slug'),
+                      Index('ix_items_slug', 'slug'),
+                      )
 
     # this relationship is used for persistence
     related_items = db.relationship("Item", secondary=Relateditems.__table__,
@@ -182,6 +189,8 @@ class ItemField(db.Model):
     show = db.Column(db.Boolean(), nullable=True, unique=False, default=False)
     user_id = db.Column(db.Integer, nullable=True, unique=False, default=-1)
     __table_args__ = (UniqueConstraint('field_id', 'item_id', name='_item_field_uc'),
+                      Index('ix_item_fields_item_id', 'item_id'),
+                      Index('ix_item_fields_field_id_user_id', 'field_id', 'user_id'),
                       )
 
 
@@ -189,9 +198,12 @@ class Image(db.Model):
     __tablename__ = "images"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     image_filename = db.Column(db.String(255), nullable=True, unique=False)
+    # the sizes generated at upload, see image_derivatives.py
+    variants = db.Column(db.Text(), nullable=True, unique=False)
     items = db.relationship('Item', secondary='item_images', back_populates='images',
-                            cascade="all,delete", lazy='subquery')
+                            cascade="all,delete", lazy='select')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    __table_args__ = (Index('ix_images_user_id_image_filename', 'user_id', 'image_filename'),)
 
 
 class ItemImage(db.Model):
@@ -199,6 +211,9 @@ class ItemImage(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     image_id = db.Column(db.Integer, db.ForeignKey('images.id', ondelete='CASCADE'))
     item_id = db.Column(db.Integer, db.ForeignKey('items.id', ondelete='CASCADE'))
+    __table_args__ = (Index('ix_item_images_item_id', 'item_id'),
+                      Index('ix_item_images_image_id', 'image_id'),
+                      )
 
 
 class UserInventory(db.Model):
@@ -218,7 +233,9 @@ class InventoryItem(db.Model):
     item_id = db.Column(db.Integer, db.ForeignKey('items.id'))
     access_level = db.Column(db.Integer, default=0)
     is_link = db.Column(db.Boolean(), default=False)
-    __table_args__ = (UniqueConstraint('item_id', 'inventory_id', name='_item_id_inventory_id_uc'),)
+    __table_args__ = (UniqueConstraint('item_id', 'inventory_id', name='_item_id_inventory_id_uc'),
+                      Index('ix_inventory_items_inventory_id_item_id', 'inventory_id', 'item_id'),
+                      )
 
 
 class ItemType(db.Model):
@@ -226,7 +243,9 @@ class ItemType(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(50), nullable=True, unique=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-    __table_args__ = (UniqueConstraint('name', 'user_id', name='_name_userid_uc'),)
+    __table_args__ = (UniqueConstraint('name', 'user_id', name='_name_userid_uc'),
+                      Index('ix_item_type_user_id', 'user_id'),
+                      )
 
 
 class Tag(db.Model):
@@ -255,6 +274,7 @@ class ItemTag(db.Model):
     item_id = db.Column(db.Integer, db.ForeignKey('items.id', ondelete='CASCADE'))
     tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'))
     __table_args__ = (UniqueConstraint('tag_id', 'item_id', name='_item_tag_uc'),
+                      Index('ix_item_tags_item_id', 'item_id'),
                       )
 
 
@@ -278,3 +298,24 @@ class UserLocation(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     location_id = db.Column(db.Integer, db.ForeignKey('locations.id', ondelete='CASCADE'))
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(50), nullable=False, unique=False)
+    status = db.Column(db.String(20), nullable=False, unique=False, default="queued")
+    params = db.Column(db.Text(), nullable=True, unique=False)
+    progress = db.Column(db.Integer, nullable=False, unique=False, default=0)
+    total = db.Column(db.Integer, nullable=True, unique=False)
+    message = db.Column(db.Text(), nullable=True, unique=False)
+    result_filename = db.Column(db.String(255), nullable=True, unique=False)
+    created_at = db.Column(db.DateTime(), default=datetime.datetime.now)
+    updated_at = db.Column(db.DateTime(), default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+
+class CacheVersion(db.Model):
+    __tablename__ = "cache_versions"
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, unique=False, default=0)
@@ -0,0 +1,186 @@
+from typing import Callable, Dict, List
+
+from sqlalchemy import select, func, text
+
+from app import db
+from database_functions import _my_items_query, _apply_items_window, _search_by_field_value, _item_custom_field_query
+from models import User, Item, ItemType, Location, Inventory, InventoryItem, UserInventory, ItemField, ItemTag, \
+    ItemImage, Image, Tag
+
+# Query plans of the hot queries
+#
+# The queries every page and API call runs, registered with @hot_query, each built with sample
+# values. check_plans has the database EXPLAIN each and reports those that read a whole table:
+#   MySQL       access type ALL (or index, a read of a whole index)
+#   SQLite      SCAN of a table (EXPLAIN QUERY PLAN)
+#   PostgreSQL  Seq Scan
+# Databases plan small tables with scans whatever their indexes, run the check on a database with
+# realistic numbers of rows (see admin/check_query_plans.py).
+#
+# The indexes that keep these queries off full scans are declared in models.py and created on
+# existing databases by migrations.py. A new hot query is registered here along with its index.
+
+SAMPLE_USER_ID = 1
+SAMPLE_INVENTORY_ID = 1
+SAMPLE_ITEM_IDS = [1, 2, 3]
+
+HOT_QUERIES: Dict[str, Callable] = {}
+
+
+def hot_query(name: str):
+    """Register a function returning a hot query's statement under name."""
+    def _register(function):
+        HOT_QUERIES[name] = function
+        return function
+
+    return _register
+
+
+@hot_query("item by owner and slug")
+def _item_by_owner_and_slug():
+    # find_item_by_slug
+    return select(Item).where(Item.slug == "sample-item").where(Item.user_id == SAMPLE_USER_ID)
+
+
+@hot_query("item page")
+def _item_page():
+    # get_item_by_slug
+    return select(Item, ItemType.name, InventoryItem) \
+        .join(InventoryItem, InventoryItem.item_id == Item.id) \
+        .join(ItemType, ItemType.id == Item.item_type) \
+        .join(Location, Location.id == Item.location_id) \
+        .where(Item.slug == "sample-item")
+
+
+@hot_query("inventory by owner and slug")
+def _inventory_by_owner_and_slug():
+    # find_inventory_by_slug
+    return select(Inventory).where(Inventory.owner_id == SAMPLE_USER_ID).where(Inventory.slug == "sample-inventory")
+
+
+@hot_query("inventory access")
+def _inventory_access():
+    return select(UserInventory).where(UserInventory.user_id == SAMPLE_USER_ID) \
+        .where(UserInventory.inventory_id == SAMPLE_INVENTORY_ID)
+
+
+@hot_query("items of an inventory")
+def _items_of_an_inventory():
+    # a page of the items API for one inventory
+    query_ = _my_items_query(entities=(Item, ItemType.name, Location.name, InventoryItem.access_level,
+                                       InventoryItem.is_link),
+                             logged_in_user=User(id=SAMPLE_USER_ID), inventory_id=SAMPLE_INVENTORY_ID,
+                             query_params={})
+    return _apply_items_window(query_, {"order_column": "name", "length": 50}).statement
+
+
+@hot_query("items of all inventories")
+def _items_of_all_inventories():
+    query_ = _my_items_query(entities=(Item, ItemType.name, Location.name, InventoryItem.access_level,
+                                       InventoryItem.is_link),
+                             logged_in_user=User(id=SAMPLE_USER_ID), inventory_id=None, query_params={})
+    return _apply_items_window(query_, {"after_id": 0, "length": 50}).statement
+
+
+@hot_query("inventory version of all inventories")
+def _all_inventories_version():
+    # inventory_versions.inventory_version
+    return select(func.coalesce(func.sum(Inventory.version), 0), func.count(Inventory.id)) \
+        .join(UserInventory, UserInventory.inventory_id == Inventory.id) \
+        .where(UserInventory.user_id == SAMPLE_USER_ID)
+
+
+@hot_query("fields of items")
+def _fields_of_items():
+    # the selectin loads of Item.fields and the item lists' custom field columns
+    return select(ItemField).where(ItemField.item_id.in_(SAMPLE_ITEM_IDS))
+
+
+@hot_query("tags of items")
+def _tags_of_items():
+    return select(ItemTag).where(ItemTag.item_id.in_(SAMPLE_ITEM_IDS))
+
+
+@hot_query("images of items")
+def _images_of_items():
+    return select(ItemImage).where(ItemImage.item_id.in_(SAMPLE_ITEM_IDS))
+
+
+@hot_query("links of an image")
+def _links_of_an_image():
+    # release_images
+    return select(func.count(ItemImage.id)).where(ItemImage.image_id == 1)
+
+
+@hot_query("image by owner and filename")
+def _image_by_owner_and_filename():
+    # add_images_to_item
+    return select(Image).where(Image.image_filename == "ab/cd/sample.jpg").where(Image.user_id == SAMPLE_USER_ID)
+
+
+@hot_query("locations of a user")
+def _locations_of_a_user():
+    return select(Location).where(Location.user_id == SAMPLE_USER_ID)
+
+
+@hot_query("item types of a user")
+def _item_types_of_a_user():
+    return select(ItemType.name).where(ItemType.user_id == SAMPLE_USER_ID)
+
+
+@hot_query("tag by name")
+def _tag_by_name():
+    return select(Tag).where(Tag.tag == "sample-tag")
+
+
+@hot_query("custom field values of items")
+def _custom_field_values_of_items():
+    # get_item_custom_field_data, for the custom field columns of the item lists
+    return _item_custom_field_query(user_id=SAMPLE_USER_ID, item_list=SAMPLE_ITEM_IDS).statement
+
+
+@hot_query("search by field value")
+def _search_by_field():
+    return _search_by_field_value(field_id=1, user_id=SAMPLE_USER_ID, query="sample").statement
+
+
+def _sql(statement) -> str:
+    return str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+
+
+def _full_scans(connection, sql: str) -> List[str]:
+    """The tables a statement reads whole, by the plan of the database it runs on."""
+    dialect = connection.dialect.name
+    table_names = set(db.metadata.tables.keys())
+    scans = []
+
+    if dialect == "sqlite":
+        for row in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")):
+            words = row[3].split()
+            if len(words) > 1 and words[0] == "SCAN" and words[1] in table_names:
+                scans.append(row[3])
+    elif dialect in ("mysql", "mariadb"):
+        for row in connection.execute(text(f"EXPLAIN {sql}")).mappings():
+            if row["type"] in ("ALL", "index") and row["table"] in table_names:
+                scans.append(f"{row['table']} (type {row['type']})")
+    elif dialect == "postgresql":
+        for row in connection.execute(text(f"EXPLAIN {sql}")):
+            if "Seq Scan on " in row[0]:
+                scans.append(row[0].strip())
+    else:
+        raise ValueError(f"no query plan check for {dialect} databases")
+
+    return scans
+
+
+def check_plans() -> Dict[str, List[str]]:
+    """
+    EXPLAIN the hot queries.
+
+    :return: The full scans of each hot query, by name; empty lists for the queries using indexes.
+    """
+    results = {}
+    with db.engine.connect() as connection:
+        for name, function in HOT_QUERIES.items():
+            results[name] = _full_scans(connection, _sql(function()))
+    return results
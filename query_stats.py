@@ -0,0 +1,164 @@
+import heapq
+import logging
+import os
+import re
+import time
+import warnings
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+# SQL statistics
+#
+# Every statement sent to the database is timed. Per request the number of statements, the time
+# spent in the database and the SLOWEST_KEPT slowest statements are kept on flask.g, and:
+#   - in debug mode they are sent back in a Server-Timing header, which browsers show with the
+#     request's timings in their developer tools
+#   - statements slower than SLOW_QUERY_MS milliseconds, in requests or not, are written to
+#     thinglist_slow_queries.txt in LOG_DIRECTORY, with the types of their parameters but not
+#     their values
+#   - a view may set the most statements it should need with @query_budget, or QUERY_BUDGET sets
+#     one for all views; requests going over it are logged, and under app.testing raise a
+#     QueryBudgetWarning so tests show them
+
+SLOWEST_KEPT = 5
+STATEMENT_LOG_LENGTH = 2000
+
+_STATS_KEY = '_query_stats'
+_START_KEY = 'query_start_times'
+
+slow_query_logger = logging.getLogger("thinglist.slow_queries")
+slow_query_logger.propagate = False
+slow_query_logger.setLevel(logging.INFO)
+slow_query_file_handler = RotatingFileHandler(
+    filename=os.path.join(app.config['LOG_DIRECTORY'], 'thinglist_slow_queries.txt'), maxBytes=1024 * 1024,
+    backupCount=10)
+slow_query_file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+slow_query_logger.addHandler(slow_query_file_handler)
+
+
+class QueryBudgetWarning(UserWarning):
+    """A request ran more SQL statements than the budget of its view."""
+
+
+class QueryStats:
+    """The statements of one request: their number, total time and the slowest of them."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        # a min-heap of (seconds, sequence number, statement), the fastest of the kept on top
+        self.slowest = []
+
+    def add(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.total_time += elapsed
+        entry = (elapsed, self.count, statement)
+        if len(self.slowest) < SLOWEST_KEPT:
+            heapq.heappush(self.slowest, entry)
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def slowest_first(self) -> list:
+        return [(elapsed, statement) for elapsed, number, statement in sorted(self.slowest, reverse=True)]
+
+
+def query_budget(number_of_statements: int):
+    """Set the most SQL statements a view should run, see above. Place it under the route decorator."""
+    def _set_budget(view):
+        view.query_budget = number_of_statements
+        return view
+
+    return _set_budget
+
+
+def request_query_stats() -> Optional[QueryStats]:
+    """The statistics of the current request's statements, None outside a request."""
+    if not has_request_context():
+        return None
+    if _STATS_KEY not in g:
+        setattr(g, _STATS_KEY, QueryStats())
+    return getattr(g, _STATS_KEY)
+
+
+def _one_line(statement: str) -> str:
+    return re.sub(r"\s+", " ", statement).strip()
+
+
+def _value_shape(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def parameter_shape(parameters, executemany: bool = False) -> str:
+    """The types of a statement's bound parameters, without their values, e.g. (int, str)."""
+    if executemany:
+        if len(parameters) == 0:
+            return "[]"
+        return f"{len(parameters)} x {parameter_shape(parameters[0])}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {_value_shape(value)}" for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(_value_shape(x) for x in parameters) + ")"
+    return _value_shape(parameters)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_START_KEY, []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get(_START_KEY)
+    if not start_times:
+        return
+    elapsed = time.perf_counter() - start_times.pop()
+
+    stats = request_query_stats()
+    if stats is not None:
+        stats.add(statement, elapsed)
+
+    if elapsed * 1000 >= float(app.config['SLOW_QUERY_MS']):
+        where = f"{request.method} {request.path}" if has_request_context() else "outside a request"
+        slow_query_logger.info(f"{elapsed * 1000:.1f} ms, {where}: "
+                               f"{_one_line(statement)[:STATEMENT_LOG_LENGTH]} "
+                               f"-- parameters {parameter_shape(parameters, executemany)}")
+
+
+def _server_timing(stats: QueryStats) -> str:
+    metrics = [f'db;dur={stats.total_time * 1000:.1f};desc="{stats.count} SQL statements"']
+    for number, (elapsed, statement) in enumerate(stats.slowest_first(), start=1):
+        description = _one_line(statement)[:60].replace('"', "'").replace("\\", "/")
+        description = description.encode("ascii", "replace").decode("ascii")
+        metrics.append(f'sql-{number};dur={elapsed * 1000:.1f};desc="{description}"')
+    return ", ".join(metrics)
+
+
+def _check_budget(stats: QueryStats) -> None:
+    view = app.view_functions.get(request.endpoint)
+    budget = getattr(view, "query_budget", None) or int(app.config['QUERY_BUDGET'])
+    if budget <= 0 or stats.count <= budget:
+        return
+
+    message = f"{request.endpoint} ran {stats.count} SQL statements, its budget is {budget} " \
+              f"({request.method} {request.path})"
+    app.logger.warning(message)
+    if app.testing:
+        warnings.warn(message, QueryBudgetWarning)
+
+
+@app.after_request
+def _report_query_stats(response):
+    stats = request_query_stats()
+    if stats.count > 0:
+        if app.debug:
+            response.headers.add('Server-Timing', _server_timing(stats))
+        _check_budget(stats)
+    return response
@@ -0,0 +1,208 @@
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import event, select, update
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import app, db
+from models import ItemType, Field, Location, FieldTemplate, CacheVersion
+
+# Reference data cache
+#
+# Item types, fields, locations and field templates are read on nearly every page but rarely
+# change. Lookups decorated with @reference_cached keep their results in a process-local LRU
+# cache for REFERENCE_CACHE_TTL seconds. Entries are grouped into namespaces and scoped to the user
+# the lookup was made for (or to nobody, for lookups across all users).
+#
+# Commits that add, change or delete reference rows through the ORM invalidate the namespace for
+# the row's user. Code writing with Core statements calls invalidate_reference_data itself.
+#
+# With REFERENCE_CACHE_SHARED set, every invalidation also bumps the namespace's version stamp in
+# the cache_versions table, and each worker re-reads the stamps every
+# REFERENCE_CACHE_VERSION_CHECK seconds, dropping the namespaces another worker changed.
+
+ITEM_TYPES = "item_types"
+FIELDS = "fields"
+LOCATIONS = "locations"
+TEMPLATES = "templates"
+
+_MODEL_NAMESPACES = {
+    ItemType: ITEM_TYPES,
+    Field: FIELDS,
+    Location: LOCATIONS,
+    FieldTemplate: TEMPLATES,
+}
+
+_PENDING_KEY = 'reference_cache_pending'
+
+_entries = OrderedDict()
+_lock = threading.RLock()
+_known_versions = None
+_last_version_check = 0.0
+_table_checked = False
+
+
+def _detach(value):
+    """Take ORM objects out of their session so the cached value can be shared between requests."""
+    if isinstance(value, (list, tuple, Row)):
+        for x in value:
+            _detach(x)
+        return value
+
+    state = sa_inspect(value, raiseerr=False)
+    if state is not None and getattr(state, 'session', None) is not None:
+        state.session.expunge(value)
+    return value
+
+
+def _ensure_version_table():
+    global _table_checked
+
+    if not _table_checked:
+        CacheVersion.__table__.create(db.engine, checkfirst=True)
+        _table_checked = True
+
+
+def _drop(namespace: str, user_id: Optional[int] = None) -> None:
+    with _lock:
+        for key in list(_entries.keys()):
+            if key[0] == namespace and (user_id is None or key[1] is None or key[1] == user_id):
+                del _entries[key]
+
+
+def _sync_shared_versions() -> None:
+    """Drop the namespaces whose version stamp another worker bumped since the last check."""
+    global _known_versions, _last_version_check
+
+    now = time.monotonic()
+    if now - _last_version_check < float(app.config['REFERENCE_CACHE_VERSION_CHECK']):
+        return
+    _last_version_check = now
+
+    try:
+        with app.app_context():
+            _ensure_version_table()
+            versions = dict(db.session.execute(select(CacheVersion.name, CacheVersion.version)).all())
+    except Exception as e:
+        app.logger.error(f"Could not read reference cache versions: {str(e)}")
+        return
+
+    with _lock:
+        if _known_versions is None:
+            # entries cached before the first check can not be vouched for
+            _entries.clear()
+        else:
+            for namespace, version in versions.items():
+                if _known_versions.get(namespace) != version:
+                    _drop(namespace)
+        _known_versions = versions
+
+
+def _bump_shared_version(namespace: str) -> None:
+    try:
+        with app.app_context():
+            _ensure_version_table()
+            bumped = db.session.execute(update(CacheVersion).where(CacheVersion.name == namespace)
+                                        .values(version=CacheVersion.version + 1))
+            if bumped.rowcount == 0:
+                db.session.add(CacheVersion(name=namespace, version=1))
+            db.session.commit()
+    except IntegrityError:
+        # another worker created the stamp first
+        _bump_shared_version(namespace)
+    except Exception as e:
+        app.logger.error(f"Could not bump the reference cache version of {namespace}: {str(e)}")
+
+
+def invalidate_reference_data(namespace: str, user_id: Optional[int] = None) -> None:
+    """
+    Forget cached reference data.
+
+    :param namespace: One of ITEM_TYPES, FIELDS, LOCATIONS or TEMPLATES.
+    :param user_id: The user whose data changed, or None for everybody's. Lookups across all users
+                    are dropped either way.
+    """
+    _drop(namespace, user_id)
+    if app.config['REFERENCE_CACHE_SHARED']:
+        _bump_shared_version(namespace)
+
+
+def clear_reference_cache() -> None:
+    """Forget all cached reference data in this process."""
+    with _lock:
+        _entries.clear()
+
+
+def reference_cached(namespace: str, user_arg: str = None):
+    """
+    Cache the results of a reference data lookup across requests.
+
+    :param namespace: The namespace invalidated when the underlying rows change.
+    :param user_arg: The name of the argument holding the user id the lookup is scoped to, or None
+                     if the lookup covers all users.
+    """
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if int(app.config['REFERENCE_CACHE_SIZE']) <= 0:
+                return f(*args, **kwargs)
+
+            if app.config['REFERENCE_CACHE_SHARED']:
+                _sync_shared_versions()
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            user_id = bound.arguments.get(user_arg) if user_arg is not None else None
+            key = (namespace, user_id, f.__qualname__, tuple(bound.arguments.items()))
+
+            now = time.monotonic()
+            with _lock:
+                entry = _entries.get(key)
+                if entry is not None and entry[0] > now:
+                    _entries.move_to_end(key)
+                    return entry[1]
+
+            value = _detach(f(*args, **kwargs))
+
+            with _lock:
+                _entries[key] = (now + float(app.config['REFERENCE_CACHE_TTL']), value)
+                _entries.move_to_end(key)
+                while len(_entries) > int(app.config['REFERENCE_CACHE_SIZE']):
+                    _entries.popitem(last=False)
+
+            return value
+
+        wrapper.uncached = f
+        return wrapper
+    return decorator
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_reference_changes(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        namespace = _MODEL_NAMESPACES.get(type(obj))
+        if namespace is not None:
+            pending.add((namespace, getattr(obj, 'user_id', None)))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_reference_changes(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        for namespace, user_id in pending:
+            invalidate_reference_data(namespace, user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_reference_changes(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,107 @@
+import functools
+import inspect
+from typing import Dict
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import app
+
+# Request-scoped memoization
+#
+# Lookup helpers decorated with @request_memoized run their query once per request and per
+# distinct set of arguments; repeated calls in the same request return the first result. The
+# cache lives on flask.g, so it is dropped at the end of the request, and it is cleared whenever
+# a session commits so a request never reads back its own stale lookups after a write. Outside a
+# request (background jobs, admin scripts) the helpers are called straight through.
+
+_CACHE_KEY = '_request_cache'
+_STATS_KEY = '_request_cache_stats'
+
+
+def _cache() -> dict:
+    if _CACHE_KEY not in g:
+        setattr(g, _CACHE_KEY, {})
+    return getattr(g, _CACHE_KEY)
+
+
+def _stats() -> Dict[str, list]:
+    if _STATS_KEY not in g:
+        setattr(g, _STATS_KEY, {})
+    return getattr(g, _STATS_KEY)
+
+
+def request_memoized(f):
+    """
+    Memoize a lookup function for the rest of the current request.
+
+    Calls are keyed on the function and its bound arguments, so f(1) and f(user_id=1) share an
+    entry. Calls with unhashable arguments are not cached. The undecorated function stays
+    available as f.uncached, for callers that modify the objects they look up.
+    """
+    signature = inspect.signature(f)
+    name = f.__qualname__
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not has_request_context():
+            return f(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (name, tuple(bound.arguments.items()))
+
+        stats = _stats().setdefault(name, [0, 0])
+        cache = _cache()
+        try:
+            if key in cache:
+                stats[0] += 1
+                return cache[key]
+        except TypeError:
+            # unhashable arguments
+            stats[1] += 1
+            return f(*args, **kwargs)
+
+        stats[1] += 1
+        result = f(*args, **kwargs)
+        cache[key] = result
+        return result
+
+    wrapper.uncached = f
+    return wrapper
+
+
+def clear_request_cache() -> None:
+    """Forget every lookup memoized in the current request."""
+    if has_request_context() and _CACHE_KEY in g:
+        getattr(g, _CACHE_KEY).clear()
+
+
+def request_cache_report() -> Dict[str, dict]:
+    """
+    The hits and misses of the memoized lookups in the current request.
+
+    :return: A dictionary of function name to {"hits": ..., "misses": ...}.
+    """
+    if not has_request_context():
+        return {}
+    return {name: {"hits": hits, "misses": misses} for name, (hits, misses) in _stats().items()}
+
+
+@event.listens_for(Session, 'after_commit')
+def _clear_after_commit(session):
+    clear_request_cache()
+
+
+@app.after_request
+def _log_request_cache_report(response):
+    if app.config['REQUEST_CACHE_REPORT']:
+        report = request_cache_report()
+        if len(report) > 0:
+            hits = sum(x["hits"] for x in report.values())
+            misses = sum(x["misses"] for x in report.values())
+            details = ", ".join(f"{name} {x['hits']}/{x['misses']}" for name, x in sorted(report.items()))
+            app.logger.info(f"Request cache {request.method} {request.path}: {hits} hits, {misses} misses "
+                            f"(hits/misses: {details})")
+    return response
@@ -1,10 +1,14 @@
 import bleach
 from flask import Blueprint
 from flask_login import login_required, current_user
-from flask import request
+from flask import request, jsonify
 from database_functions import get_all_itemtypes_for_user, get_all_user_locations, get_all_user_tags, \
     get_all_item_types, find_items_new, find_all_my_items, find_user_by_username, \
-    count_all_item_ids_in_inventory
+    count_all_item_ids_in_inventory, count_my_items
+from http_caching import not_modified
+from inventory_versions import items_api_etag
+from loading import ITEM_API_LOAD
+from query_stats import query_budget
 from routes.items_routes import _get_inventory, _process_url_query
 
 api_routes = Blueprint('api', __name__)
@@ -42,6 +46,7 @@ def user_items():
 
 @api_routes.route('/api/items/@<string:username>/<inventory_slug>', methods=['GET', 'POST'])
 @login_required
+@query_budget(15)
 def items(username=None, inventory_slug=None):
     inventory_slug = bleach.clean(inventory_slug.strip())
     inventory_owner_username = bleach.clean(username)
@@ -75,6 +80,12 @@ def items(username=None, inventory_slug=None):
                                                                         inventory_owner_id=inventory_owner_id,
                                                                         logged_in_user_id=logged_in_user_id)
 
+    # nothing changed since the client's copy: answer before reading any items
+    etag = items_api_etag(inventory_id=inventory_id, user_id=current_user.id, args=request.args)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
     request_params = _process_url_query(req_=request, inventory_user=requested_user)
 
     search_query = request.args.get("search[value]", None)
@@ -82,14 +93,21 @@ def items(username=None, inventory_slug=None):
         if len(search_query) < 3:
             search_query = None
 
+    # DataTables sends the index of the ordered column, map it to the column's data name
+    order_0 = request.args.get("order[0][column]", None)
+    order_column = None
+    if order_0 is not None:
+        order_column = request.args.get(f"columns[{order_0}][data]", order_0)
+
     query_params = {
         'item_location': request_params.get("requested_item_location_id", None),
         'item_specific_location': request_params.get("item_specific_location", None),
         'item_tags': request_params.get("requested_tag_strings", None),
         'item_type': request_params.get("requested_item_type_id", None),
-        'start': request.args.get("start", 0),
-        'length': request.args.get("length", 50),
-        'order_0': request.args.get("order[0][column]", None),
+        'start': request.args.get("start", 0, type=int),
+        'length': request.args.get("length", 50, type=int),
+        'after_id': request.args.get("after_id", None, type=int),
+        'order_column': order_column,
         'dir_0': request.args.get("order[0][dir]", None),
         'search': search_query,
     }
@@ -97,9 +115,12 @@ def items(username=None, inventory_slug=None):
     items_ = find_items_new(inventory_id=inventory_id,
                             query_params=query_params,
                             requested_username=current_user.username,
-                            logged_in_user=current_user)
+                            logged_in_user=current_user,
+                            load_options=ITEM_API_LOAD)
 
     num_items_in_inventory = count_all_item_ids_in_inventory(user_id=current_user.id, inventory_id=inventory_id)
+    num_items_filtered = count_my_items(logged_in_user=current_user, inventory_id=inventory_id,
+                                        query_params=query_params)
 
     ret_items = []
     for row in items_:
@@ -124,11 +145,18 @@ def items(username=None, inventory_slug=None):
             "id": item_.id
         })
 
-    return {
+    response_data = {
         "data": ret_items,
-        "recordTotals": num_items_in_inventory,
-        "recordsFiltered": num_items_in_inventory #len(ret_items)
+        "recordsTotal": num_items_in_inventory,
+        "recordsFiltered": num_items_filtered
     }
+    # the client leaves the draw counter out to be able to reuse its cached copies
+    if "draw" in request.args:
+        response_data["draw"] = request.args.get("draw", 0, type=int)
+
+    response = jsonify(response_data)
+    response.set_etag(etag)
+    return response
 
 
 @api_routes.route('/api/locations', methods=['GET'])
@@ -12,6 +12,7 @@ from database_functions import find_user, save_new_user, find_user_by_token, act
 from email_utils import send_email
 from models import User
 from routes.index_routes import profile
+from user_cache import load_session_user
 
 auth_flask_login = Blueprint('auth_flask_login', __name__, template_folder='templates')
 
@@ -399,7 +400,7 @@ def load_user(id):
     if id is None:
         redirect('/login')
 
-    user = User.query.filter_by(id=id).first()
+    user = load_session_user(user_id=id)
     if user is not None:
         if user.is_active:
             return user
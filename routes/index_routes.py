@@ -3,6 +3,8 @@ from flask import Blueprint, render_template, request, redirect, url_for, send_f
 from flask_login import login_required, current_user
 
 from app import app
+from image_derivatives import image_variant_url
+from models import Image
 from database_functions import get_user_inventories, get_user_item_count, get_user_templates, get_user_locations, \
     get_all_itemtypes_for_user, find_user_by_username, delete_notification_by_id, get_number_user_locations, \
     get_all_user_fields
@@ -25,15 +27,43 @@ def index():
         return render_template('index.html')
 
 
+def _image_filename_and_variants(image) -> tuple:
+    # an Image row, or only a filename, whose variants are then unknown
+    if isinstance(image, Image):
+        return image.image_filename, image.variants
+    return image, None
+
+
 @app.context_processor
 def utility_processor():
-    def get_image_url(user_id, image_id):
+    def get_image_url(user_id, image, size=None):
+        user_id = bleach.clean(str(user_id))
+        image_filename, variants = _image_filename_and_variants(image)
+        image_filename = bleach.clean(str(image_filename))
+        base_url = app.config['USER_IMAGES_BASE_URL']
+        if size is None:
+            image = f"{base_url}/{user_id}/{image_filename}"
+            return image
+        return image_variant_url(base_url=f"{base_url}/{user_id}", image_filename=image_filename,
+                                 variants_json=variants, size=size,
+                                 placeholder_url=url_for('static', filename='img/image-processing.svg'))
+
+    def get_image_webp_url(user_id, image, size=None):
         user_id = bleach.clean(str(user_id))
-        image_id = bleach.clean(str(image_id))
+        image_filename, variants = _image_filename_and_variants(image)
+        image_filename = bleach.clean(str(image_filename))
         base_url = app.config['USER_IMAGES_BASE_URL']
-        image = f"{base_url}/{user_id}/{image_id}"
-        return image
-    return dict(get_image_url=get_image_url)
+        return image_variant_url(base_url=f"{base_url}/{user_id}", image_filename=image_filename,
+                                 variants_json=variants, size=size, extension="webp")
+
+    def item_main_image(item):
+        """The Image of an item's main image among its loaded images, or its filename."""
+        for image in item.images:
+            if image.image_filename == item.main_image:
+                return image
+        return item.main_image
+
+    return dict(get_image_url=get_image_url, get_image_webp_url=get_image_webp_url, item_main_image=item_main_image)
 
 
 @main.route('/testimages/<string:image_id>')
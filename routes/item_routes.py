@@ -1,13 +1,11 @@
 import collections
+import functools
 import json
 import os
-import pathlib
 import random
 import string
-from io import BytesIO
 
 import bleach
-from PIL import Image
 from flask import Blueprint, render_template, redirect, url_for, request, jsonify, flash
 from flask_login import login_required, current_user
 # from flask_weasyprint import render_pdf, HTML
@@ -20,9 +18,11 @@ from database_functions import get_all_user_locations, \
     get_item_fields, get_all_item_fields, \
     get_all_fields, set_field_status, update_item_fields, \
     set_inventory_default_fields, save_inventory_fieldtemplate, get_user_location_by_id, unrelate_items_by_id, \
-    find_item_by_slug, relate_items_by_id, find_user_by_username, __PUBLIC__, __PRIVATE__, __VIEWER__, __INVENTORY__, \
-    __LIST__
-from utils import correct_image_orientation, generate_item_image_filename
+    find_item_by_slug, relate_items_by_id, find_user_by_username, set_image_variants, __PUBLIC__, __PRIVATE__, \
+    __VIEWER__, __INVENTORY__, __LIST__
+from http_caching import set_cache_policy, REVALIDATE
+from image_derivatives import submit_derivatives
+from image_store import stage_upload, store_staged, user_images_directory
 
 item_routes = Blueprint('item', __name__)
 
@@ -114,6 +114,9 @@ def item_with_username_and_inventory(username: str, inventory_slug: str, item_sl
     if item_ is None or inventory_item_ is None:
         return render_template('404.html', message="No such item or you do not have access to this item"), 404
 
+    if inventory_.access_level == __PUBLIC__:
+        set_cache_policy(REVALIDATE)
+
     item_fields = get_item_fields(item_id=item_.id)
 
     ii = {}
@@ -432,29 +435,40 @@ def upload():
     except ValueError:
         pass # for now
 
-    uploaded_files = request.files.getlist("file[]")
-    for file in uploaded_files:
-
-        new_filename = generate_item_image_filename(item_slug=item_slug, item_id=item_id, img_type="jpg")
-        new_filename_list.append(new_filename)
-
-        in_mem_file = BytesIO(file.read())
-        image = Image.open(in_mem_file)
-
-        image = correct_image_orientation(image=image)
-
-        image = image.convert('RGB')
-        image.thumbnail((600, 600))
-        in_mem_file = BytesIO()
-        image.save(in_mem_file, format="JPEG")
-        in_mem_file.seek(0)
-
-        user_id = str(current_user.id)
-
-        pathlib.Path(os.path.join(app.config['USER_IMAGES_BASE_PATH'], user_id, new_filename)).write_bytes(
-            in_mem_file.getbuffer().tobytes())
-
-    add_images_to_item(item_id=item_id, filenames=new_filename_list, user=current_user)
+    images_directory = user_images_directory(current_user.id)
+
+    # files are stored by content, an image the user already has is not stored or processed again
+    stored_uploads = []
+    for file in request.files.getlist("file[]"):
+        if not file.filename:
+            continue
+        upload_path, digest = stage_upload(upload_file=file.stream, directory=images_directory)
+        new_filename, is_new = store_staged(staged_path=upload_path, digest=digest, directory=images_directory)
+        if is_new:
+            stored_uploads.append((file.filename, new_filename))
+        if new_filename not in new_filename_list:
+            new_filename_list.append(new_filename)
+
+    # the images are recorded straight away, with no variants yet (PENDING_VARIANTS in
+    # image_derivatives), and shown as placeholders until the image workers have written their files
+    if len(new_filename_list) > 0:
+        add_images_to_item(item_id=item_id, filenames=new_filename_list, user=current_user,
+                           variants={new_filename: {} for original_filename, new_filename in stored_uploads})
+
+    user_id = current_user.id
+    for original_filename, new_filename in stored_uploads:
+        try:
+            queued = submit_derivatives(image_filename=new_filename, directory=images_directory,
+                                        on_done=functools.partial(set_image_variants, new_filename, user_id))
+        except Exception as e:
+            app.logger.error(f"Could not queue image {new_filename} for processing: {str(e)}")
+            queued = False
+        if not queued:
+            # only this item lets go of the image, other items may share its row (see image_store.py);
+            # the row and its file go when no item is left
+            delete_images_from_item(item_id=item_id, image_ids=[new_filename], user=current_user)
+            flash(message=f"Sorry, the server is busy and could not take {bleach.clean(original_filename)}, "
+                          f"please try again shortly.")
 
     return redirect(url_for('item.item_with_username_and_inventory',
                             username=username,
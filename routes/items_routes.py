@@ -4,18 +4,24 @@ import json
 import os
 
 import csv
-import traceback
+import uuid
+import zipfile
 from json import JSONDecodeError
 
 import bleach
 import pdfkit
-from flask import make_response, flash
+from flask import make_response, flash, jsonify
 
 from flask import Blueprint, render_template, redirect, url_for, request, current_app
 from flask_login import login_required, current_user
-from slugify import slugify
+from werkzeug.utils import secure_filename
 
 from app import app
+from bulk_import import BulkImporter
+from export_archive import ArchiveWriter, is_archive, verify_manifest, read_archive_inventories, extract_image
+from http_caching import set_cache_policy, REVALIDATE
+from image_store import store_bytes, user_images_directory
+from jobs import submit_job, job_handler
 from routes.index_routes import profile
 from database_functions import get_all_user_locations, \
     get_all_item_types, \
@@ -25,15 +31,21 @@ from database_functions import get_all_user_locations, \
     get_user_templates, get_item_custom_field_data, \
     get_users_for_inventory, get_user_inventory_by_id, get_or_add_new_location, edit_items_locations, \
     change_item_access_level, link_items, copy_items, commit, find_items_new, __PUBLIC__, __PRIVATE__, \
-    find_user_by_username, add_images_to_item, set_item_main_image, get_user_inventories, add_user_inventory, \
-    save_template_fields, get_item_fields, save_inventory_fieldtemplate, find_template_by_id, save_user_inventory_view, \
-    get_related_items, get_all_item_ids_in_inventory, find_item_by_id, update_item_by_id, find_item_by_slug
+    find_user_by_username, get_user_inventories, add_user_inventory, save_template_fields, \
+    save_inventory_fieldtemplate, find_template_by_id, save_user_inventory_view, get_export_item_data, \
+    get_all_item_ids_in_inventory, find_item_by_id, find_user_by_id
+from loading import ITEM_LIST_LOAD, ITEM_EXPORT_LOAD
 from models import FieldTemplate
+from query_stats import query_budget
 
-from utils import generate_item_image_filename
 
 items_routes = Blueprint('items', __name__)
 
+# items are exported in keyset pages of this size, so memory use does not grow with the inventory
+EXPORT_PAGE_SIZE = 200
+# images are read and base64 encoded in chunks; a multiple of 3 so the encoded chunks concatenate
+EXPORT_IMAGE_CHUNK_SIZE = 3 * 64 * 1024
+
 
 @items_routes.context_processor
 def my_utility_processor():
@@ -61,255 +73,257 @@ def _find_list_index(list_, value):
         return -1
 
 
+def _clean_import_item(item: dict) -> dict:
+    """
+    Sanitise an imported item for the bulk importer.
+    """
+    item_type = item.get("type", "none")
+    if item_type is not None:
+        item_type = bleach.clean(item_type)
+
+    return {
+        "id": item.get("id"),
+        "name": bleach.clean(item.get("name")),
+        "slug": bleach.clean(item.get("slug")),
+        "description": bleach.clean(item.get("description") or ""),
+        "type": item_type,
+        "quantity": int(bleach.clean(str(item.get("quantity")))),
+        "tags": [bleach.clean(str(x)) for x in item.get("tags", [])],
+        "location": bleach.clean(item.get("location") or ""),
+        "specific_location": bleach.clean(item.get("specific_location") or ""),
+        "custom_fields": item.get("custom_fields", {}),
+        "images": item.get("images", []),
+    }
+
+
+def _save_imported_images(item: dict, item_id: int, item_name: str, user_id: int, import_archive_=None) -> list:
+    """
+    Store the image files of an imported item, from an export archive or from base64 JSON.
+
+    Images are stored by content (see image_store.py), unchanged images are not written again.
+
+    :return: The store filenames of the verified images, the main image first.
+    """
+    import base64
+
+    images_directory = user_images_directory(user_id)
+    item_image_filename = []
+
+    for img in item.get("images", []):
+        if import_archive_ is not None:
+            img_filename = extract_image(import_archive_, img, images_directory)
+            if img_filename is None:
+                continue
+        else:
+            img_data = img.get("image_data", None)
+            img_hash = img.get("image_hash", None)
+            if img_data is None:
+                continue
+
+            raw = img_data.encode('utf-8')
+            key = app.config['IMAGE_SECRET_KEY'].encode('utf-8')
+            hashed = hmac.new(key, raw, hashlib.sha1)
+            img_hmac_hash = base64.encodebytes(hashed.digest()).decode('utf-8')
+
+            if img_hash != img_hmac_hash:
+                continue
+
+            extension = os.path.splitext(img.get("image_filename") or "")[1].lstrip(".").lower() or "jpg"
+            img_filename = store_bytes(base64.b64decode(img_data), images_directory, extension=extension)
+
+        if img_filename in item_image_filename:
+            continue
+        if str(img.get("is_main", "false")).lower() == "true":
+            item_image_filename.insert(0, img_filename)
+        else:
+            item_image_filename.append(img_filename)
+
+    return item_image_filename
+
+
 @items_routes.route('/items/load', methods=['POST'])
 @login_required
 def items_load():
-    load_log = ""
     username = current_user.username
 
+    if request.method == 'POST' and request.files:
+        inventory_slug_from_form = request.form.get("inventory_slug")
+        inventory_slug_from_form = bleach.clean(inventory_slug_from_form)
+        overwrite_or_not_from_form = bleach.clean(str(request.form.get("overwrite_or_not")))
+        overwrite_or_not_from_form = True if overwrite_or_not_from_form == "on" else False
+
+        uploaded_file = request.files['file']
+        # uploads are kept until the import job has read them, make the name unique
+        filename = f"{current_user.id}-{uuid.uuid4().hex}-{secure_filename(uploaded_file.filename)}"
+        filepath = os.path.join(app.config['FILE_UPLOADS'], filename)
+        try:
+            uploaded_file.save(filepath)
+        except FileNotFoundError as fnfe:
+            app.logger.error(f"Error saving uploaded file: {str(fnfe)} for user {current_user.username}")
+            flash(message="Sorry, there was an error saving the uploaded file.")
+            return profile(username=username)
+
+        job_id = submit_job("items_import", user_id=current_user.id,
+                            params={"filepath": filepath, "inventory_slug": inventory_slug_from_form,
+                                    "overwrite": overwrite_or_not_from_form})
+        return redirect(url_for('jobs.job_page', job_id=job_id))
+
+    return profile(username=username)
+
+
+@job_handler("items_import")
+def _items_import_job(job, filepath: str, inventory_slug: str, overwrite: bool):
+    user = find_user_by_id(user_id=job.user_id)
     try:
-        if request.method == 'POST':
-            inventory_slug_from_form = request.form.get("inventory_slug")
-            inventory_slug_from_form = bleach.clean(inventory_slug_from_form)
-            overwrite_or_not_from_form = bleach.clean(str(request.form.get("overwrite_or_not")))
-            overwrite_or_not_from_form = True if overwrite_or_not_from_form == "on" else False
-
-            if request.files:
-                uploaded_file = request.files['file']  # This line uses the same variable and worked fine
-                filepath = os.path.join(app.config['FILE_UPLOADS'], uploaded_file.filename)
-                try:
-                    uploaded_file.save(filepath)
-                except FileNotFoundError as fnfe:
-                    app.logger.error(f"Error saving uploaded file: {str(fnfe)} for user {current_user.username}")
-                    flash(message="Sorry, there was an error saving the uploaded file.")
+        return import_items_file(filepath=filepath, user=user, inventory_slug_from_form=inventory_slug,
+                                 overwrite_or_not_from_form=overwrite,
+                                 progress=lambda number_done: job.progress(number_done,
+                                                                           message=f"Imported {number_done} things"))
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
-                import mimetypes
-                import_file_mimetype = mimetypes.MimeTypes().guess_type(filepath)[0]
-                if "application/json" not in import_file_mimetype:
-                    flash("Uploaded file does not seem to be a JSON file.")
-                    return profile(username=username)
 
-                try:
-                    with open(filepath, 'r') as f:
-                        try:
-                            data = json.load(f)
-                        except JSONDecodeError as e:
-                            flash("Uploaded file does not seem to be a valid JSON file.")
-                            return profile(username=username)
-
-                        for inventory_ in data:
-                            inventory_data = inventory_.get("inventory", None)
-                            if inventory_data is None:
-                                break
-
-                            inventory_slug_ = inventory_data.get("slug", None)
-                            inventory_slug_ = bleach.clean(inventory_slug_)
-
-                            found_inv, found_userinv = find_inventory_by_slug(inventory_slug=inventory_slug_,
-                                                                              inventory_owner_id=current_user.id,
-                                                                              viewing_user_id=current_user.id)
-
-                            if found_inv is None:
-                                load_log += f"<br>Inventory {inventory_slug_} not found. Creating it...<br>"
-                                inventory_name = bleach.clean(inventory_data.get("name"))
-                                inventory_description = bleach.clean(inventory_data.get("description"))
-                                inventory_type = int(bleach.clean(str(inventory_data.get("type", 1))))
-                                inventory_access_level = int(bleach.clean(str(inventory_data.get("access_level", 1))))
-
-                                found_inv, status = add_user_inventory(name=inventory_name,
-                                                                       description=inventory_description,
-                                                                       inventory_type=inventory_type,
-                                                                       slug=inventory_slug_,
-                                                                       access_level=inventory_access_level,
-                                                                       user_id=current_user.id)
-                                if status != "success":
-                                    load_log += f"Error creating inventory {inventory_slug_}.<br>"
-                                    continue
-
-                            else:
-                                load_log += f"<br>Inventory {found_inv.name} found...<br>"
-                                found_inv = {
-                                    "id": found_inv.id,
-                                    "name": found_inv.name,
-                                    "description": found_inv.description,
-                                    "slug": found_inv.slug,
-                                    "type": found_inv.type,
-                                    "access_level": found_inv.access_level,
-                                    "owner_id": found_inv.owner_id
-                                }
-
-                            # lets sort the field template out
-                            field_set_ = inventory_data.get("field_set", None)
-                            if field_set_ is not None:
-                                template_name_ = bleach.clean(inventory_data.get("name"))
-
-                                if template_name_ is not None:
-                                    template_slugs_ = field_set_.get("slugs", [])
-                                    if len(template_slugs_) > 0:
-                                        template_slugs_ = [bleach.clean(str(x)) for x in template_slugs_]
-                                        field_template_id_ = save_template_fields(template_name=template_name_,
-                                                                                  fields=template_slugs_, user=current_user)
-
-                                        status, save_inv_fieldtemplate_msg = save_inventory_fieldtemplate(inventory_id=found_inv["id"],
-                                                                              inventory_template=field_template_id_,
-                                                                              user_id=current_user.id)
-                                        if status:
-                                            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... created field template {template_name_}.<br>"
-                                        else:
-                                            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... could no create field template {template_name_}.<br>"
-
-                                else:
-                                    load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... no field template found/used.<br>"
-
-
-                            # If we are importing into a specific inventory, only import into that inventory
-                            if inventory_slug_from_form != "all":
-                                if inventory_slug_ != inventory_slug_from_form:
-                                    continue
-
-                            inventory_id = found_inv["id"]
-
-                            item_count = 0
-                            if "items" in inventory_data:
-                                for item in inventory_data["items"]:
-                                    item_id = int(bleach.clean(str(item.get("id"))))
-                                    if not overwrite_or_not_from_form:
-                                        item_id = None
-                                    item_name = bleach.clean(item.get("name"))
-                                    item_slug = bleach.clean(item.get("slug"))
-                                    item_description = bleach.clean(item.get("description"))
-                                    item_type = item.get("type", "none")
-                                    if item_type is not None:
-                                        item_type = bleach.clean(item_type)
-                                    item_quantity = int(bleach.clean(str(item.get("quantity"))))
-                                    item_tags = [bleach.clean(str(x)) for x in item.get("tags")]
-                                    item_location = bleach.clean(item.get("location"))
-                                    item_specific_location = bleach.clean(item.get("specific_location"))
-
-                                    # add item types
-                                    if item_type is not None and item_type != 'none':
-                                        status, add_item_type_msg = add_new_user_itemtype(name=item_type,
-                                                                                          user_id=current_user.id)
-
-                                    location_id = None
-                                    if item_location is not None:
-                                        if item_location.strip() != "":
-                                            location_data_ = get_or_add_new_location(location_name=item_location,
-                                                                                     location_description=item_location,
-                                                                                     to_user_id=current_user.id)
-
-                                            if location_data_["status"] and location_data_["new"]:
-                                                load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... created location {item_location}.<br>"
-
-                                            if not location_data_["status"]:
-                                                load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... could not create location {item_location}.<br>"
-
-                                            location_id = location_data_.get("id")
-
-                                    tag_array = item_tags
-
-                                    if isinstance(tag_array, list):
-                                        for t in range(len(tag_array)):
-                                            tag_array[t] = tag_array[t].strip()
-                                            tag_array[t] = tag_array[t].replace(" ", "@#$")
-
-                                    custom_fields = item.get("custom_fields", {})
-
-                                    if overwrite_or_not_from_form:
-                                        potential_item = find_item_by_slug(item_slug=item_slug, user_id=current_user.id)
-                                        if potential_item is None:
-                                            new_item_ = add_item_to_inventory(item_id=item_id, item_name=item_name,
-                                                                              item_desc=item_description,
-                                                                              item_type=item_type,
-                                                                              item_quantity=item_quantity,
-                                                                              item_tags=tag_array,
-                                                                              inventory_id=inventory_id,
-                                                                              item_location_id=location_id,
-                                                                              item_specific_location=item_specific_location,
-                                                                              user_id=current_user.id,
-                                                                              custom_fields=custom_fields)
-                                            item_count += 1
-                                        else:
-                                            new_item_data = {
-                                                "id": item_id,
-                                                "name": item_name,
-                                                "description": item_description,
-                                                "item_type": item_type,
-                                                "item_quantity": item_quantity,
-                                                "item_location": item_location,
-                                                "item_specific_location": item_specific_location,
-                                                "item_tags": item_tags
-                                            }
-                                            new_item_ = update_item_by_id(item_data=new_item_data, item_id=int(item_id),
-                                                                              user=current_user)
-                                            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... item {item_name} found and updated if different.<br>"
-                                    else:
-                                        new_item_ = add_item_to_inventory(item_id=item_id, item_name=item_name,
-                                                                          item_desc=item_description,
-                                                                          item_type=item_type, item_quantity=item_quantity,
-                                                                          item_tags=tag_array, inventory_id=inventory_id,
-                                                                          item_location_id=location_id,
-                                                                          item_specific_location=item_specific_location,
-                                                                          user_id=current_user.id,
-                                                                          custom_fields=custom_fields)
-                                        item_count += 1
-
-                                    if new_item_["status"] != "error":
-                                        # save images
-                                        item_image_filename = []
-                                        for img in item["images"]:
-                                            img_filename = img.get("image_filename", None)
-
-                                            item_slug = f"{str(new_item_['item']['id'])}-{slugify(new_item_['item']['name'])}"
-
-                                            if img_filename is None:
-                                                img_filename = generate_item_image_filename(item_slug=item_slug,
-                                                                                            item_id=item_id, img_type="jpg")
-
-                                            img_is_main = img.get("is_main", "false")
-                                            img_data = img.get("image_data", None)
-                                            img_hash = img.get("image_hash", None)
-
-                                            if img_is_main == "true":
-                                                set_item_main_image(main_image_url=img_filename, item_id=item_id,
-                                                                    user=current_user)
-
-                                            img_filepath = os.path.join(app.root_path, app.config['USER_IMAGES_BASE_PATH'],
-                                                                        str(current_user.id), img_filename)
-
-                                            import base64
-                                            imgdata = base64.b64decode(img_data)
-
-                                            raw = img_data.encode('utf-8')
-                                            key = app.config['IMAGE_SECRET_KEY'].encode('utf-8')
-                                            hashed = hmac.new(key, raw, hashlib.sha1)
-                                            img_hmac_hash = base64.encodebytes(hashed.digest()).decode('utf-8')
-
-                                            if img_hash == img_hmac_hash:
-                                                with open(img_filepath, 'wb') as img_file:
-                                                    img_file.write(imgdata)
-                                                    item_image_filename.append(img_filename)
-
-                                        add_images_to_item(new_item_['item']['id'], item_image_filename, user=current_user)
-
-                                    if new_item_["status"] == "error":
-                                        flash("Sorry, there was an error importing these things.")
-                                        return profile(username=username)
-
-
-                            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... imported {item_count} items into inventory {inventory_slug_}.<br>"
-
-                            # set up related items
-                            d = 4
+def import_items_file(filepath: str, user, inventory_slug_from_form: str, overwrite_or_not_from_form: bool,
+                      progress=None) -> str:
+    """
+    Import an export file (JSON or archive) into a user's inventories.
+
+    :param filepath: The path of the uploaded export file.
+    :param user: The importing user.
+    :param inventory_slug_from_form: The slug of the only inventory to import, or "all".
+    :param overwrite_or_not_from_form: Update existing items with the same slug instead of adding new ones.
+    :param progress: Optional callable(number_done: int) called as items are imported.
+    :return: The import log, as HTML.
+    """
+    load_log = ""
+
+    import_archive_ = None
+    if is_archive(filepath):
+        import_archive_ = zipfile.ZipFile(filepath)
+        if not verify_manifest(import_archive_):
+            import_archive_.close()
+            return load_log + "Uploaded archive could not be verified."
+        data = read_archive_inventories(import_archive_)
+    else:
+        import mimetypes
+        import_file_mimetype = mimetypes.MimeTypes().guess_type(filepath)[0]
+        if import_file_mimetype is None or "application/json" not in import_file_mimetype:
+            return load_log + "Uploaded file does not seem to be a JSON file or an export archive."
 
+        with open(filepath, 'r') as f:
+            try:
+                data = json.load(f)
+            except JSONDecodeError as e:
+                return load_log + "Uploaded file does not seem to be a valid JSON file."
 
+    importer = BulkImporter(user_id=user.id, overwrite=overwrite_or_not_from_form, progress=progress,
+                            save_images=lambda item_, item_id_, item_name_: _save_imported_images(
+                                item_, item_id_, item_name_, user.id, import_archive_))
+
+    try:
+        for inventory_ in data:
+            inventory_data = inventory_.get("inventory", None)
+            if inventory_data is None:
+                break
+
+            inventory_slug_ = inventory_data.get("slug", None)
+            inventory_slug_ = bleach.clean(inventory_slug_)
+
+            found_inv, found_userinv = find_inventory_by_slug(inventory_slug=inventory_slug_,
+                                                              inventory_owner_id=user.id,
+                                                              viewing_user_id=user.id)
+
+            if found_inv is None:
+                load_log += f"<br>Inventory {inventory_slug_} not found. Creating it...<br>"
+                inventory_name = bleach.clean(inventory_data.get("name"))
+                inventory_description = bleach.clean(inventory_data.get("description"))
+                inventory_type = int(bleach.clean(str(inventory_data.get("type", 1))))
+                inventory_access_level = int(bleach.clean(str(inventory_data.get("access_level", 1))))
+
+                found_inv, status = add_user_inventory(name=inventory_name,
+                                                       description=inventory_description,
+                                                       inventory_type=inventory_type,
+                                                       slug=inventory_slug_,
+                                                       access_level=inventory_access_level,
+                                                       user_id=user.id)
+                if status != "success":
+                    load_log += f"Error creating inventory {inventory_slug_}.<br>"
+                    continue
+
+            else:
+                load_log += f"<br>Inventory {found_inv.name} found...<br>"
+                found_inv = {
+                    "id": found_inv.id,
+                    "name": found_inv.name,
+                    "description": found_inv.description,
+                    "slug": found_inv.slug,
+                    "type": found_inv.type,
+                    "access_level": found_inv.access_level,
+                    "owner_id": found_inv.owner_id
+                }
+
+            # lets sort the field template out
+            field_set_ = inventory_data.get("field_set", None)
+            if field_set_ is not None:
+                template_name_ = bleach.clean(inventory_data.get("name"))
+
+                if template_name_ is not None:
+                    template_slugs_ = field_set_.get("slugs", [])
+                    if len(template_slugs_) > 0:
+                        template_slugs_ = [bleach.clean(str(x)) for x in template_slugs_]
+                        field_template_id_ = save_template_fields(template_name=template_name_,
+                                                                  fields=template_slugs_, user=user)
+
+                        status, save_inv_fieldtemplate_msg = save_inventory_fieldtemplate(inventory_id=found_inv["id"],
+                                                              inventory_template=field_template_id_,
+                                                              user_id=user.id)
+                        if status:
+                            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... created field template {template_name_}.<br>"
+                        else:
+                            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... could no create field template {template_name_}.<br>"
+
+                else:
+                    load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... no field template found/used.<br>"
+
+
+            # If we are importing into a specific inventory, only import into that inventory
+            if inventory_slug_from_form != "all":
+                if inventory_slug_ != inventory_slug_from_form:
+                    continue
+
+            inventory_id = found_inv["id"]
+
+            item_count = 0
+            if "items" in inventory_data:
+                number_new_locations = len(importer.new_locations)
+                try:
+                    import_result = importer.import_items(
+                        inventory_id=inventory_id,
+                        items=(_clean_import_item(x) for x in inventory_data["items"]))
                 except Exception as ex:
-                    app.logger.error(f"Error importing items: {str(ex)}")
-    except Exception as e:
-        traceback.print_exc()
+                    app.logger.error(f"Error importing items into inventory {inventory_slug_}: {str(ex)}")
+                    return load_log + "Sorry, there was an error importing these things."
 
-    flash(message=load_log)
-    return profile(username=username)
+                for location_name in importer.new_locations[number_new_locations:]:
+                    load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... created location {location_name}.<br>"
+                if import_result["updated"] > 0:
+                    load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... {import_result['updated']} items found and updated.<br>"
+                item_count = import_result["added"]
+
+            load_log += f"&nbsp;&nbsp;&nbsp;&nbsp;... imported {item_count} items into inventory {inventory_slug_}.<br>"
+
+            # set up related items
+            d = 4
+
+
+    except Exception as ex:
+        app.logger.error(f"Error importing items: {str(ex)}")
+    finally:
+        if import_archive_ is not None:
+            import_archive_.close()
+
+    return load_log
 
 
 @items_routes.route('/items/load', methods=['POST'])
@@ -574,8 +588,7 @@ def items_manage():
 @login_required
 def items_save():
     inventory_slug = request.form.get("inventory_slug")
-
-    filename = f"{current_user.username}_{inventory_slug}_export.json"
+    export_format = request.form.get("export_format", "json")
 
     request_params = _process_url_query(req_=request, inventory_user=current_user)
 
@@ -585,129 +598,277 @@ def items_save():
         user_inventories = get_user_inventories(current_user_id=current_user.id, requesting_user_id=current_user.id)
         for ui in user_inventories:
             inventory_list.append(ui["inventory_slug"])
+    elif inventory_slug == "default":
+        inventory_list = [f"default-{current_user.username}"]
     else:
         inventory_list = [inventory_slug]
 
-    entire_json = []
-    for inv_slug in inventory_list:
+    if export_format == "archive":
+        filename = f"{current_user.username}_{inventory_slug}_export.zip"
+    else:
+        export_format = "json"
+        filename = f"{current_user.username}_{inventory_slug}_export.json"
 
-        inventory_id, inventory_, inventory_default_fields = _get_inventory(inventory_slug=inv_slug,
-                                                                            logged_in_user_id=current_user.id,
-                                                                            inventory_owner_id=current_user.id)
+    job_id = submit_job("items_export", user_id=current_user.id,
+                        params={"inventory_list": inventory_list, "request_params": request_params,
+                                "export_format": export_format, "filename": filename})
+    return redirect(url_for('jobs.job_page', job_id=job_id))
 
-        data_dict, item_id_list = find_items_query(current_user.username,
-                                                   current_user, inventory_id, request_params=request_params)
 
-        dd, slugs, newdd = get_item_custom_field_data(user_id=current_user.id, item_list=item_id_list)
+@job_handler("items_export")
+def _items_export_job(job, inventory_list: list, request_params: dict, export_format: str, filename: str):
+    user = find_user_by_id(user_id=job.user_id)
 
-        # save the json items with a flag stating if they are just links to other items in the inventroy
-        if inventory_default_fields is not None:
-            inventory_field_template_name = inventory_default_fields.name
-        else:
-            inventory_field_template_name = None
+    number_exported = [0]
 
-        field_set = set()
-        field_set2 = list()
+    def _progress(number_in_page):
+        number_exported[0] += number_in_page
+        job.progress(number_exported[0], message=f"Exported {number_exported[0]} things")
 
-        for dn, dv in dd.items():
-            dv_lower = [x.lower() for x in list(dv.keys())]
-            field_set.update(dv_lower)
+    if export_format == "archive":
+        stream = _export_archive_stream(inventory_list, request_params, user, progress=_progress)
+    else:
+        stream = _export_json_stream(inventory_list, request_params, user, progress=_progress)
+
+    with open(job.result_path(filename), "wb") as export_file:
+        for chunk in stream:
+            export_file.write(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+
+    job.progress(number_exported[0], force=True)
+    return f"Exported {number_exported[0]} things."
+
+
+def _export_item_pages(inventory_id: int, request_params: dict, user):
+    """
+    Yield the items of an inventory as (data_dict, item_id_list) pages, ordered by item id.
+    """
+    after_id = None
+    while True:
+        data_dict, item_id_list = find_items_query(user.username, user, inventory_id,
+                                                   request_params=request_params, load_options=ITEM_EXPORT_LOAD,
+                                                   after_id=after_id, length=EXPORT_PAGE_SIZE)
+        if len(data_dict) == 0:
+            return
+
+        yield data_dict, item_id_list
+
+        if len(item_id_list) < EXPORT_PAGE_SIZE:
+            return
+        after_id = item_id_list[-1]
 
-        wewe = {}
-        for dfdf, dvvv in newdd.items():
 
+def _export_inventory_items(inventory_id: int, request_params: dict, user, field_summary: dict, progress=None):
+    """
+    Yield (row, item_data) for every exported item of an inventory, a page at a time.
+
+    Summarises the custom fields of the items into field_summary on the way, which is
+    complete once all items have been yielded. progress, if given, is called with the
+    number of items of every page written.
+    """
+    field_summary.setdefault("fields", set())
+    field_summary.setdefault("slugs", [])
+    field_summary.setdefault("custom_field_set", {})
+
+    for data_dict, item_id_list in _export_item_pages(inventory_id, request_params, user):
+        dd, page_slugs, newdd = get_item_custom_field_data(user_id=user.id, item_list=item_id_list)
+
+        for dn, dv in dd.items():
+            field_summary["fields"].update([x.lower() for x in list(dv.keys())])
+        for slug_ in page_slugs:
+            if slug_ not in field_summary["slugs"]:
+                field_summary["slugs"].append(slug_)
+        for dfdf, dvvv in newdd.items():
             for df in dvvv:
-                wewe[df['slug']] = df
-                d = 3
-
-
-        headers_ = ["id", "name", "description", "tags", "type", "location", "specific location", "quantity"]
-        headers_.extend(field_set)
-
-        if inventory_ is not None:
-            json_output = {
-                "inventory": {"id": inventory_id, "name": inventory_.name, "description": inventory_.description,
-                              "slug": inv_slug,
-                              "custom_field_set": wewe,
-                              "std_fields": headers_,
-                              "field_set": {
-                                  "name": inventory_field_template_name,
-                                  "fields": list(field_set),
-                                  "slugs": slugs
-                              },
-                              "items": []
-                              }}
-        else:
-            json_output = {
-                "inventory": {"items": []}}
+                field_summary["custom_field_set"][df['slug']] = df
+
+        export_data = get_export_item_data(item_ids=item_id_list)
 
         for row in data_dict:
-            item_ = row["item"]
-            item_custom_fields_ = get_item_fields(item_id=item_.id)
-
-            related_items_ = get_related_items(item_id=item_.id)
-            related_items_dict = {}
-            if len(related_items_) > 0:
-                for related_item in related_items_:
-                    related_items_dict[related_item.item_id] = related_item.related_item_id
-
-            ddd = {}
-            for field_data in item_custom_fields_:
-                field_ = field_data[0]
-                item_field_ = field_data[1]
-                template_field_ = field_data[2]
-                ddd[field_.slug] = item_field_.value
-
-            tmp_json = {
-                "id": item_.id,
-                "name": item_.name,
-                "slug": item_.slug,
-                "description": item_.description,
-                "tags": [x.tag.replace("@#$", " ") for x in item_.tags],
-                "type": row["types"],
-                "location": row["location"],
-                "specific_location": item_.specific_location,
-                "quantity": item_.quantity,
-                "is_link": row["item_is_link"],
-                "custom_fields": ddd,
-                "related_items": related_items_dict
-            }
-
-            current_user_id = str(current_user.id)
-            item_images = []
-            # save images
-            for img in item_.images:
-                tmp_img_dict = {"is_main": False}
-                img_path = os.path.join(app.config['USER_IMAGES_BASE_PATH'],
-                                        current_user_id,
-                                        img.image_filename)
-
-                import base64
-
-                with open(img_path, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read())
-                    raw = encoded_string.decode("utf-8")
-                    tmp_img_dict["image_data"] = raw
-
-                raw = raw.encode("utf-8")
-                key = app.config['IMAGE_SECRET_KEY'].encode('utf-8')
-                hashed = hmac.new(key, raw, hashlib.sha1)
-                img_hmac_hash = base64.encodebytes(hashed.digest()).decode('utf-8')
-                tmp_img_dict["image_hash"] = img_hmac_hash
-
-                item_images.append(tmp_img_dict)
-
-            tmp_json["images"] = item_images
-
-            json_output["inventory"]["items"].append(tmp_json)
-
-        entire_json.append(json_output)
-
-    output = make_response(entire_json)
-    output.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    output.headers["Content-types"] = "text/json"
-
-    return output
+            yield row, export_data[row["item"].id]
+
+        if progress is not None:
+            progress(len(data_dict))
+
+
+def _export_inventory_dict(inventory_id: int, inventory_, inventory_default_fields, inv_slug: str,
+                           field_summary: dict) -> dict:
+    """
+    The details of an exported inventory, without its items.
+    """
+    if inventory_ is None:
+        return {}
+
+    # save the json items with a flag stating if they are just links to other items in the inventroy
+    if inventory_default_fields is not None:
+        inventory_field_template_name = inventory_default_fields.name
+    else:
+        inventory_field_template_name = None
+
+    field_set = field_summary.get("fields", set())
+    headers_ = ["id", "name", "description", "tags", "type", "location", "specific location", "quantity"]
+    headers_.extend(field_set)
+
+    return {"id": inventory_id, "name": inventory_.name, "description": inventory_.description,
+            "slug": inv_slug,
+            "custom_field_set": field_summary.get("custom_field_set", {}),
+            "std_fields": headers_,
+            "field_set": {
+                "name": inventory_field_template_name,
+                "fields": list(field_set),
+                "slugs": field_summary.get("slugs", [])
+            }}
+
+
+def _export_item_dict(row: dict, item_data: dict) -> dict:
+    """
+    The details of an exported item, without its images.
+
+    :param row: The item row from find_items_query.
+    :param item_data: The item's custom fields and related items from get_export_item_data.
+    """
+    item_ = row["item"]
+
+    return {
+        "id": item_.id,
+        "name": item_.name,
+        "slug": item_.slug,
+        "description": item_.description,
+        "tags": [x.tag.replace("@#$", " ") for x in item_.tags],
+        "type": row["types"],
+        "location": row["location"],
+        "specific_location": item_.specific_location,
+        "quantity": item_.quantity,
+        "is_link": row["item_is_link"],
+        "custom_fields": item_data["custom_fields"],
+        "related_items": item_data["related_items"]
+    }
+
+
+def _export_item_image_paths(item_, current_user_id: str):
+    """
+    Yield (image, path) for the images of an item that exist on disk.
+    """
+    for img in item_.images:
+        img_path = os.path.join(user_images_directory(current_user_id), img.image_filename)
+        if not os.path.exists(img_path):
+            app.logger.error(f"Export: image {img.image_filename} of item {item_.id} not found")
+            continue
+        yield img, img_path
+
+
+def _export_image_json(img_path: str):
+    """
+    Yield the JSON export of one image, reading and encoding the file in chunks.
+
+    The HMAC is computed over the base64 text, as items_load expects.
+    """
+    import base64
+
+    key = app.config['IMAGE_SECRET_KEY'].encode('utf-8')
+    hashed = hmac.new(key, digestmod=hashlib.sha1)
+
+    yield '{"is_main": false, "image_data": "'
+    with open(img_path, "rb") as image_file:
+        while True:
+            chunk = image_file.read(EXPORT_IMAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            encoded = base64.b64encode(chunk)
+            hashed.update(encoded)
+            yield encoded.decode("utf-8")
+
+    img_hmac_hash = base64.encodebytes(hashed.digest()).decode('utf-8')
+    yield f'", "image_hash": {json.dumps(img_hmac_hash)}}}'
+
+
+def _export_item_json(row: dict, item_data: dict, current_user_id: str):
+    """
+    Yield the JSON export of one item, its images streamed one chunk at a time.
+    """
+    # the item without its closing brace, then the images
+    yield json.dumps(_export_item_dict(row, item_data))[:-1] + ', "images": ['
+
+    first_image = True
+    for img, img_path in _export_item_image_paths(row["item"], current_user_id):
+        if not first_image:
+            yield ', '
+        first_image = False
+        yield from _export_image_json(img_path)
+
+    yield ']}'
+
+
+def _export_json_stream(inventory_list: list, request_params: dict, user, progress=None):
+    """
+    Yield the JSON export of the given inventories piece by piece.
+
+    Each inventory's items are written first; the inventory's own details, which summarise
+    the custom fields of all its items, are written after them.
+    """
+    current_user_id = str(user.id)
+
+    yield '['
+    for inv_index, inv_slug in enumerate(inventory_list):
+        inventory_id, inventory_, inventory_default_fields = _get_inventory(inventory_slug=inv_slug,
+                                                                            logged_in_user_id=user.id,
+                                                                            inventory_owner_id=user.id)
+
+        if inv_index > 0:
+            yield ', '
+        yield '{"inventory": {"items": ['
+
+        field_summary = {}
+        first_item = True
+        for row, item_data in _export_inventory_items(inventory_id, request_params, user, field_summary,
+                                                      progress=progress):
+            if not first_item:
+                yield ', '
+            first_item = False
+            yield from _export_item_json(row, item_data, current_user_id)
+
+        yield ']'
+
+        inventory_json = _export_inventory_dict(inventory_id, inventory_, inventory_default_fields, inv_slug,
+                                                field_summary)
+        if len(inventory_json) > 0:
+            yield ', ' + json.dumps(inventory_json)[1:]
+        else:
+            yield '}'
+
+        yield '}'
+    yield ']'
+
+
+def _export_archive_stream(inventory_list: list, request_params: dict, user, progress=None):
+    """
+    Yield the archive export (see export_archive) of the given inventories piece by piece.
+    """
+    current_user_id = str(user.id)
+    writer = ArchiveWriter()
+
+    for inv_index, inv_slug in enumerate(inventory_list):
+        inventory_id, inventory_, inventory_default_fields = _get_inventory(inventory_slug=inv_slug,
+                                                                            logged_in_user_id=user.id,
+                                                                            inventory_owner_id=user.id)
+
+        field_summary = {}
+        for row, item_data in _export_inventory_items(inventory_id, request_params, user, field_summary,
+                                                      progress=progress):
+            item_json = _export_item_dict(row, item_data)
+            item_json["images"] = []
+            for img, img_path in _export_item_image_paths(row["item"], current_user_id):
+                yield from writer.add_image(item_id=row["item"].id, image_filename=img.image_filename,
+                                            image_path=img_path)
+                item_json["images"].append({"is_main": False, "image_filename": img.image_filename,
+                                            **writer.last_entry})
+
+            writer.add_record({"record": "item", "inventory": inv_index, **item_json})
+
+        inventory_json = _export_inventory_dict(inventory_id, inventory_, inventory_default_fields, inv_slug,
+                                                field_summary)
+        writer.add_record({"record": "inventory", "key": inv_index, **inventory_json})
+
+    yield from writer.finish()
 
 
 @items_routes.route('/items')
@@ -727,6 +888,7 @@ def items_with_username(username=None):
 
 
 @items_routes.route('/@<string:username>/<inventory_slug>')
+@query_budget(25)
 def items_with_username_and_inventory(username=None, inventory_slug=None):
 
     inventory_owner_username = bleach.clean(username)
@@ -750,7 +912,7 @@ def items_with_username_and_inventory(username=None, inventory_slug=None):
         user_locations_ = get_all_user_locations(user_id=logged_in_user.id)
         inventory_templates = get_user_templates(user_id=current_user.id)
 
-        if current_user == inventory_owner_username:
+        if current_user.username == inventory_owner_username:
             inventory_owner = current_user
             inventory_owner_id = inventory_owner.id
 
@@ -837,6 +999,8 @@ def items_with_username_and_inventory(username=None, inventory_slug=None):
     else:
         current_username = None
 
+    if inventory_ is not None and inventory_.access_level == __PUBLIC__:
+        set_cache_policy(REVALIDATE)
 
     return render_template(template_name_or_list='item/items.html',
                            inventory_id=inventory_id,
@@ -900,7 +1064,8 @@ def _get_inventory(inventory_slug: str, logged_in_user_id: int, inventory_owner_
 
 
 
-def find_items_query(requested_username: str, logged_in_user, inventory_id: int, request_params):
+def find_items_query(requested_username: str, logged_in_user, inventory_id: int, request_params,
+                     load_options=ITEM_LIST_LOAD, after_id: int = None, length: int = None):
     query_params = {
         'item_type': request_params["requested_item_type_id"],
         'item_location': request_params["requested_item_location_id"],
@@ -908,11 +1073,16 @@ def find_items_query(requested_username: str, logged_in_user, inventory_id: int,
         'item_tags': request_params["requested_tag_strings"],
         'page': request_params.get("page", 1),
     }
+    if after_id is not None:
+        query_params['after_id'] = after_id
+    if length is not None:
+        query_params['length'] = length
 
     items_ = find_items_new(inventory_id=inventory_id,
                             query_params=query_params,
                             requested_username=requested_username,
-                            logged_in_user=logged_in_user)
+                            logged_in_user=logged_in_user,
+                            load_options=load_options)
 
     item_id_list = []
     data_dict = []
@@ -985,6 +1155,12 @@ def _process_url_query(req_, inventory_user):
     }
 
 
+@job_handler("items_delete")
+def _items_delete_job(job, item_ids: list, inventory_id: int = None):
+    number_items_deleted = delete_items(item_ids=item_ids, user_id=job.user_id, inventory_id=inventory_id)
+    return f"Deleted {number_items_deleted} things."
+
+
 @items_routes.route(rule='/item/delete', methods=['POST'])
 @login_required
 def del_items():
@@ -1016,6 +1192,12 @@ def del_items():
             inventory_id = int(bleach.clean(str(json_data.get('inventory_id'))))
 
         if item_ids is not None and username is not None:
+            if len(item_ids) == 1 and item_ids[0] == -1:
+                # deleting everything can take a while, run it as a job and let the page poll it
+                job_id = submit_job("items_delete", user_id=current_user.id,
+                                    params={"item_ids": item_ids, "inventory_id": inventory_id})
+                return jsonify({"job_id": job_id, "status_url": url_for('jobs.job_status', job_id=job_id)})
+
             delete_items(item_ids=item_ids, user_id=current_user.id, inventory_id=inventory_id)
         else:
             flash("There was a problem deleting your things!")
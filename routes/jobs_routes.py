@@ -0,0 +1,37 @@
+import os
+
+from flask import Blueprint, render_template, jsonify, abort, send_file
+from flask_login import login_required, current_user
+
+from jobs import get_job, get_job_result_path
+
+jobs_routes = Blueprint('jobs', __name__)
+
+
+@jobs_routes.route('/jobs/<int:job_id>')
+@login_required
+def job_page(job_id: int):
+    job_ = get_job(job_id=job_id, user_id=current_user.id)
+    if job_ is None:
+        abort(404)
+    return render_template('jobs/job.html', job=job_, username=current_user.username)
+
+
+@jobs_routes.route('/jobs/<int:job_id>/status')
+@login_required
+def job_status(job_id: int):
+    job_ = get_job(job_id=job_id, user_id=current_user.id)
+    if job_ is None:
+        abort(404)
+    return jsonify(job_)
+
+
+@jobs_routes.route('/jobs/<int:job_id>/download')
+@login_required
+def job_download(job_id: int):
+    result_path = get_job_result_path(job_id=job_id, user_id=current_user.id)
+    if result_path is None:
+        abort(404)
+
+    job_ = get_job(job_id=job_id, user_id=current_user.id)
+    return send_file(os.path.abspath(result_path), as_attachment=True, download_name=job_["result_filename"])
@@ -0,0 +1,21 @@
+import hmac
+
+from flask import Blueprint, Response, abort, request
+
+from app import app
+from metrics import render_metrics
+
+metrics_routes = Blueprint('metrics', __name__)
+
+
+@metrics_routes.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    # not served without a token, so a deployment that never set one does not expose its metrics
+    if not app.config['METRICS'] or not token:
+        abort(404)
+
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(401)
+
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, request
 from flask_login import login_required, current_user
 
+from app import app
 from database_functions import search_items
 
 search_routes = Blueprint('search', __name__)
@@ -11,6 +12,9 @@ search_routes = Blueprint('search', __name__)
 def search():
     query_string = request.args.get('q')
     if query_string is not None:
-        items = search_items(query=query_string, user_id=current_user.id)
-        return render_template('search/search.html', items=items, q=query_string, username=current_user.username)
+        page = request.args.get('page', 1, type=int)
+        per_page = int(app.config['POSTS_PER_PAGE'])
+        items, total = search_items(query=query_string, user_id=current_user.id, page=page, per_page=per_page)
+        return render_template('search/search.html', items=items, q=query_string, username=current_user.username,
+                               page=page, per_page=per_page, total=total)
     return render_template('search/search.html')
@@ -1,5 +1,5 @@
+import multiprocessing
 import os
-from datetime import datetime
 import mimetypes
 
 # Import the main Flask app
@@ -18,6 +18,13 @@ from routes.items_routes import items_routes
 from routes.api_routes import api_routes
 from routes.search_routes import search_routes
 from routes.field_routes import field_routes
+from routes.jobs_routes import jobs_routes
+from routes.metrics_routes import metrics_routes
+
+from compression import compress_response
+from http_caching import apply_cache_policy
+from jobs import recover_jobs
+import query_stats  # registers the statement timing events and the Server-Timing header
 
 
 # Register Blueprints
@@ -32,6 +39,16 @@ app.register_blueprint(items_routes)
 app.register_blueprint(api_routes)
 app.register_blueprint(search_routes)
 app.register_blueprint(field_routes)
+app.register_blueprint(jobs_routes)
+app.register_blueprint(metrics_routes)
+
+# pick up background jobs queued before a restart; not in the image worker processes, which
+# import this module again when they start
+if multiprocessing.parent_process() is None:
+    try:
+        recover_jobs()
+    except Exception as e:
+        app.logger.error(f"Could not recover background jobs: {str(e)}")
 
 
 mimetypes.add_type('application/javascript', '.js')
@@ -50,12 +67,8 @@ def add_headers(response):
     #response.headers['Content-Security-Policy'] = "default-src 'self'; style-src-elem 'self' http://fonts.googleapis.com; font-src 'self' https://fonts.gstatic.com; unsafe-inline"
     response.headers['X-XSS-Protection'] = '1; mode=block'
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['Last-Modified'] = datetime.now()
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
 
-    return response
+    return compress_response(apply_cache_policy(response))
 
 
 # start the server
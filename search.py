@@ -1,34 +1,423 @@
+import abc
+import os
+import queue
+import re
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
 from app import app
 
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class SearchBackend(abc.ABC):
+    """
+    Base class for full-text search backends.
+
+    A backend keeps one index per searchable model (named by the caller, e.g. 'items') holding the
+    model's __searchable__ fields, keyed by the model id and scoped by the owning user id.
+    Documents are plain dictionaries built by search_document().
+    """
+
+    def add(self, index: str, model) -> None:
+        self.add_many(index, [search_document(model)])
+
+    def remove(self, index: str, model) -> None:
+        self.remove_ids(index, [model.id])
+
+    @abc.abstractmethod
+    def add_many(self, index: str, documents: List[dict]) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_ids(self, index: str, ids: List[int]) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self, index: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query(self, index: str, query: str, page: int, per_page: int,
+              user_id: int = None) -> Tuple[List[int], int]:
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(SearchBackend):
+    """Search backend using an external Elasticsearch server."""
+
+    def __init__(self, url: str):
+        from elasticsearch import Elasticsearch
+        self.es = Elasticsearch([url])
+
+    def add_many(self, index: str, documents: List[dict]) -> None:
+        for document in documents:
+            payload = dict(document)
+            doc_id = payload.pop('id')
+            self.es.index(index=index, id=doc_id, body=payload)
+
+    def remove_ids(self, index: str, ids: List[int]) -> None:
+        for doc_id in ids:
+            self.es.delete(index=index, id=doc_id, ignore=[404])
+
+    def clear(self, index: str) -> None:
+        self.es.indices.delete(index=index, ignore=[404])
+
+    def query(self, index: str, query: str, page: int, per_page: int,
+              user_id: int = None) -> Tuple[List[int], int]:
+        es_query = {'multi_match': {'query': query, 'fields': ['*']}}
+        if user_id is not None:
+            es_query = {'bool': {'must': es_query, 'filter': {'term': {'user_id': user_id}}}}
+
+        search = self.es.search(
+            index=index,
+            body={'query': es_query, 'from': (page - 1) * per_page, 'size': per_page})
+
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+
+class SqliteFtsBackend(SearchBackend):
+    """
+    Built-in search backend using an SQLite FTS5 index stored in a local file.
+
+    Each index is an FTS5 table whose rowid is the model id, with one column per searchable
+    field plus an unindexed user_id column. Results are ranked with FTS5's BM25.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._tables = set()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _ensure_table(self, connection: sqlite3.Connection, index: str, fields: List[str]) -> None:
+        if index in self._tables:
+            return
+        columns = ", ".join(f'"{field}"' for field in fields)
+        connection.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{index}" '
+                           f'USING fts5(user_id UNINDEXED, {columns})')
+        self._tables.add(index)
+
+    def _table_exists(self, connection: sqlite3.Connection, index: str) -> bool:
+        if index in self._tables:
+            return True
+        row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (index,)).fetchone()
+        return row is not None
+
+    def add_many(self, index: str, documents: List[dict]) -> None:
+        """Insert or replace several documents of the same index in one transaction."""
+        if len(documents) == 0:
+            return
+        fields = [x for x in documents[0].keys() if x not in ('id', 'user_id')]
+        placeholders = ", ".join("?" for _ in range(len(fields) + 2))
+        columns = ", ".join(f'"{field}"' for field in fields)
+
+        with self._write_lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    self._ensure_table(connection, index, fields)
+                    connection.executemany(f'DELETE FROM "{index}" WHERE rowid = ?',
+                                           [(document['id'],) for document in documents])
+                    connection.executemany(
+                        f'INSERT INTO "{index}" (rowid, user_id, {columns}) VALUES ({placeholders})',
+                        [(document['id'], document['user_id'],
+                          *[document[field] or "" for field in fields]) for document in documents])
+            finally:
+                connection.close()
+
+    def remove_ids(self, index: str, ids: List[int]) -> None:
+        """Remove several documents from an index in one transaction."""
+        if len(ids) == 0:
+            return
+        with self._write_lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    if self._table_exists(connection, index):
+                        connection.executemany(f'DELETE FROM "{index}" WHERE rowid = ?',
+                                               [(doc_id,) for doc_id in ids])
+            finally:
+                connection.close()
+
+    def clear(self, index: str) -> None:
+        """Drop an index completely."""
+        with self._write_lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute(f'DROP TABLE IF EXISTS "{index}"')
+                self._tables.discard(index)
+            finally:
+                connection.close()
+
+    def query(self, index: str, query: str, page: int, per_page: int,
+              user_id: int = None) -> Tuple[List[int], int]:
+        match = _fts_match_expression(query)
+        if match is None:
+            return [], 0
+
+        where = f'"{index}" MATCH ?'
+        params = [match]
+        if user_id is not None:
+            where += ' AND user_id = ?'
+            params.append(user_id)
+
+        connection = self._connect()
+        try:
+            if not self._table_exists(connection, index):
+                return [], 0
+
+            total = connection.execute(f'SELECT count(*) FROM "{index}" WHERE {where}', params).fetchone()[0]
+            rows = connection.execute(f'SELECT rowid FROM "{index}" WHERE {where} '
+                                      f'ORDER BY bm25("{index}") LIMIT ? OFFSET ?',
+                                      params + [per_page, (page - 1) * per_page]).fetchall()
+        finally:
+            connection.close()
+
+        return [row[0] for row in rows], total
+
+
+def search_document(model) -> dict:
+    """
+    Snapshot a searchable model into a search document.
+
+    :param model: A model instance declaring __searchable__.
+    :return: A dictionary with the model id, the owning user id and the searchable field values.
+    """
+    document = {'id': model.id, 'user_id': getattr(model, 'user_id', getattr(model, 'owner_id', None))}
+    for field in model.__searchable__:
+        document[field] = getattr(model, field)
+    return document
+
+
+def _fts_match_expression(query: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 MATCH expression: every word must match, as a prefix.
+
+    :param query: The free text typed by the user.
+    :return: The MATCH expression, or None if the text has no searchable words.
+    """
+    tokens = _TOKEN_RE.findall(query or "")
+    if len(tokens) == 0:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> Optional[SearchBackend]:
+    """
+    Get the configured search backend, creating it on first use.
+
+    SEARCH_BACKEND selects 'sqlite' (the built-in FTS5 index), 'elasticsearch' or 'none'.
+
+    :return: The search backend, or None if searching through an index is disabled.
+    """
+    global _backend
+
+    if _backend is not None:
+        return _backend
+
+    with _backend_lock:
+        if _backend is None:
+            backend_name = app.config.get('SEARCH_BACKEND', 'sqlite')
+            try:
+                if backend_name == 'sqlite':
+                    _backend = SqliteFtsBackend(path=app.config['SEARCH_INDEX_PATH'])
+                elif backend_name == 'elasticsearch' and app.config.get('ELASTICSEARCH_URL'):
+                    _backend = ElasticsearchBackend(url=app.config['ELASTICSEARCH_URL'])
+            except Exception as e:
+                app.logger.error(f"Could not start search backend {backend_name}: {str(e)}")
+                _backend = None
+    return _backend
+
 
 def add_to_index(index, model):
-    if not app.elasticsearch:
+    backend = get_backend()
+    if backend is None:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    app.elasticsearch.index(index=index, id=model.id, body=payload)
+    try:
+        backend.add(index, model)
+    except Exception as e:
+        app.logger.error(f"Error adding {index} {model.id} to search index: {str(e)}")
 
 
 def remove_from_index(index, model):
-    if not app.elasticsearch:
+    backend = get_backend()
+    if backend is None:
+        return
+    try:
+        backend.remove(index, model)
+    except Exception as e:
+        app.logger.error(f"Error removing {index} {model.id} from search index: {str(e)}")
+
+
+def query_index(index, query, page, per_page, user_id=None):
+    """
+    Search an index.
+
+    :return: A tuple of the matching ids for the requested page, best match first, and the total
+             number of matches; or None if there is no search backend and the caller should fall back.
+    """
+    backend = get_backend()
+    if backend is None:
+        return None
+    try:
+        return backend.query(index, query, page, per_page, user_id=user_id)
+    except Exception as e:
+        app.logger.error(f"Error querying search index {index}: {str(e)}")
+        return None
+
+
+# --- Incremental index maintenance ---
+#
+# Searchable objects written by a flush are snapshotted into session.info and only handed to the
+# background indexer once the transaction commits; a rollback throws them away.
+
+_PENDING_KEY = 'search_pending'
+_BATCH_SIZE = 500
+_BATCH_WAIT_SECONDS = 0.5
+
+_index_queue = queue.Queue()
+_indexer_thread = None
+_indexer_lock = threading.Lock()
+
+
+def _is_searchable(obj) -> bool:
+    return hasattr(obj, '__searchable__') and hasattr(obj, '__tablename__')
+
+
+def _searchable_fields_changed(obj) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in obj.__searchable__)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_search_changes(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, {})
+
+    for obj in session.new:
+        if _is_searchable(obj):
+            pending[(obj.__tablename__, obj.id)] = search_document(obj)
+
+    for obj in session.dirty:
+        if _is_searchable(obj) and _searchable_fields_changed(obj):
+            pending[(obj.__tablename__, obj.id)] = search_document(obj)
+
+    for obj in session.deleted:
+        if _is_searchable(obj):
+            pending[(obj.__tablename__, obj.id)] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _queue_search_changes(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        enqueue_index_changes(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_search_changes(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def enqueue_index_changes(changes: dict) -> None:
+    """
+    Hand index changes to the background indexer.
+
+    :param changes: A dictionary of (index, id) to a search document, or None to remove the document.
+    """
+    if get_backend() is None:
+        return
+    _start_indexer()
+    for key, document in changes.items():
+        _index_queue.put((key, document))
+
+
+def _start_indexer() -> None:
+    global _indexer_thread
+
+    if _indexer_thread is not None and _indexer_thread.is_alive():
+        return
+
+    with _indexer_lock:
+        if _indexer_thread is None or not _indexer_thread.is_alive():
+            _indexer_thread = threading.Thread(target=_run_indexer, name="search-indexer", daemon=True)
+            _indexer_thread.start()
+
+
+def _run_indexer() -> None:
+    while True:
+        batch = {}
+        key, document = _index_queue.get()
+        batch[key] = document
+        received = 1
+
+        # collect whatever else arrives shortly after, the latest change to a document wins
+        while len(batch) < _BATCH_SIZE:
+            try:
+                key, document = _index_queue.get(timeout=_BATCH_WAIT_SECONDS)
+            except queue.Empty:
+                break
+            batch[key] = document
+            received += 1
+
+        try:
+            apply_index_changes(batch)
+        finally:
+            for _ in range(received):
+                _index_queue.task_done()
+
+
+def apply_index_changes(changes: dict) -> None:
+    """
+    Write a batch of index changes to the search backend, one add and one remove per index.
+
+    :param changes: A dictionary of (index, id) to a search document, or None to remove the document.
+    """
+    backend = get_backend()
+    if backend is None:
         return
-    app.elasticsearch.delete(index=index, id=model.id)
-
-
-def query_index(index, query, page, per_page):
-    if not app.elasticsearch:
-        return [], 0
-    search = app.elasticsearch.search(
-        index=index,
-        body={
-            'query': {
-                'multi_match': {
-                    'query': query,
-                    'fields': ['*']
-                }
-            },
-              'from': (page - 1) * per_page, 'size': per_page})
-
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+
+    additions = {}
+    removals = {}
+    for (index, doc_id), document in changes.items():
+        if document is None:
+            removals.setdefault(index, []).append(doc_id)
+        else:
+            additions.setdefault(index, []).append(document)
+
+    for index, ids in removals.items():
+        try:
+            backend.remove_ids(index, ids)
+        except Exception as e:
+            app.logger.error(f"Error removing {len(ids)} documents from search index {index}: {str(e)}")
+
+    for index, documents in additions.items():
+        try:
+            backend.add_many(index, documents)
+        except Exception as e:
+            app.logger.error(f"Error adding {len(documents)} documents to search index {index}: {str(e)}")
+
+
+def wait_for_indexer() -> None:
+    """Block until the background indexer has written everything queued so far."""
+    if _indexer_thread is not None:
+        _index_queue.join()
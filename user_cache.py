@@ -0,0 +1,87 @@
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app import app, db
+from loading import USER_SESSION_LOAD
+from models import User
+
+# Session user cache
+#
+# The Flask-Login user loader runs on every authenticated request. It loads the user's identity
+# columns once per USER_CACHE_TTL seconds and merges the cached copy into the request's session
+# without querying, so relationships and deferred columns still load on first access.
+#
+# Each user has a version, bumped by any commit that changes their row, and a cached copy is only
+# used while its version is current. Other worker processes do not see the bump and keep their
+# copy for at most USER_CACHE_TTL seconds.
+
+_PENDING_KEY = 'user_cache_pending'
+
+_users = {}
+_versions = {}
+_lock = threading.Lock()
+
+
+def load_session_user(user_id: int) -> Optional[User]:
+    """
+    Load a user for the current request.
+
+    :param user_id: The id of the user.
+    :return: The user, attached to the current session, or None if there is no such user.
+    """
+    user_id = int(user_id)
+    ttl = float(app.config['USER_CACHE_TTL'])
+    now = time.monotonic()
+
+    with _lock:
+        version = _versions.get(user_id, 0)
+        entry = _users.get(user_id)
+
+    if entry is not None and entry[0] > now and entry[1] == version:
+        user_ = entry[2]
+    else:
+        with app.app_context():
+            user_ = db.session.execute(select(User).where(User.id == user_id)
+                                       .options(*USER_SESSION_LOAD)).scalar_one_or_none()
+        if user_ is None:
+            return None
+
+        if ttl > 0:
+            with _lock:
+                # the user changed while we were loading them, do not cache the old copy
+                if _versions.get(user_id, 0) == version:
+                    _users[user_id] = (now + ttl, version, user_)
+
+    return db.session.merge(user_, load=False)
+
+
+def invalidate_session_user(user_id: int) -> None:
+    """Bump a user's version so their cached copy is not used again."""
+    with _lock:
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+        _users.pop(user_id, None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_user_changes(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            pending.add(obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_user_changes(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        for user_id in pending:
+            invalidate_session_user(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_user_changes(session):
+    session.info.pop(_PENDING_KEY, None)
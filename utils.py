@@ -1,5 +1,8 @@
+import os
 import random
 import string
+from io import BytesIO
+from typing import Dict, List, Tuple
 
 from PIL import Image
 
@@ -45,3 +48,80 @@ def generate_item_image_filename(item_slug: str, item_id: int, img_type: str) ->
     rand_ = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
     img_filename = f"{item_slug}_{item_id}_{rand_}.{img_type}"
     return img_filename
+
+
+def derivative_filename(image_filename: str, name: str, extension: str = None) -> str:
+    """
+    The filename of one derivative of an image.
+
+    :param image_filename: The filename of the image, as stored in Image.image_filename.
+    :param name: The name of the derivative, e.g. "thumb".
+    :param extension: The file extension, defaults to the image's own.
+    """
+    stem, own_extension = os.path.splitext(image_filename)
+    if extension is None:
+        extension = own_extension.lstrip(".")
+    return f"{stem}_{name}.{extension}"
+
+
+def _save_image(image: Image, path: str, image_format: str, **params) -> None:
+    # write next to the target and rename, so a file that exists is always complete
+    partial_path = f"{path}.part"
+    image.save(partial_path, format=image_format, **params)
+    os.replace(partial_path, path)
+
+
+def write_image_derivatives(image_data: bytes, image_filename: str, directory: str, sizes: List[Tuple[str, int]],
+                            write_webp: bool = False, keep_full: bool = False) -> Dict[str, dict]:
+    """
+    Decode an image once and write all of its derivatives.
+
+    JPEG images are decoded in draft mode straight at the smallest scale that still covers the
+    largest derivative, and each smaller derivative is scaled down from the previous one.
+
+    This only depends on Pillow, so it can run in the image worker processes.
+
+    :param image_data: The uploaded image file.
+    :param image_filename: The filename of the full size image, in directory.
+    :param directory: The directory of the user's images.
+    :param sizes: The derivatives as (name, max size in pixels), largest first.
+    :param write_webp: Also write each derivative as WebP.
+    :param keep_full: The image file itself is the "full" JPEG (images stored before "full" was a
+                      derivative of its own), do not write one.
+    :return: The variants written, in the Image.variants shape.
+    """
+    largest = sizes[0][1] if len(sizes) > 0 else 600
+
+    image = Image.open(BytesIO(image_data))
+    if image.format == "JPEG":
+        image.draft("RGB", (largest, largest))
+    image = correct_image_orientation(image=image)
+    image = image.convert('RGB')
+
+    variants = {}
+    for name, size in sizes:
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        if keep_full and name == "full":
+            filename = image_filename
+        else:
+            filename = derivative_filename(image_filename, name)
+            _save_image(image, os.path.join(directory, filename), image_format="JPEG", optimize=True)
+
+        webp_filename = None
+        if write_webp:
+            webp_filename = derivative_filename(image_filename, name, extension="webp")
+            _save_image(image, os.path.join(directory, webp_filename), image_format="WEBP")
+
+        variants[name] = {"file": filename, "width": image.width, "height": image.height, "webp": webp_filename}
+
+    return variants
+
+
+def write_image_derivatives_from_file(image_filename: str, directory: str, sizes: List[Tuple[str, int]],
+                                      write_webp: bool = False) -> Dict[str, dict]:
+    """Run write_image_derivatives on an image file of the user's directory."""
+    with open(os.path.join(directory, image_filename), "rb") as image_file:
+        image_data = image_file.read()
+    return write_image_derivatives(image_data=image_data, image_filename=image_filename, directory=directory,
+                                   sizes=sizes, write_webp=write_webp)